@@ -56,8 +56,12 @@ const CartController = {
       
       try {
         const cartProductIds = cartItems.map(item => item.product_id);
-        mlComplementaryItems = await mlService.getComplementaryItems(cartProductIds, 5);
-        mlBestDeals = await mlService.getBestDeals(cartProductIds, 3);
+        if (cartProductIds.length > 0) {
+          [mlComplementaryItems, mlBestDeals] = await mlService.batch([
+            { path: '/api/cart/complementary', body: { product_ids: cartProductIds, limit: 5 } },
+            { path: '/api/cart/best-deals', body: { product_ids: cartProductIds, limit: 3 } }
+          ]);
+        }
       } catch (error) {
         console.error('Error fetching ML cart recommendations:', error);
         // Continue without ML recommendations if they fail
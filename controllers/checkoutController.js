@@ -1,6 +1,7 @@
 const Cart = require('../models/cart');
 const Order = require('../models/order');
 const crypto = require('crypto');
+const mlService = require('../utils/mlService');
 
 /**
  * Checkout controller for handling order processing and payments
@@ -145,6 +146,7 @@ const CheckoutController = {
         
         // Update order status to paid
         await Order.updateOrderStatus(orderId, 'paid');
+        mlService.notifyOrderPaid(orderId, req.session.userId);
         
         // Clear the cart after successful payment
         await Cart.clearCart(req.session.userId);
@@ -176,6 +178,7 @@ const CheckoutController = {
       
       // Update order status to paid
       await Order.updateOrderStatus(order_id, 'paid');
+      mlService.notifyOrderPaid(order_id, req.session.userId);
       
       // Clear the cart after successful payment
       await Cart.clearCart(req.session.userId);
@@ -147,8 +147,10 @@ const shopController = {
       let mlAlsoBought = [];
 
       try {
-        mlSimilarProducts = await mlService.getSimilarProducts(productId, 5);
-        mlAlsoBought = await mlService.getAlsoBought(productId, 5);
+        [mlSimilarProducts, mlAlsoBought] = await mlService.batch([
+          { path: '/api/product/similar', body: { product_id: productId, limit: 5 } },
+          { path: '/api/product/also-bought', body: { product_id: productId, limit: 5 } }
+        ]);
       } catch (error) {
         console.error('Error fetching ML recommendations:', error);
         // Continue with regular similar products if ML fails
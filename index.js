@@ -59,6 +59,8 @@ app.use(async (req, res, next) => {
     try {
       const cartItems = await Cart.getCartItems(req.session.userId);
       res.locals.cartCount = cartItems.length;
+      // Passed to the ML service so it does not query the cart again
+      res.locals.cartProductIds = cartItems.map(item => item.product_id);
     } catch (error) {
       console.error('Error fetching cart count:', error);
       res.locals.cartCount = 0;
@@ -93,7 +95,7 @@ app.get('/', async (req, res) => {
     let mlRecommendations = [];
     if (req.session.userId) {
       try {
-        mlRecommendations = await mlService.getHomeRecommendations(req.session.userId, 8);
+        mlRecommendations = await mlService.getHomeRecommendations(req.session.userId, 8, res.locals.cartProductIds);
       } catch (error) {
         console.error('Error fetching ML recommendations:', error);
       }
@@ -1,6 +1,7 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
 import time
+import json
 import psycopg2
 from psycopg2 import OperationalError
 import sys
@@ -14,18 +15,30 @@ from models.similarity import ProductSimilarity
 from models.cart_suggestions import CartSuggestions
 from models.shop_ranking import ShopRanking
 from models.search_ranking import SearchRanking
-from utils.database import get_db_connection
+from models.catalog import catalog_store
+from models.user_profiles import profile_store
+from models.shop_stats import shop_stats_store
+from utils.database import get_db_connection, shared_connection
+from utils import cache
+from utils import metrics
+from utils.serialization import dumps
+from utils.warmup import warmup
 
 app = Flask(__name__)
 CORS(app)
 
-# Initialize ML models
+# Initialize ML models (all share catalog_store)
 home_recommender = HomePageRecommendations()
 product_similarity = ProductSimilarity()
 cart_suggestions = CartSuggestions()
 shop_ranking = ShopRanking()
 search_ranking = SearchRanking()
 
+# Requests replayed before the service reports ready, JSON lines of {"path": ..., "body": ...}
+WARMUP_REQUESTS = os.getenv('WARMUP_REQUESTS', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'data', 'warmup_requests.jsonl'
+))
+
 def wait_for_db(max_retries=30, delay=2):
     """Wait for database to be ready"""
     for i in range(max_retries):
@@ -39,131 +52,287 @@ def wait_for_db(max_retries=30, delay=2):
             time.sleep(delay)
     return False
 
+def require_db():
+    if not wait_for_db():
+        raise RuntimeError("database is unreachable")
+
+# Each handler takes the request body and returns the result, or a
+# (result, status) tuple, so routes and /api/batch share the same logic
+
+def recommend_home_handler(data):
+    user_id = data.get('user_id')
+    limit = data.get('limit', 8)
+    
+    if not user_id:
+        # Return popular products for non-logged-in users
+        return home_recommender.get_popular_products(limit)
+    return home_recommender.recommend_for_user(user_id, limit, data.get('cart_product_ids'))
+
+def similar_products_handler(data):
+    product_id = data.get('product_id')
+    limit = data.get('limit', 5)
+    
+    if not product_id:
+        return [], 400
+    return product_similarity.get_similar_products(product_id, limit)
+
+def also_bought_handler(data):
+    product_id = data.get('product_id')
+    limit = data.get('limit', 5)
+    
+    if not product_id:
+        return [], 400
+    return product_similarity.get_customers_also_bought(product_id, limit)
+
+def complementary_items_handler(data):
+    cart_product_ids = data.get('product_ids', [])
+    limit = data.get('limit', 5)
+    
+    if not cart_product_ids:
+        return []
+    return cart_suggestions.get_complementary_items(cart_product_ids, limit)
+
+def best_deals_handler(data):
+    cart_product_ids = data.get('product_ids', [])
+    limit = data.get('limit', 3)
+    
+    if not cart_product_ids:
+        return []
+    return cart_suggestions.get_best_deals(cart_product_ids, limit)
+
+def ranked_shops_handler(data):
+    return shop_ranking.get_all_shops_ranked(data.get('user_id'))
+
+def search_handler(data):
+    query_text = data.get('query', '')
+    limit = data.get('limit', 20)
+    user_id = data.get('user_id')
+    
+    if not query_text:
+        return []
+    return search_ranking.search_products(query_text, limit, user_id)
+
+def suggest_handler(data):
+    prefix = data.get('prefix', '')
+    limit = data.get('limit', 10)
+    
+    if not prefix:
+        return []
+    return search_ranking.suggest_terms(prefix, limit)
+
+HANDLERS = {
+    '/api/recommend/home': recommend_home_handler,
+    '/api/product/similar': similar_products_handler,
+    '/api/product/also-bought': also_bought_handler,
+    '/api/cart/complementary': complementary_items_handler,
+    '/api/cart/best-deals': best_deals_handler,
+    '/api/shops/ranked': ranked_shops_handler,
+    '/api/search': search_handler,
+    '/api/search/suggest': suggest_handler,
+}
+
+def run_handler(handler, data, name):
+    """Run a handler, returning (result, status) and [] with 500 on errors"""
+    try:
+        result = handler(data)
+    except Exception as e:
+        print(f"Error in {name}: {e}")
+        return [], 500
+    if isinstance(result, tuple):
+        return result
+    return result, 200
+
+def replay_warmup_requests(path=WARMUP_REQUESTS):
+    """Run the requests listed in path through their handlers, so the first real ones find warm caches"""
+    if not os.path.exists(path):
+        return 0
+    with open(path, encoding='utf-8') as f:
+        warmup_requests = [json.loads(line) for line in f if line.strip()]
+    for sub in warmup_requests:
+        handler = HANDLERS.get(sub.get('path'))
+        if handler is not None:
+            run_handler(handler, sub.get('body') or {}, sub['path'])
+    print(f"Replayed {len(warmup_requests)} warmup requests")
+    return len(warmup_requests)
+
+def start_auto_refresh():
+    """Pick up new and edited products, newly paid orders and shop edits, without retraining"""
+    catalog_store.start_auto_refresh()
+    profile_store.start_auto_refresh()
+    shop_stats_store.start_auto_refresh()
+
+# Loaded before the service reports ready: by wsgi.py in the gunicorn master, else in the background
+warmup.add('database', require_db)
+warmup.add('catalog', catalog_store.load)
+warmup.add('user_profiles', profile_store.load)
+warmup.add('shop_stats', shop_stats_store.load)
+warmup.add('search_cache', search_ranking.warm, required=False)
+warmup.add('warmup_requests', replay_warmup_requests, required=False)
+
+def json_response(result, status=200):
+    """Response of a handler result, see utils/serialization.py"""
+    with metrics.stage('serialize'):
+        return Response(dumps(result), status=status, mimetype='application/json')
+
+def request_json():
+    """The JSON object of the request body, {} for anything else (like asgi.read_json)"""
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+def respond(handler, name):
+    result, status = run_handler(handler, request_json(), name)
+    return json_response(result, status)
+
+@app.before_request
+def start_request_timer():
+    # Label by route pattern, so unknown paths cannot add series
+    g.metrics_timer = metrics.start_request(request.url_rule.rule if request.url_rule else 'unmatched')
+
+@app.after_request
+def record_request(response):
+    timer = g.get('metrics_timer')
+    if timer is not None:
+        if metrics.SERVER_TIMING:
+            response.headers['Server-Timing'] = timer.server_timing()
+        timer.finish(response.status_code)
+    return response
+
 @app.route('/api/recommend/home', methods=['POST'])
 def recommend_home():
     """1. Home page recommendations"""
-    try:
-        data = request.json or {}
-        user_id = data.get('user_id')
-        limit = data.get('limit', 8)
-        
-        if not user_id:
-            # Return popular products for non-logged-in users
-            recommendations = home_recommender.get_popular_products(limit)
-        else:
-            recommendations = home_recommender.recommend_for_user(user_id, limit)
-        
-        return jsonify(recommendations)
-    except Exception as e:
-        print(f"Error in recommend_home: {e}")
-        return jsonify([]), 500
+    return respond(recommend_home_handler, 'recommend_home')
 
 @app.route('/api/product/similar', methods=['POST'])
 def get_similar_products():
     """2. Product detail page - Similar products"""
-    try:
-        data = request.json or {}
-        product_id = data.get('product_id')
-        limit = data.get('limit', 5)
-        
-        if not product_id:
-            return jsonify([]), 400
-        
-        similar = product_similarity.get_similar_products(product_id, limit)
-        return jsonify(similar)
-    except Exception as e:
-        print(f"Error in get_similar_products: {e}")
-        return jsonify([]), 500
+    return respond(similar_products_handler, 'get_similar_products')
 
 @app.route('/api/product/also-bought', methods=['POST'])
 def get_also_bought():
     """2. Product detail page - Customers also bought"""
-    try:
-        data = request.json or {}
-        product_id = data.get('product_id')
-        limit = data.get('limit', 5)
-        
-        if not product_id:
-            return jsonify([]), 400
-        
-        also_bought = product_similarity.get_customers_also_bought(product_id, limit)
-        return jsonify(also_bought)
-    except Exception as e:
-        print(f"Error in get_also_bought: {e}")
-        return jsonify([]), 500
+    return respond(also_bought_handler, 'get_also_bought')
 
 @app.route('/api/cart/complementary', methods=['POST'])
 def get_complementary_items():
     """3. Cart page - Complementary items"""
-    try:
-        data = request.json or {}
-        cart_product_ids = data.get('product_ids', [])
-        limit = data.get('limit', 5)
-        
-        if not cart_product_ids:
-            return jsonify([])
-        
-        complementary = cart_suggestions.get_complementary_items(cart_product_ids, limit)
-        return jsonify(complementary)
-    except Exception as e:
-        print(f"Error in get_complementary_items: {e}")
-        return jsonify([]), 500
+    return respond(complementary_items_handler, 'get_complementary_items')
 
 @app.route('/api/cart/best-deals', methods=['POST'])
 def get_best_deals():
     """3. Cart page - Best deals"""
-    try:
-        data = request.json or {}
-        cart_product_ids = data.get('product_ids', [])
-        limit = data.get('limit', 3)
-        
-        if not cart_product_ids:
-            return jsonify([])
-        
-        deals = cart_suggestions.get_best_deals(cart_product_ids, limit)
-        return jsonify(deals)
-    except Exception as e:
-        print(f"Error in get_best_deals: {e}")
-        return jsonify([]), 500
+    return respond(best_deals_handler, 'get_best_deals')
 
 @app.route('/api/shops/ranked', methods=['POST'])
 def get_ranked_shops():
     """4. Shop listing page - Personalized ranking"""
-    try:
-        data = request.json or {}
-        user_id = data.get('user_id')
-        
-        shops = shop_ranking.get_all_shops_ranked(user_id)
-        return jsonify(shops)
-    except Exception as e:
-        print(f"Error in get_ranked_shops: {e}")
-        return jsonify([]), 500
+    return respond(ranked_shops_handler, 'get_ranked_shops')
 
 @app.route('/api/search', methods=['POST'])
 def search_products():
     """5. Search functionality - ML-ranked results"""
-    try:
-        data = request.json or {}
-        query_text = data.get('query', '')
-        limit = data.get('limit', 20)
-        user_id = data.get('user_id')
-        
-        if not query_text:
-            return jsonify([])
+    return respond(search_handler, 'search_products')
+
+@app.route('/api/search/suggest', methods=['POST'])
+def suggest_search_terms():
+    """5. Search functionality - Autocomplete"""
+    return respond(suggest_handler, 'suggest_search_terms')
+
+def _prefetch_similar_products(sub_requests):
+    """Score every similar-products sub-request of a batch in one pass"""
+    wanted = [
+        sub for sub in sub_requests
+        if isinstance(sub, dict) and sub.get('path') == '/api/product/similar' and (sub.get('body') or {}).get('product_id')
+    ]
+    if len(wanted) < 2:
+        return {}
+    
+    limits = [max(int(sub['body'].get('limit', 5)), 0) for sub in wanted]
+    product_ids = [sub['body']['product_id'] for sub in wanted]
+    similar = product_similarity.get_similar_products_batch(product_ids, max(limits))
+    return {
+        id(sub): results[:limit]
+        for sub, limit, results in zip(wanted, limits, similar)
+    }
+
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    """Run several API calls in one round trip.
+
+    Body: { "requests": [{ "path": "/api/search", "body": {...} }, ...] }
+    Returns one { "status", "data" } entry per sub-request, in order. All
+    sub-requests see the same catalog snapshot and share one DB connection.
+    """
+    sub_requests = request_json().get('requests')
+    if not isinstance(sub_requests, list):
+        return jsonify({'error': 'requests must be a list'}), 400
+    
+    responses = []
+    with catalog_store.pinned(), shared_connection():
+        try:
+            prefetched = _prefetch_similar_products(sub_requests)
+        except Exception as e:
+            print(f"Error in batch similar products: {e}")
+            prefetched = {}
         
-        results = search_ranking.search_products(query_text, limit, user_id)
-        return jsonify(results)
+        for sub in sub_requests:
+            handler = HANDLERS.get(sub.get('path')) if isinstance(sub, dict) else None
+            if handler is None:
+                responses.append({'status': 404, 'data': []})
+            elif id(sub) in prefetched:
+                responses.append({'status': 200, 'data': prefetched[id(sub)]})
+            else:
+                result, status = run_handler(handler, sub.get('body') or {}, sub['path'])
+                responses.append({'status': status, 'data': result})
+    
+    return json_response({'results': responses})
+
+@app.route('/api/events/order-paid', methods=['POST'])
+def order_paid():
+    """Called by the web app once an order is paid, so cached rankings refresh"""
+    # Fold the order into the buyer's profile and the shop stats now rather
+    # than at the next poll, before dropping the rankings computed without it
+    try:
+        profile_store.refresh()
+    except Exception as e:
+        print(f"Error refreshing user profiles: {e}")
+    cache.invalidate('popular_products', 'shop_ranking')
+    return jsonify({'status': 'ok'})
+
+@app.route('/api/catalog/refresh', methods=['POST'])
+def refresh_catalog():
+    """Apply products added or edited since the last refresh right away"""
+    try:
+        applied = catalog_store.refresh()
     except Exception as e:
-        print(f"Error in search_products: {e}")
-        return jsonify([]), 500
+        print(f"Error in refresh_catalog: {e}")
+        return jsonify({'status': 'error'}), 500
+    return jsonify({'status': 'ok', 'applied': applied})
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(cache.cache_stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics of every worker"""
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
 
 @app.route('/health', methods=['GET'])
+@app.route('/health/live', methods=['GET'])
 def health_check():
+    """The process is up and serving, models loaded or not"""
     return jsonify({'status': 'ok', 'service': 'ml-service'})
 
+@app.route('/health/ready', methods=['GET'])
+def readiness_check():
+    """200 once every model is loaded, 503 with the state of each until then"""
+    report = warmup.report()
+    return jsonify(dict(report, service='ml-service')), 200 if report['ready'] else 503
+
 if __name__ == '__main__':
-    # Wait for database before starting
-    wait_for_db()
+    # Load the models in the background; /health/ready turns 200 once they are in
+    warmup.start(then=start_auto_refresh)
     app.run(host='0.0.0.0', port=5000, debug=False)
 
 
@@ -0,0 +1,174 @@
+"""ASGI entry point: the API on an asyncio event loop.
+
+The model endpoints and /api/batch are asyncio handlers. Their blocking
+work (scoring, Postgres queries) runs on a bounded thread pool, so a slow
+query holds one pool thread rather than a worker, and independent queries
+of one request run concurrently. Every other route (events, stats,
+health) is served by the Flask app from app.py, mounted underneath.
+
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+"""
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from a2wsgi import WSGIMiddleware
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import asyncio
+import os
+
+# Loads the models once, before gunicorn forks the workers (see wsgi.py for ML_WARMUP)
+from wsgi import app as flask_app
+from app import HANDLERS, run_handler, home_recommender, _prefetch_similar_products
+from models.catalog import catalog_store
+from models.user_profiles import profile_store
+from utils.database import DB_POOL_MAX, shared_connection
+from utils import metrics
+from utils.serialization import dumps
+
+# Threads running blocking handler work; queries beyond the DB pool wait for a connection
+ASYNC_THREADS = int(os.getenv('ML_ASYNC_THREADS', DB_POOL_MAX * 2))
+
+_executor = None
+
+
+def get_executor():
+    """The worker's thread pool, created after fork on first use"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=ASYNC_THREADS, thread_name_prefix='ml-async')
+    return _executor
+
+
+async def offload(func, *args, catalog=None):
+    """Run func(*args) on the thread pool, pinned to catalog when given.
+
+    The call sees the caller's context, so its stages count towards the request.
+    """
+    if catalog is not None:
+        def pinned_call():
+            with catalog_store.pinned(catalog):
+                return func(*args)
+        call = pinned_call
+    else:
+        call = functools.partial(func, *args)
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), context.run, call)
+
+
+def json_response(result, status=200):
+    # The encoder of app.py's routes, so both servers produce the same bytes
+    with metrics.stage('serialize'):
+        return Response(dumps(result), status_code=status, media_type='application/json')
+
+
+def timed(path):
+    """Decorate an async route to record it like the Flask routes"""
+    def decorate(route):
+        @functools.wraps(route)
+        async def handle(request):
+            timer = metrics.start_request(path)
+            response = await route(request)
+            if metrics.SERVER_TIMING:
+                response.headers['Server-Timing'] = timer.server_timing()
+            timer.finish(response.status_code)
+            return response
+        return handle
+    return decorate
+
+
+async def read_json(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def recommend_home_handler(data, catalog=None):
+    """Home recommendations, loading the profile and cart concurrently"""
+    user_id = data.get('user_id')
+    cart_product_ids = data.get('cart_product_ids')
+
+    if user_id and cart_product_ids is None:
+        _, cart_items = await asyncio.gather(
+            offload(profile_store.get, user_id),
+            offload(home_recommender.get_user_cart_items, user_id),
+        )
+        data = dict(data, cart_product_ids=cart_items['product_id'].tolist())
+    return await offload(run_handler, HANDLERS['/api/recommend/home'], data, 'recommend_home', catalog=catalog)
+
+
+# Handlers that need more than running the sync handler off the loop
+ASYNC_HANDLERS = {
+    '/api/recommend/home': recommend_home_handler,
+}
+
+
+async def run_async_handler(path, data, catalog=None):
+    """(result, status) of the handler for path, [] with 500 on errors"""
+    if path in ASYNC_HANDLERS:
+        try:
+            return await ASYNC_HANDLERS[path](data, catalog)
+        except Exception as e:
+            print(f"Error in {path}: {e}")
+            return [], 500
+    return await offload(run_handler, HANDLERS[path], data, path, catalog=catalog)
+
+
+def endpoint(path):
+    @timed(path)
+    async def handle(request):
+        result, status = await run_async_handler(path, await read_json(request))
+        return json_response(result, status)
+    return handle
+
+
+@timed('/api/batch')
+async def batch(request):
+    """/api/batch with every sub-request running concurrently on one catalog snapshot.
+
+    Sub-requests share one database connection, as under app.py: their
+    scoring runs in parallel, their queries one after the other.
+    """
+    data = await read_json(request)
+    sub_requests = data.get('requests')
+    if not isinstance(sub_requests, list):
+        return json_response({'error': 'requests must be a list'}, 400)
+
+    catalog = catalog_store.get()
+
+    async def run_sub(sub):
+        path = sub.get('path') if isinstance(sub, dict) else None
+        if path not in HANDLERS:
+            return {'status': 404, 'data': []}
+        if id(sub) in prefetched:
+            return {'status': 200, 'data': prefetched[id(sub)]}
+        result, status = await run_async_handler(path, sub.get('body') or {}, catalog)
+        return {'status': status, 'data': result}
+
+    # offload() copies this context, so the sub-requests' threads join the connection
+    with shared_connection():
+        try:
+            prefetched = await offload(_prefetch_similar_products, sub_requests, catalog=catalog)
+        except Exception as e:
+            print(f"Error in batch similar products: {e}")
+            prefetched = {}
+        responses = await asyncio.gather(*(run_sub(sub) for sub in sub_requests))
+    return json_response({'results': list(responses)})
+
+
+routes = [Route(path, endpoint(path), methods=['POST']) for path in HANDLERS]
+routes += [
+    Route('/api/batch', batch, methods=['POST']),
+    # Everything else is served by the Flask app
+    Mount('/', WSGIMiddleware(flask_app)),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+)
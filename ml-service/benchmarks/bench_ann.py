@@ -0,0 +1,115 @@
+"""Recall and latency of the IVF index used for home recommendations.
+
+Builds a synthetic topic-structured catalog, then for random users compares
+IVFIndex.query at several nprobe values against the exact cosine path:
+recall@limit (share of the exact top results the index returns) and p50/p99
+latency. Prints one JSON object per measurement.
+
+    python benchmarks/bench_ann.py --sizes 100000 1000000 --nprobe 1 2 4 8 16 32
+"""
+import argparse
+import json
+import sys
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.ann_index import IVFIndex, normalize_rows
+from utils.ranking import top_k_rows
+
+VOCABULARY = [f"term{i}" for i in range(100)]
+
+
+def make_vectors(n_products, n_topics=200, seed=0):
+    """TF-IDF vectors of products drawing most of their words from one topic"""
+    rng = np.random.default_rng(seed)
+    topic_terms = rng.integers(0, len(VOCABULARY), size=(n_topics, 8))
+    topics = rng.integers(0, n_topics, n_products)
+    own = topic_terms[topics[:, None], rng.integers(0, 8, size=(n_products, 5))]
+    noise = rng.integers(0, len(VOCABULARY), size=(n_products, 2))
+    words = np.array(VOCABULARY)[np.concatenate([own, noise], axis=1)]
+    vectorizer = TfidfVectorizer(max_features=100)
+    return vectorizer.fit_transform([' '.join(row) for row in words]), topics
+
+
+def make_users(topics, n_users, seed=1):
+    """Purchased and excluded rows of users who buy from one or two topics"""
+    rng = np.random.default_rng(seed)
+    by_topic = pd.Series(np.arange(len(topics))).groupby(topics).apply(np.asarray)
+    users = []
+    for _ in range(n_users):
+        user_topics = rng.choice(by_topic.index, size=rng.integers(1, 3), replace=False)
+        pool = np.concatenate([by_topic[topic] for topic in user_topics])
+        purchased = rng.choice(pool, size=min(5, len(pool)), replace=False)
+        users.append((purchased, np.concatenate([purchased, rng.choice(len(topics), 2)])))
+    return users
+
+
+def exact_top(product_vectors, purchased, excluded, limit):
+    user_vector = np.asarray(product_vectors[purchased].mean(axis=0))
+    similarities = cosine_similarity(user_vector, product_vectors).ravel()
+    return top_k_rows(similarities, limit, exclude_rows=excluded)
+
+
+def ann_top(index, embeddings, purchased, excluded, limit, nprobe):
+    user_vector = embeddings[purchased].mean(axis=0)
+    rows, _ = index.query(user_vector / np.linalg.norm(user_vector), limit, nprobe=nprobe, exclude_rows=excluded)
+    return rows
+
+
+def timed(func, users):
+    timings, results = [], []
+    for user in users:
+        start = time.perf_counter()
+        results.append(func(*user))
+        timings.append((time.perf_counter() - start) * 1000)
+    return results, {
+        'p50_ms': round(float(np.percentile(timings, 50)), 3),
+        'p99_ms': round(float(np.percentile(timings, 99)), 3),
+    }
+
+
+def run(sizes, nprobes, n_users, limit):
+    results = []
+    for n_products in sizes:
+        product_vectors, topics = make_vectors(n_products)
+        embeddings = normalize_rows(product_vectors)
+        start = time.perf_counter()
+        index = IVFIndex.build(embeddings)
+        build_s = time.perf_counter() - start
+        users = make_users(topics, n_users)
+
+        exact, timing = timed(lambda p, e: exact_top(product_vectors, p, e, limit), users)
+        result = {'catalog_size': n_products, 'path': 'exact', 'recall': 1.0}
+        result.update(timing)
+        print(json.dumps(result), flush=True)
+        results.append(result)
+
+        for nprobe in nprobes:
+            approx, timing = timed(lambda p, e: ann_top(index, embeddings, p, e, limit, nprobe), users)
+            recall = np.mean([
+                len(np.intersect1d(a, e)) / len(e) for a, e in zip(approx, exact) if len(e)
+            ])
+            result = {
+                'catalog_size': n_products, 'path': 'ivf', 'n_lists': index.n_lists,
+                'nprobe': nprobe, 'recall': round(float(recall), 4), 'build_s': round(build_s, 2),
+            }
+            result.update(timing)
+            print(json.dumps(result), flush=True)
+            results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000])
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--limit', type=int, default=8)
+    args = parser.parse_args()
+    run(args.sizes, args.nprobe, args.users, args.limit)
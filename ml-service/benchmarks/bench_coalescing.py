@@ -0,0 +1,146 @@
+"""Bursts of identical cold requests, with and without request coalescing.
+
+Prepares a dataset and models like bench_models.py, then for each
+--concurrency level starts that many threads at once on the same cold
+call: popular products (a SQL aggregate), the anonymous shop ranking and
+one search query, with their caches cleared before every burst. The
+coalesced variant is the service as it runs (utils/singleflight.py); the
+uncoalesced one lets every thread compute, as before. Reports the
+queries run per burst and burst duration percentiles, one JSON object
+per (method, variant, concurrency).
+
+    python benchmarks/bench_coalescing.py --products 100000 --concurrency 1 8 32
+"""
+import argparse
+import contextlib
+import threading
+import sys
+import os
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import datasets
+from bench_models import connect, run_info
+from utils import cache
+from utils.singleflight import SingleFlight
+
+
+class QueryCounter:
+    """Number of fetch_data calls so far"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def wrap(self, fetch):
+        def counted_fetch(*args, **kwargs):
+            with self._lock:
+                self.count += 1
+            return fetch(*args, **kwargs)
+        return counted_fetch
+
+
+@contextlib.contextmanager
+def count_queries():
+    """Count the queries of every module's fetch_data (SQLite or Postgres) within the block"""
+    queries = QueryCounter()
+    replaced = []
+    for module in list(sys.modules.values()):
+        fetch = getattr(module, 'fetch_data', None)
+        if callable(fetch):
+            replaced.append((module, fetch))
+            module.fetch_data = queries.wrap(fetch)
+    try:
+        yield queries
+    finally:
+        for module, fetch in replaced:
+            module.fetch_data = fetch
+
+
+@contextlib.contextmanager
+def uncoalesced():
+    """Every SingleFlight.do call computes, as before coalescing"""
+    do = SingleFlight.do
+    SingleFlight.do = lambda self, key, func, timeout=None: func()
+    try:
+        yield
+    finally:
+        SingleFlight.do = do
+
+
+def burst(func, concurrency):
+    """Seconds until concurrency threads started together have all returned"""
+    barrier = threading.Barrier(concurrency + 1)
+    errors = []
+
+    def call():
+        barrier.wait()
+        try:
+            func()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return time.perf_counter() - start
+
+
+def bursts(func, variant, concurrency, n_bursts, queries):
+    """Burst durations (ms) and queries run per burst, caches cleared before each"""
+    timings, query_counts = [], []
+    for _ in range(n_bursts):
+        cache.invalidate('popular_products', 'shop_ranking', 'search')
+        before = queries.count
+        with contextlib.redirect_stdout(sys.stderr), \
+                (uncoalesced() if variant == 'uncoalesced' else contextlib.nullcontext()):
+            timings.append(burst(func, concurrency) * 1000)
+        query_counts.append(queries.count - before)
+    return timings, query_counts
+
+
+def run(args):
+    info = run_info()
+    for n_products in args.products:
+        with contextlib.redirect_stdout(sys.stderr):
+            dataset_dir, dataset = datasets.prepare(n_products, args.order_items, seed=args.seed)
+            models = connect(dataset_dir, 'sqlite', None)
+        query_text = datasets.sample_inputs(dataset_dir, 1, args.seed)['queries'][0]
+        home, shops, search = models['home'], models['shops'], models['search']
+        calls = {
+            'get_popular_products': lambda: home.get_popular_products(8),
+            'get_all_shops_ranked': lambda: shops.get_all_shops_ranked(None),
+            'search_products': lambda: search.search_products(query_text, 20),
+        }
+
+        with count_queries() as queries:
+            for method, func in calls.items():
+                for variant in ('coalesced', 'uncoalesced'):
+                    for concurrency in args.concurrency:
+                        timings, query_counts = bursts(func, variant, concurrency, args.bursts, queries)
+                        datasets.emit(dict({
+                            'benchmark': 'coalescing', 'method': method, 'variant': variant,
+                            'concurrency': concurrency, 'dataset': dataset['name'], 'catalog_size': n_products,
+                            'bursts': args.bursts,
+                            'queries_per_burst': round(float(np.mean(query_counts)), 2),
+                            'p50_ms': round(float(np.percentile(timings, 50)), 3),
+                            'p99_ms': round(float(np.percentile(timings, 99)), 3),
+                        }, **info), args.output)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, nargs='+', default=[100_000])
+    parser.add_argument('--order-items', type=int, default=1_000_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--bursts', type=int, default=10, help='bursts per method, variant and concurrency')
+    parser.add_argument('--output', help='also append the results to this JSON lines file')
+    run(parser.parse_args())
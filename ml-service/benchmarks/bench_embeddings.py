@@ -0,0 +1,126 @@
+"""Memory, latency and ranking agreement of the product vectors used for similarity.
+
+Prepares a synthetic dataset (see datasets.prepare) and compares, on its
+trained artifacts, the ways of scoring one product against the catalog:
+
+- tfidf_sparse: cosine of the sparse float64 TF-IDF product vectors
+- tfidf_dense: unit-length float32 TF-IDF vectors (EMBEDDING_DIM=0)
+- tfidf_large: cosine of the larger TF-IDF the SVD is fitted on
+- svd_float32: the SVD embeddings train.py saves
+- svd_int8: the same quantized to int8 (EMBEDDING_PRECISION=int8)
+
+For each variant: bytes held, p50/p99 latency of scoring and taking the
+top --limit for one product, and overlap@limit with the rankings of
+tfidf_sparse (the vectors scored before the embeddings, products with an
+empty vector left out), tfidf_large (what the SVD approximates) and
+svd_float32. Prints one JSON object per variant.
+
+    python benchmarks/bench_embeddings.py --products 10000 100000 1000000
+"""
+import argparse
+import contextlib
+import sys
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics.pairwise import cosine_similarity
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import datasets
+from bench_models import run_info
+from models.ann_index import normalize_rows
+from models.embeddings import Embedder, QuantizedEmbeddings, embedding_scores, load_embeddings
+from utils import artifacts
+from utils.ranking import top_k_rows
+
+
+def csr_bytes(matrix):
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+def variants(dataset_dir, version_dir):
+    """name -> (bytes, function of a row returning scores over the catalog)"""
+    manifest = artifacts.read_manifest(version_dir)
+    product_vectors = artifacts.load_csr(version_dir, 'product_vectors', manifest['shapes']['product_vectors'])
+    tfidf_dense = normalize_rows(product_vectors)
+    svd_float32 = np.ascontiguousarray(load_embeddings(version_dir, 'float32'))
+    svd_int8 = load_embeddings(version_dir, 'int8')
+    if not isinstance(svd_int8, QuantizedEmbeddings):
+        svd_int8 = QuantizedEmbeddings.from_floats(svd_float32)
+    scorers = {
+        'tfidf_sparse': (csr_bytes(product_vectors),
+                         lambda row: cosine_similarity(product_vectors[row], product_vectors).ravel()),
+        'tfidf_dense': (tfidf_dense.nbytes, lambda row: embedding_scores(tfidf_dense, tfidf_dense[row])),
+    }
+    embedder = Embedder.load(version_dir, manifest)
+    if embedder is not None:
+        products = pd.read_parquet(os.path.join(dataset_dir, 'products.parquet'), columns=['name', 'description'])
+        large = embedder.vectorizer.transform(products['name'].fillna('') + ' ' + products['description'].fillna(''))
+        scorers['tfidf_large'] = (csr_bytes(large), lambda row: cosine_similarity(large[row], large).ravel())
+    scorers.update({
+        'svd_float32': (svd_float32.nbytes, lambda row: embedding_scores(svd_float32, svd_float32[row])),
+        'svd_int8': (svd_int8.nbytes, lambda row: embedding_scores(svd_int8, svd_int8[row])),
+    })
+    return scorers, product_vectors
+
+
+def top_rows(score, row, limit):
+    return top_k_rows(np.array(score(row), dtype=np.float64), limit, exclude_rows=[row])
+
+
+def overlap(tops, reference, rows):
+    return round(float(np.mean([len(np.intersect1d(tops[row], reference[row])) / max(len(reference[row]), 1)
+                                for row in rows])), 4) if len(rows) else None
+
+
+def run(args):
+    info = run_info()
+    for n_products in args.products:
+        with contextlib.redirect_stdout(sys.stderr):
+            dataset_dir, dataset = datasets.prepare(n_products, args.order_items, seed=args.seed)
+        version_dir = artifacts.current_version_dir(os.path.join(dataset_dir, 'models'))
+        scorers, product_vectors = variants(dataset_dir, version_dir)
+        if 'tfidf_large' not in scorers:
+            print("The dataset's models were trained with EMBEDDING_DIM=0, svd_* are TF-IDF", file=sys.stderr)
+        rng = np.random.default_rng(args.seed)
+        rows = rng.choice(product_vectors.shape[0], min(args.inputs, product_vectors.shape[0]), replace=False)
+        # Empty TF-IDF rows score 0 against everything: no ranking to agree with
+        ranked_rows = rows[np.diff(product_vectors.indptr)[rows] > 0]
+
+        tops = {}
+        for name, (_, score) in scorers.items():
+            top_rows(score, rows[0], args.limit)  # warm up
+            timings = []
+            tops[name] = {}
+            for row in rows:
+                start = time.perf_counter()
+                tops[name][row] = top_rows(score, row, args.limit)
+                timings.append((time.perf_counter() - start) * 1000)
+            tops[name]['timings'] = timings
+
+        for name, (nbytes, _) in scorers.items():
+            timings = tops[name].pop('timings')
+            datasets.emit(dict({
+                'benchmark': 'embeddings', 'variant': name, 'dataset': dataset['name'],
+                'catalog_size': n_products, 'limit': args.limit, 'inputs': len(rows),
+                'bytes': int(nbytes), 'bytes_per_product': round(nbytes / product_vectors.shape[0], 1),
+                'p50_ms': round(float(np.percentile(timings, 50)), 3),
+                'p99_ms': round(float(np.percentile(timings, 99)), 3),
+                'overlap_tfidf_sparse': overlap(tops[name], tops['tfidf_sparse'], ranked_rows),
+                'overlap_tfidf_large': overlap(tops[name], tops['tfidf_large'], rows) if 'tfidf_large' in tops else None,
+                'overlap_svd_float32': overlap(tops[name], tops['svd_float32'], rows),
+                'empty_tfidf_share': round(1 - len(ranked_rows) / len(rows), 4),
+            }, **info), args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--order-items', type=int, default=1_000_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--inputs', type=int, default=300, help='products scored per variant')
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--output', help='also append the results to this JSON lines file')
+    run(parser.parse_args())
@@ -0,0 +1,168 @@
+"""Latency of every model method on a synthetic dataset.
+
+Generates (or reuses, see datasets.prepare) a dataset at the given scale,
+loads it into SQLite or a dedicated Postgres database, trains the model
+artifacts from it and serves the methods the way the service does: one
+CatalogStore and UserProfileStore shared by all model classes. Each method
+is called with inputs drawn from the dataset; cached methods are measured
+with their cache cleared before every call and again warm. Prints one JSON
+object per measurement, ready to diff between runs.
+
+    python benchmarks/bench_models.py --products 10000 100000 1000000 --order-items 1000000
+    python benchmarks/bench_models.py --db postgres   # BENCH_DB_NAME, default grocery_bench
+"""
+import argparse
+import contextlib
+import platform
+import subprocess
+import sys
+import os
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import datasets
+from models.catalog import CatalogStore
+from models.user_profiles import UserProfileStore
+from models.shop_stats import ShopStatsStore
+from models.recommendation import HomePageRecommendations
+from models.similarity import ProductSimilarity
+from models.cart_suggestions import CartSuggestions
+from models.shop_ranking import ShopRanking
+from models.search_ranking import SearchRanking
+from utils import cache
+
+# Methods that always query the database; --db-runs lowers their run count
+DB_METHODS = {'get_popular_products'}
+
+
+def run_info():
+    """Where and on what code a run happened"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'machine': platform.machine(),
+            'cpus': os.cpu_count()}
+
+
+def measure(func, inputs, runs, before=None):
+    """Latency percentiles of func over runs calls cycling through inputs"""
+    func(inputs[0])  # warm up
+    timings = []
+    for i in range(runs):
+        if before is not None:
+            before()
+        value = inputs[i % len(inputs)]
+        start = time.perf_counter()
+        func(value)
+        timings.append(time.perf_counter() - start)
+    timings = np.array(timings) * 1000
+    return {
+        'runs': runs,
+        'mean_ms': round(float(timings.mean()), 3),
+        'p50_ms': round(float(np.percentile(timings, 50)), 3),
+        'p95_ms': round(float(np.percentile(timings, 95)), 3),
+        'p99_ms': round(float(np.percentile(timings, 99)), 3),
+        'ops_per_s': round(float(1000 / timings.mean()), 1),
+    }
+
+
+def connect(dataset_dir, db, pg_database):
+    """Model classes over the dataset's artifacts and database"""
+    store = CatalogStore(os.path.join(dataset_dir, 'models'))
+    store.load()
+    shops = ShopStatsStore(store)
+    profiles = UserProfileStore(store, shops)
+    profiles.load()
+    if db == 'sqlite':
+        datasets.use_sqlite(os.path.join(dataset_dir, 'bench.db'))
+    else:
+        os.environ['DB_NAME'] = pg_database
+    shops.load()
+    return {
+        'home': HomePageRecommendations(store, profiles),
+        'similarity': ProductSimilarity(store),
+        'cart': CartSuggestions(store),
+        'shops': ShopRanking(store, profiles, shops),
+        'search': SearchRanking(store, profiles),
+    }
+
+
+def cases(models, inputs):
+    """(method, variant, function of one input, input list, before-call hook)"""
+    home, similarity, cart = models['home'], models['similarity'], models['cart']
+    shops, search = models['shops'], models['search']
+    cold = lambda: cache.invalidate('popular_products', 'shop_ranking', 'search')
+    users = inputs['user_ids']
+    return [
+        ('search_products', 'anonymous_cold', lambda q: search.search_products(q, 20), inputs['queries'], cold),
+        ('search_products', 'anonymous_cached', lambda q: search.search_products(q, 20), inputs['queries'], None),
+        ('search_products', 'personalized',
+         lambda i: search.search_products(inputs['queries'][i], 20, users[i]), range(len(users)), None),
+        ('suggest_terms', None, lambda p: search.suggest_terms(p, 10), inputs['prefixes'], None),
+        ('get_similar_products', None, lambda p: similarity.get_similar_products(p, 5), inputs['product_ids'], None),
+        ('get_customers_also_bought', None,
+         lambda p: similarity.get_customers_also_bought(p, 5), inputs['product_ids'], None),
+        ('recommend_for_user', 'cart_query', lambda u: home.recommend_for_user(u, 8), users, None),
+        ('recommend_for_user', 'cart_given',
+         lambda i: home.recommend_for_user(users[i], 8, inputs['carts'][i]), range(len(users)), None),
+        ('get_popular_products', 'cold', lambda _: home.get_popular_products(8), [None], cold),
+        ('get_popular_products', 'cached', lambda _: home.get_popular_products(8), [None], None),
+        ('get_complementary_items', None, lambda c: cart.get_complementary_items(c, 5), inputs['carts'], None),
+        ('get_best_deals', None, lambda c: cart.get_best_deals(c, 3), inputs['carts'], None),
+        ('get_all_shops_ranked', 'personalized', lambda u: shops.get_all_shops_ranked(u), users, None),
+        ('get_all_shops_ranked', 'anonymous_cold', lambda _: shops.get_all_shops_ranked(None), [None], cold),
+        ('get_all_shops_ranked', 'anonymous_cached', lambda _: shops.get_all_shops_ranked(None), [None], None),
+    ]
+
+
+def run(args):
+    results = []
+    info = run_info()
+    for n_products in args.products:
+        # Progress of generating, training and loading goes to stderr, results to stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            dataset_dir, dataset = datasets.prepare(
+                n_products, args.order_items, args.users, args.shops, args.seed, args.db, args.pg_database
+            )
+            models = connect(dataset_dir, args.db, args.pg_database)
+        inputs = datasets.sample_inputs(dataset_dir, args.inputs, args.seed)
+        # Row counts and build times (generation, database load, training) of the dataset
+        datasets.emit(dict({'benchmark': 'dataset', 'dataset': dataset['name'], 'catalog_size': n_products},
+                           rows=dataset['rows'], timings=dataset['timings'], **info), args.output)
+        for method, variant, func, method_inputs, before in cases(models, inputs):
+            if args.methods and method not in args.methods:
+                continue
+            runs = args.db_runs if args.db_runs and method in DB_METHODS else args.runs
+            result = {
+                'benchmark': 'models', 'method': method, 'variant': variant,
+                'dataset': dataset['name'], 'catalog_size': n_products,
+                'order_items': dataset['rows']['order_items'], 'db': args.db,
+            }
+            result.update(measure(func, list(method_inputs), runs, before))
+            result.update(info)
+            datasets.emit(result, args.output)
+            results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--order-items', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=None, help='default: order items / 20')
+    parser.add_argument('--shops', type=int, default=None, help='default: products / 1000, at least 20')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', choices=['sqlite', 'postgres'], default='sqlite')
+    parser.add_argument('--pg-database', default=datasets.PG_DATABASE)
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--db-runs', type=int, default=None, help='runs of the SQL-only methods')
+    parser.add_argument('--inputs', type=int, default=500, help='distinct inputs drawn from the dataset')
+    parser.add_argument('--methods', nargs='+', help='only these methods')
+    parser.add_argument('--output', help='also append the results to this JSON lines file')
+    run(parser.parse_args())
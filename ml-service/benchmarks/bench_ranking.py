@@ -0,0 +1,181 @@
+"""Per-request latency and allocations of the ranking paths.
+
+Compares the NumPy ranking path of search, similar products and home
+recommendations against the previous DataFrame copy + nlargest path on
+synthetic catalogs. Prints one JSON object per measurement.
+
+    python benchmarks/bench_ranking.py --sizes 10000 100000 1000000
+"""
+import argparse
+import json
+import sys
+import os
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.catalog import CatalogStore, ProductCatalog
+from models.recommendation import HomePageRecommendations
+from models.user_profiles import UserProfile
+from models.similarity import ProductSimilarity
+from models.search_ranking import SearchRanking
+
+VOCABULARY = [f"term{i}" for i in range(100)]
+RESULT_COLUMNS = ['id', 'name', 'price', 'shop_name', 'image_url']
+
+
+def make_catalog(n_products, seed=0):
+    """Synthetic catalog of n_products with a 100-term TF-IDF space"""
+    rng = np.random.default_rng(seed)
+    words = np.array(VOCABULARY)[rng.integers(0, len(VOCABULARY), size=(n_products, 6))]
+    names = [' '.join(row[:3]) for row in words]
+    content = [' '.join(row) for row in words]
+    products_df = pd.DataFrame({
+        'id': np.arange(1, n_products + 1),
+        'name': names,
+        'description': [' '.join(row[3:]) for row in words],
+        'price': rng.uniform(10, 5000, n_products).round(2),
+        'shop_id': rng.integers(1, 50, n_products),
+        'shop_name': [f"Shop {i}" for i in rng.integers(1, 50, n_products)],
+        'image_url': [f"https://img.example/{i}.jpg" for i in range(n_products)],
+        'content': content,
+    })
+    vectorizer = TfidfVectorizer(max_features=100)
+    product_vectors = vectorizer.fit_transform(products_df['content'])
+    return ProductCatalog.from_dataframe(products_df, product_vectors, vectorizer)
+
+
+class FixedProfiles:
+    """Profile store answering every user with the same purchases"""
+
+    def __init__(self, purchased_ids):
+        self.profile = UserProfile.empty()
+        self.profile.purchased_ids = np.asarray(purchased_ids, dtype=np.int64)
+
+    def get(self, user_id):
+        return self.profile
+
+
+class FixedHistoryRecommendations(HomePageRecommendations):
+    """Home recommendations with a canned history instead of Postgres"""
+
+    def __init__(self, store, purchased_ids, cart_ids):
+        super().__init__(store, FixedProfiles(purchased_ids))
+        self.cart = pd.DataFrame({'product_id': cart_ids})
+
+    def get_user_cart_items(self, user_id):
+        return self.cart
+
+
+# Previous implementations, kept here as the baseline
+
+def legacy_search(catalog, query_text, limit):
+    query_vector = catalog.vectorizer.transform([query_text])
+    similarities = cosine_similarity(query_vector, catalog.product_vectors).flatten()
+    results = catalog.products_df.copy()
+    results['relevance_score'] = similarities
+    results['name_match'] = results['name'].str.contains(query_text, case=False, na=False)
+    results['relevance_score'] = np.where(
+        results['name_match'], results['relevance_score'] + 0.3, results['relevance_score']
+    )
+    results = results.nlargest(limit, 'relevance_score')
+    results = results[results['relevance_score'] > 0]
+    return results[RESULT_COLUMNS + ['relevance_score']].to_dict('records')
+
+
+def legacy_similar(catalog, product_id, limit):
+    product_idx = catalog.row_of(product_id)
+    similarities = cosine_similarity(
+        catalog.product_vectors[product_idx:product_idx+1], catalog.product_vectors
+    ).flatten()
+    similar = catalog.products_df.copy()
+    similar['similarity_score'] = similarities
+    similar = similar[similar['id'] != product_id]
+    similar = similar.nlargest(limit, 'similarity_score')
+    return similar[RESULT_COLUMNS + ['similarity_score']].to_dict('records')
+
+
+def legacy_recommend(catalog, purchased_ids, cart_ids, limit):
+    purchased_indices = catalog.rows_of(purchased_ids)
+    user_vector = np.asarray(catalog.product_vectors[purchased_indices].mean(axis=0))
+    similarities = cosine_similarity(user_vector, catalog.product_vectors).flatten()
+    recommendations = catalog.products_df.copy()
+    recommendations['similarity_score'] = similarities
+    recommendations = recommendations[
+        ~recommendations['id'].isin(set(purchased_ids) | set(cart_ids))
+    ]
+    recommendations = recommendations.nlargest(limit, 'similarity_score')
+    return recommendations[RESULT_COLUMNS + ['similarity_score']].to_dict('records')
+
+
+def measure(func, runs):
+    """p50/p99 latency in ms over runs calls and peak allocation of one call in KiB"""
+    func()  # warm caches
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'p50_ms': round(float(np.percentile(timings, 50)), 3),
+        'p99_ms': round(float(np.percentile(timings, 99)), 3),
+        'peak_alloc_kib': round(peak / 1024, 1),
+    }
+
+
+def run(sizes, runs, limit):
+    results = []
+    for n_products in sizes:
+        catalog = make_catalog(n_products)
+        store = CatalogStore()
+        store.publish(catalog)
+
+        search = SearchRanking(store)
+        similarity = ProductSimilarity(store)
+        purchased_ids = [1, 2, 3, 4, 5]
+        cart_ids = [6, 7]
+        recommender = FixedHistoryRecommendations(store, purchased_ids, cart_ids)
+        product_id = n_products // 2
+        query = 'term7 term42'
+
+        cases = {
+            'search_products': (
+                lambda: legacy_search(catalog, query, limit),
+                lambda: search.search_products(query, limit),
+            ),
+            'get_similar_products': (
+                lambda: legacy_similar(catalog, product_id, limit),
+                lambda: similarity.get_similar_products(product_id, limit),
+            ),
+            'recommend_for_user': (
+                lambda: legacy_recommend(catalog, purchased_ids, cart_ids, limit),
+                lambda: recommender.recommend_for_user(1, limit),
+            ),
+        }
+        for method, (legacy, current) in cases.items():
+            for path, func in (('dataframe_copy', legacy), ('numpy_topk', current)):
+                result = {'catalog_size': n_products, 'method': method, 'path': path}
+                result.update(measure(func, runs))
+                print(json.dumps(result), flush=True)
+                results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+    run(args.sizes, args.runs, args.limit)
@@ -0,0 +1,115 @@
+"""Cost of turning model results into response bodies.
+
+Prepares a synthetic dataset (see datasets.prepare) and serializes the
+results of search (--search-limit products), similar products and a
+batch of similar-products sub-requests in three ways:
+
+- dicts_flask: a dict per product encoded by Flask's JSON provider, as
+  the service did before utils/serialization.py
+- fragments_json: the catalog's pre-encoded records spliced with the
+  scores, everything else by the json module
+- fragments_orjson: the same with orjson (skipped when not installed)
+
+Results are computed once; only building the records and encoding them
+is timed. Prints one JSON object per (variant, endpoint).
+
+    python benchmarks/bench_serialization.py --products 10000 100000
+"""
+import argparse
+import contextlib
+import sys
+import os
+import time
+
+import numpy as np
+from flask import Flask
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import datasets
+from bench_models import run_info
+from models.catalog import CatalogStore
+from models.search_ranking import SearchRanking
+from models.similarity import ProductSimilarity
+from utils import serialization
+
+
+def as_dicts(result):
+    """The response as the service built it before: plain dicts"""
+    if isinstance(result, dict):
+        return {key: as_dicts(value) for key, value in result.items()}
+    if isinstance(result, list):
+        return [as_dicts(value) for value in result]
+    if isinstance(result, serialization.PreEncoded):
+        return [dict(record) for record in result]
+    return result
+
+
+def variants():
+    flask_json = Flask(__name__).json
+    found = {'dicts_flask': lambda result: flask_json.dumps(as_dicts(result)).encode('utf-8')}
+
+    def fragments(dumps):
+        def encode(result):
+            serialization._dumps = dumps
+            return serialization.dumps(result)
+        return encode
+
+    found['fragments_json'] = fragments(serialization.json_dumps)
+    if serialization.orjson is not None:
+        found['fragments_orjson'] = fragments(serialization.orjson_dumps)
+    return found
+
+
+def run(args):
+    info = run_info()
+    for n_products in args.products:
+        with contextlib.redirect_stdout(sys.stderr):
+            dataset_dir, dataset = datasets.prepare(n_products, args.order_items, seed=args.seed)
+            store = CatalogStore(os.path.join(dataset_dir, 'models'))
+            catalog = store.load()
+        search = SearchRanking(store)
+        similarity = ProductSimilarity(store)
+
+        rng = np.random.default_rng(args.seed)
+        rows = rng.choice(len(catalog), min(args.inputs, len(catalog)), replace=False)
+        ids = [int(catalog.ids[row]) for row in rows]
+        queries = [catalog.columns['name'][row].split()[0] for row in rows]
+        with contextlib.redirect_stdout(sys.stderr):
+            responses = {
+                'search': [search.search_products(query, args.search_limit) for query in queries],
+                'similar': [similarity.get_similar_products(product_id, 5) for product_id in ids],
+                'batch': [
+                    {'results': [{'status': 200, 'data': similarity.get_similar_products(product_id, 5)}
+                                 for product_id in ids[i:i + args.batch_size]]}
+                    for i in range(0, len(ids), args.batch_size)
+                ],
+            }
+
+        for name, encode in variants().items():
+            for endpoint, results in responses.items():
+                encode(results[0])  # warm up
+                timings, sizes = [], []
+                for result in results:
+                    start = time.perf_counter()
+                    body = encode(result)
+                    timings.append((time.perf_counter() - start) * 1000)
+                    sizes.append(len(body))
+                datasets.emit(dict({
+                    'benchmark': 'serialization', 'variant': name, 'endpoint': endpoint,
+                    'dataset': dataset['name'], 'catalog_size': n_products, 'responses': len(results),
+                    'mean_bytes': round(float(np.mean(sizes)), 1),
+                    'p50_us': round(float(np.percentile(timings, 50)) * 1000, 1),
+                    'p99_us': round(float(np.percentile(timings, 99)) * 1000, 1),
+                }, **info), args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--order-items', type=int, default=1_000_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--inputs', type=int, default=500, help='products and queries per endpoint')
+    parser.add_argument('--search-limit', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=10, help='similar-products sub-requests per batch')
+    parser.add_argument('--output', help='also append the results to this JSON lines file')
+    run(parser.parse_args())
@@ -0,0 +1,64 @@
+"""Compare two benchmark runs saved as JSON lines.
+
+Matches measurements by what they measured (benchmark, method or endpoint,
+variant, dataset, ...) and prints the change of a latency field for each,
+slowest regressions first.
+
+    python benchmarks/bench_models.py --output before.jsonl
+    ... change the code ...
+    python benchmarks/bench_models.py --output after.jsonl
+    python benchmarks/compare.py before.jsonl after.jsonl --field p50_ms
+"""
+import argparse
+import json
+
+# Fields that identify a measurement rather than report one
+KEY_FIELDS = ('benchmark', 'method', 'variant', 'endpoint', 'path', 'dataset', 'catalog_size',
+              'db', 'concurrency', 'nprobe')
+
+
+def read(path):
+    """Last result per measurement key in a JSON lines file"""
+    results = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                results[tuple(result.get(field) for field in KEY_FIELDS)] = result
+    return results
+
+
+def describe(key):
+    return ' '.join(f"{field}={value}" for field, value in zip(KEY_FIELDS, key) if value is not None)
+
+
+def compare(before_path, after_path, field, threshold):
+    before, after = read(before_path), read(after_path)
+    rows = []
+    for key in before.keys() & after.keys():
+        old, new = before[key].get(field), after[key].get(field)
+        if old is None or new is None or old == 0:
+            continue
+        rows.append((new / old, key, old, new))
+    rows.sort(reverse=True)
+    for ratio, key, old, new in rows:
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  SLOWER'
+        elif ratio < 1 - threshold:
+            flag = '  faster'
+        print(f"{old:>10.3f} -> {new:>10.3f} {field}  x{ratio:5.2f}{flag}  {describe(key)}")
+    for key in sorted(before.keys() - after.keys(), key=str):
+        print(f"only in {before_path}: {describe(key)}")
+    for key in sorted(after.keys() - before.keys(), key=str):
+        print(f"only in {after_path}: {describe(key)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--field', default='p50_ms')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change flagged')
+    args = parser.parse_args()
+    compare(args.before, args.after, args.field, args.threshold)
@@ -0,0 +1,438 @@
+"""Synthetic shops, products, users, orders and carts for the benchmarks.
+
+generate() builds the tables at any scale from a seed. Products draw their
+names and descriptions from one of many topics, and every name is sold by
+several shops at different prices, so search, similarity and best deals
+have realistic work to do. Users mostly buy from a favourite topic.
+
+The tables are loaded into a SQLite file (the default stand-in, see
+use_sqlite) or a dedicated Postgres database, and written in the layout of
+export_data.py so train.py can build the model artifacts from them.
+prepare() does all of this once per scale and seed and reuses it afterwards.
+"""
+import json
+import sqlite3
+import threading
+import sys
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import metrics
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'bench')
+# Postgres database the tables are loaded into with db='postgres'
+PG_DATABASE = os.getenv('BENCH_DB_NAME', 'grocery_bench')
+
+N_WORDS = 2000
+N_TOPICS = 500
+WORDS_PER_TOPIC = 12
+# Shops selling each product name
+SHOPS_PER_NAME = 4
+# Share of order items from the buyer's favourite topic
+TOPIC_AFFINITY = 0.7
+PAID_SHARE = 0.9
+
+# Column subset of models/schema_final.sql read by the ML service; the same
+# DDL runs on SQLite and Postgres
+SCHEMA = {
+    'shops': """
+        id INTEGER PRIMARY KEY, name TEXT NOT NULL, address TEXT NOT NULL,
+        contact TEXT, logo TEXT
+    """,
+    'users': "id INTEGER PRIMARY KEY, name TEXT NOT NULL, email TEXT NOT NULL",
+    'products': """
+        id INTEGER PRIMARY KEY, name TEXT NOT NULL, description TEXT,
+        price NUMERIC(10, 2) NOT NULL, shop_id INTEGER NOT NULL, image_url TEXT,
+        created_at TIMESTAMP, updated_at TIMESTAMP
+    """,
+    'orders': """
+        id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, total_amount NUMERIC(10, 2) NOT NULL,
+        payment_status TEXT, created_at TIMESTAMP
+    """,
+    'order_items': """
+        id INTEGER PRIMARY KEY, order_id INTEGER NOT NULL, product_id INTEGER,
+        shop_id INTEGER, quantity INTEGER NOT NULL, price NUMERIC(10, 2) NOT NULL
+    """,
+    'cart_items': """
+        id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, product_id INTEGER NOT NULL,
+        shop_id INTEGER NOT NULL, quantity INTEGER NOT NULL
+    """,
+}
+INDEXES = {
+    'idx_products_shop_id': 'products(shop_id)',
+    'idx_products_name': 'products(name)',
+    'idx_cart_items_user_id': 'cart_items(user_id)',
+    'idx_orders_user_id': 'orders(user_id)',
+    'idx_order_items_order_id': 'order_items(order_id)',
+    'idx_order_items_product_id': 'order_items(product_id)',
+}
+
+
+def _vocabulary(rng):
+    """N_WORDS distinct pronounceable words of three syllables"""
+    syllables = np.array([c + v for c in 'bdfgklmnprstvz' for v in 'aeiou'])
+    codes = rng.choice(len(syllables) ** 3, N_WORDS, replace=False)
+    parts = np.stack([codes // len(syllables) ** 2, codes // len(syllables) % len(syllables),
+                      codes % len(syllables)], axis=1)
+    return np.char.add(np.char.add(syllables[parts[:, 0]], syllables[parts[:, 1]]), syllables[parts[:, 2]])
+
+
+def _join_words(vocabulary, codes):
+    """One space-joined string per row of word codes"""
+    words = vocabulary[codes]
+    joined = words[:, 0]
+    for column in range(1, words.shape[1]):
+        joined = np.char.add(np.char.add(joined, ' '), words[:, column])
+    return joined.astype(object)
+
+
+def generate(n_products, n_order_items, n_users=None, n_shops=None, seed=0):
+    """Dict of table name -> DataFrame with ids starting at 1"""
+    rng = np.random.default_rng(seed)
+    n_users = n_users or max(n_order_items // 20, 1)
+    n_shops = n_shops or max(n_products // 1000, 20)
+    now = pd.Timestamp('2024-01-01')
+    vocabulary = _vocabulary(rng)
+    topic_words = rng.integers(0, N_WORDS, size=(N_TOPICS, WORDS_PER_TOPIC))
+
+    shops = pd.DataFrame({
+        'id': np.arange(1, n_shops + 1),
+        'name': [f"Shop {i}" for i in range(1, n_shops + 1)],
+        'address': [f"{i} Market Street" for i in range(1, n_shops + 1)],
+        'contact': [f"+91 90000 {i:05d}" for i in range(1, n_shops + 1)],
+        'logo': [f"https://img.example/shops/{i}.png" for i in range(1, n_shops + 1)],
+    })
+    users = pd.DataFrame({
+        'id': np.arange(1, n_users + 1),
+        'name': [f"User {i}" for i in range(1, n_users + 1)],
+        'email': [f"user{i}@example.com" for i in range(1, n_users + 1)],
+    })
+
+    # Product names, each sold by SHOPS_PER_NAME shops at different prices
+    n_names = max(n_products // SHOPS_PER_NAME, 1)
+    name_topics = rng.integers(0, N_TOPICS, n_names)
+    name_codes = topic_words[name_topics[:, None], rng.integers(0, WORDS_PER_TOPIC, size=(n_names, 3))]
+    names = _join_words(vocabulary, name_codes)
+    product_names = rng.integers(0, n_names, n_products)
+    topics = name_topics[product_names]
+    own = topic_words[topics[:, None], rng.integers(0, WORDS_PER_TOPIC, size=(n_products, 6))]
+    noise = rng.integers(0, N_WORDS, size=(n_products, 2))
+    base_price = rng.uniform(10, 5000, n_names)
+    products = pd.DataFrame({
+        'id': np.arange(1, n_products + 1),
+        'name': names[product_names],
+        'description': _join_words(vocabulary, np.concatenate([own, noise], axis=1)),
+        'price': (base_price[product_names] * rng.uniform(0.8, 1.2, n_products)).round(2),
+        'shop_id': rng.integers(1, n_shops + 1, n_products),
+        'image_url': [f"https://img.example/products/{i}.jpg" for i in range(1, n_products + 1)],
+        'created_at': now - pd.to_timedelta(rng.integers(0, 365 * 86400, n_products), unit='s'),
+    })
+    products['updated_at'] = products['created_at']
+
+    # Orders of 1-6 items (about 3), cut to n_order_items in total
+    sizes = np.minimum(rng.poisson(2, max(n_order_items // 2, 1)) + 1, 6)
+    sizes = sizes[:np.searchsorted(np.cumsum(sizes), n_order_items) + 1]
+    sizes[-1] -= sizes.sum() - n_order_items
+    n_orders = len(sizes)
+    # Some users order far more often than others
+    activity = rng.pareto(1.5, n_users) + 1
+    order_users = rng.choice(n_users, n_orders, p=activity / activity.sum()) + 1
+    favourite_topics = rng.integers(0, N_TOPICS, n_users + 1)
+
+    # Items: mostly from the buyer's favourite topic, popular products more often
+    item_orders = np.repeat(np.arange(n_orders), sizes)
+    item_topics = np.where(
+        rng.random(n_order_items) < TOPIC_AFFINITY,
+        favourite_topics[order_users[item_orders]],
+        rng.integers(0, N_TOPICS, n_order_items),
+    )
+    by_topic = np.argsort(topics, kind='stable')
+    topic_start = np.searchsorted(topics[by_topic], np.arange(N_TOPICS))
+    topic_count = np.bincount(topics, minlength=N_TOPICS)
+    # Topics no product has fall back to a random product
+    empty = topic_count[item_topics] == 0
+    offsets = np.floor(rng.power(3, n_order_items) * np.maximum(topic_count[item_topics], 1)).astype(np.int64)
+    offsets = np.minimum(offsets, np.maximum(topic_count[item_topics] - 1, 0))
+    item_rows = by_topic[np.minimum(topic_start[item_topics] + offsets, n_products - 1)]
+    item_rows[empty] = rng.integers(0, n_products, int(empty.sum()))
+    quantities = rng.integers(1, 4, n_order_items)
+    item_prices = products['price'].to_numpy()[item_rows]
+    order_items = pd.DataFrame({
+        'id': np.arange(1, n_order_items + 1),
+        'order_id': item_orders + 1,
+        'product_id': item_rows + 1,
+        'shop_id': products['shop_id'].to_numpy()[item_rows],
+        'quantity': quantities,
+        'price': item_prices,
+    })
+    orders = pd.DataFrame({
+        'id': np.arange(1, n_orders + 1),
+        'user_id': order_users,
+        'total_amount': np.bincount(item_orders, weights=item_prices * quantities, minlength=n_orders).round(2),
+        'payment_status': np.where(rng.random(n_orders) < PAID_SHARE, 'paid', 'pending'),
+        'created_at': now - pd.to_timedelta(rng.integers(0, 365 * 86400, n_orders), unit='s'),
+    })
+
+    # Carts of 0-4 items for every user
+    cart_sizes = rng.integers(0, 5, n_users)
+    cart_rows = rng.integers(0, n_products, int(cart_sizes.sum()))
+    cart_items = pd.DataFrame({
+        'id': np.arange(1, len(cart_rows) + 1),
+        'user_id': np.repeat(np.arange(1, n_users + 1), cart_sizes),
+        'product_id': cart_rows + 1,
+        'shop_id': products['shop_id'].to_numpy()[cart_rows],
+        'quantity': rng.integers(1, 4, len(cart_rows)),
+    })
+
+    return {
+        'shops': shops, 'users': users, 'products': products,
+        'orders': orders, 'order_items': order_items, 'cart_items': cart_items,
+    }
+
+
+def _create_schema(cursor):
+    for table, columns in SCHEMA.items():
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        cursor.execute(f"CREATE TABLE {table} ({columns})")
+
+
+def _create_indexes(cursor):
+    for name, target in INDEXES.items():
+        cursor.execute(f"CREATE INDEX {name} ON {target}")
+
+
+def load_sqlite(tables, path):
+    """Write the tables into a fresh SQLite database at path"""
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    try:
+        _create_schema(conn)
+        for table, df in tables.items():
+            df = df.copy()
+            for column in df.select_dtypes('datetime').columns:
+                df[column] = df[column].dt.strftime('%Y-%m-%d %H:%M:%S')
+            placeholders = ','.join('?' * len(df.columns))
+            conn.executemany(
+                f"INSERT INTO {table} ({','.join(df.columns)}) VALUES ({placeholders})",
+                df.itertuples(index=False, name=None)
+            )
+        _create_indexes(conn)
+        conn.execute('ANALYZE')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _postgres_params(db_name):
+    from utils.database import _connection_params
+
+    params = _connection_params()
+    if db_name == params['database']:
+        raise ValueError(f"Refusing to overwrite the application database {db_name}")
+    return dict(params, database=db_name)
+
+
+def _postgres_dataset(db_name):
+    """Name of the dataset last loaded into db_name, or None"""
+    import psycopg2
+
+    try:
+        conn = psycopg2.connect(**_postgres_params(db_name))
+    except psycopg2.OperationalError:
+        return None
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT obj_description('products'::regclass, 'pg_class')")
+            return cursor.fetchone()[0]
+    except psycopg2.Error:
+        return None
+    finally:
+        conn.close()
+
+
+def load_postgres(tables, db_name, dataset_name):
+    """Replace the benchmark tables in the Postgres database db_name.
+
+    The connection settings are the service's (DB_HOST, DB_USER, ...), so
+    db_name must not be the application database.
+    """
+    import io
+    import psycopg2
+
+    params = _postgres_params(db_name)
+    admin = psycopg2.connect(**dict(params, database='postgres'))
+    admin.autocommit = True
+    with admin.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_database WHERE datname = %s', [db_name])
+        if cursor.fetchone() is None:
+            cursor.execute(f'CREATE DATABASE "{db_name}"')
+    admin.close()
+
+    conn = psycopg2.connect(**params)
+    try:
+        with conn.cursor() as cursor:
+            _create_schema(cursor)
+            for table, df in tables.items():
+                buffer = io.StringIO()
+                df.to_csv(buffer, index=False, header=False)
+                buffer.seek(0)
+                cursor.copy_expert(f"COPY {table} ({','.join(df.columns)}) FROM STDIN WITH CSV", buffer)
+            _create_indexes(cursor)
+            # Records which dataset the database holds
+            cursor.execute(f"COMMENT ON TABLE products IS '{dataset_name}'")
+        conn.commit()
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute('ANALYZE')
+    finally:
+        conn.close()
+
+
+def use_sqlite(path):
+    """Answer the service's queries from the SQLite database at path.
+
+    Replaces fetch_data in every loaded module that imported it, so import
+    the model classes first. Postgres-only queries (catalog and profile
+    refresh) are not supported.
+    """
+    import utils.database
+
+    local = threading.local()
+
+    def fetch_sqlite(query, params=None):
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = sqlite3.connect(path)
+        with metrics.stage('db'):
+            return pd.read_sql(query.replace('%s', '?'), conn, params=params)
+
+    original = utils.database.fetch_data
+    for module in list(sys.modules.values()):
+        if getattr(module, 'fetch_data', None) is original:
+            module.fetch_data = fetch_sqlite
+
+
+def write_training_data(tables, data_dir):
+    """Write the tables as export_data.py would, for train.py"""
+    from export_data import PRODUCTS_SCHEMA, ORDERS_SCHEMA, SHOPS_SCHEMA, save_state
+
+    products = tables['products'].merge(
+        tables['shops'][['id', 'name']].rename(columns={'id': 'shop_id', 'name': 'shop_name'}), on='shop_id'
+    ).sort_values('id')
+    orders = tables['orders']
+    paid = orders[orders['payment_status'] == 'paid']
+    items = tables['order_items'].merge(
+        paid[['id', 'user_id', 'payment_status', 'total_amount']].rename(columns={'id': 'order_id'}),
+        on='order_id'
+    ).sort_values('order_id')
+
+    def write(df, schema, path):
+        pq.write_table(pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False), path)
+
+    orders_dir = os.path.join(data_dir, 'order_history')
+    os.makedirs(orders_dir, exist_ok=True)
+    write(products, PRODUCTS_SCHEMA, os.path.join(data_dir, 'products.parquet'))
+    write(items, ORDERS_SCHEMA, os.path.join(orders_dir, 'part-00000.parquet'))
+    write(tables['shops'], SHOPS_SCHEMA, os.path.join(data_dir, 'shops.parquet'))
+    last_order_id = int(orders['id'].max())
+    save_state(data_dir, {'order_history': {
+        'last_order_id': last_order_id,
+        'unpaid_order_ids': orders.loc[orders['payment_status'] != 'paid', 'id'].tolist(),
+        'parts': 1,
+    }})
+
+
+def prepare(n_products, n_order_items, n_users=None, n_shops=None, seed=0, db='sqlite',
+            pg_database=PG_DATABASE, bench_dir=BENCH_DIR):
+    """Directory holding the dataset, its trained models and SQLite database.
+
+    db is 'sqlite' (bench.db in the directory) or 'postgres' (pg_database).
+    Generated and trained on first use for a scale and seed, then reused
+    with its models brought up to date with train.py; Postgres is reloaded
+    whenever it last held another dataset.
+    Returns (dataset dir, info dict).
+    """
+    name = f"p{n_products}-i{n_order_items}-u{n_users or 0}-s{n_shops or 0}-seed{seed}"
+    dataset_dir = os.path.join(bench_dir, name)
+    info_path = os.path.join(dataset_dir, 'dataset.json')
+    target = 'sqlite' if db == 'sqlite' else f"postgres:{pg_database}"
+    info = None
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            info = json.load(f)
+        # Retrains only the stages whose code changed since, a no-op otherwise
+        import train
+        train.train_models(dataset_dir, os.path.join(dataset_dir, 'models'))
+        if target == 'sqlite' and target in info['databases']:
+            return dataset_dir, info
+        if target != 'sqlite' and _postgres_dataset(pg_database) == name:
+            return dataset_dir, info
+
+    os.makedirs(dataset_dir, exist_ok=True)
+    start = time.perf_counter()
+    tables = generate(n_products, n_order_items, n_users, n_shops, seed)
+    timings = {'generate_s': round(time.perf_counter() - start, 2)}
+
+    start = time.perf_counter()
+    if db == 'sqlite':
+        load_sqlite(tables, os.path.join(dataset_dir, 'bench.db'))
+    else:
+        load_postgres(tables, pg_database, name)
+    timings[f"load_{db}_s"] = round(time.perf_counter() - start, 2)
+
+    if info is None:
+        import train
+        start = time.perf_counter()
+        write_training_data(tables, dataset_dir)
+        train.train_models(dataset_dir, os.path.join(dataset_dir, 'models'))
+        timings['train_s'] = round(time.perf_counter() - start, 2)
+        info = {
+            'name': name,
+            'rows': {table: len(df) for table, df in tables.items()},
+            'databases': [],
+            'timings': {},
+        }
+    if target not in info['databases']:
+        info['databases'].append(target)
+    info['timings'].update(timings)
+    with open(info_path, 'w') as f:
+        json.dump(info, f, indent=2)
+    return dataset_dir, info
+
+
+def sample_inputs(dataset_dir, n, seed=0):
+    """Request inputs drawn from the dataset: product ids, buyers, carts and queries"""
+    rng = np.random.default_rng(seed)
+    products = pd.read_parquet(os.path.join(dataset_dir, 'products.parquet'), columns=['id', 'name'])
+    orders = pd.read_parquet(os.path.join(dataset_dir, 'order_history'), columns=['user_id'])
+    product_ids = products['id'].to_numpy()
+    names = products['name'].to_numpy()
+    buyers = orders['user_id'].unique()
+
+    picks = rng.integers(0, len(product_ids), size=(n, 3))
+    return {
+        'product_ids': product_ids[picks[:, 0]].tolist(),
+        'user_ids': rng.choice(buyers, n).tolist(),
+        'carts': product_ids[picks].tolist(),
+        # The first one or two words of a product name
+        'queries': [
+            ' '.join(name.split()[:k]) for name, k in zip(names[picks[:, 1]], rng.integers(1, 3, n))
+        ],
+        'prefixes': [name.split()[0][:rng.integers(2, 6)] for name in names[picks[:, 2]]],
+    }
+
+
+def emit(result, output=None):
+    """Print a result as one JSON line, appending it to output too if given"""
+    line = json.dumps(result)
+    print(line, flush=True)
+    if output:
+        with open(output, 'a') as f:
+            f.write(line + '\n')
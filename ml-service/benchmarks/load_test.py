@@ -0,0 +1,161 @@
+"""Closed-loop HTTP load test of the ML service endpoints.
+
+--concurrency clients each send requests back to back for --duration
+seconds, picking the endpoint at random by the weights of --mix. Request
+bodies use ids, carts and queries from the same synthetic dataset the
+server was started with (benchmarks/serve.py, or any service whose database
+holds it). Prints one JSON object per endpoint and one for all requests:
+throughput, errors and latency percentiles.
+
+    python benchmarks/serve.py --products 100000 &
+    python benchmarks/load_test.py --products 100000 --concurrency 16 --duration 30
+"""
+import argparse
+import contextlib
+import http.client
+import json
+import random
+import sys
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import datasets
+
+# name -> (path, body for input i); bodies follow what the web app sends
+ENDPOINTS = {
+    'search': ('/api/search', lambda inp, i: {'query': inp['queries'][i], 'limit': 20}),
+    'search_personalized': ('/api/search', lambda inp, i: {
+        'query': inp['queries'][i], 'limit': 20, 'user_id': inp['user_ids'][i]}),
+    'suggest': ('/api/search/suggest', lambda inp, i: {'prefix': inp['prefixes'][i], 'limit': 10}),
+    'similar': ('/api/product/similar', lambda inp, i: {'product_id': inp['product_ids'][i], 'limit': 5}),
+    'also_bought': ('/api/product/also-bought', lambda inp, i: {'product_id': inp['product_ids'][i], 'limit': 5}),
+    'recommend_home': ('/api/recommend/home', lambda inp, i: {
+        'user_id': inp['user_ids'][i], 'limit': 8, 'cart_product_ids': inp['carts'][i]}),
+    'recommend_anonymous': ('/api/recommend/home', lambda inp, i: {'limit': 8}),
+    'complementary': ('/api/cart/complementary', lambda inp, i: {'product_ids': inp['carts'][i], 'limit': 5}),
+    'best_deals': ('/api/cart/best-deals', lambda inp, i: {'product_ids': inp['carts'][i], 'limit': 3}),
+    'shops_ranked': ('/api/shops/ranked', lambda inp, i: {'user_id': inp['user_ids'][i]}),
+    # The product page: similar products and also-bought in one round trip
+    'batch_product_page': ('/api/batch', lambda inp, i: {'requests': [
+        {'path': '/api/product/similar', 'body': {'product_id': inp['product_ids'][i], 'limit': 5}},
+        {'path': '/api/product/also-bought', 'body': {'product_id': inp['product_ids'][i], 'limit': 5}},
+    ]}),
+}
+DEFAULT_MIX = {
+    'search': 25, 'search_personalized': 5, 'suggest': 20, 'similar': 10, 'also_bought': 5,
+    'batch_product_page': 10, 'recommend_home': 10, 'recommend_anonymous': 5,
+    'complementary': 5, 'best_deals': 3, 'shops_ranked': 2,
+}
+
+
+def parse_mix(items):
+    """{'search': 3, ...} from ['search=3', ...]"""
+    mix = {}
+    for item in items:
+        name, _, weight = item.partition('=')
+        if name not in ENDPOINTS:
+            raise SystemExit(f"Unknown endpoint {name}; choose from {', '.join(ENDPOINTS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def client(url, inputs, mix, deadline, warmup_until, seed, samples):
+    """Send requests until deadline, appending (name, status, seconds) after the warm-up"""
+    target = urlsplit(url)
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    n_inputs = len(inputs['product_ids'])
+    conn = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=30)
+    local = []
+    while time.perf_counter() < deadline:
+        name = rng.choices(names, weights)[0]
+        path, body = ENDPOINTS[name]
+        payload = json.dumps(body(inputs, rng.randrange(n_inputs)))
+        start = time.perf_counter()
+        try:
+            conn.request('POST', path, payload, {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            status = 0
+            conn.close()
+            conn = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=30)
+        if start >= warmup_until:
+            local.append((name, status, time.perf_counter() - start))
+    conn.close()
+    samples.extend(local)
+
+
+def summarize(name, rows, duration):
+    timings = np.array([seconds for _, _, seconds in rows]) * 1000
+    errors = sum(1 for _, status, _ in rows if status != 200)
+    result = {'endpoint': name, 'requests': len(rows), 'errors': errors,
+              'rps': round(len(rows) / duration, 1)}
+    if len(rows):
+        result.update({
+            'mean_ms': round(float(timings.mean()), 2),
+            'p50_ms': round(float(np.percentile(timings, 50)), 2),
+            'p95_ms': round(float(np.percentile(timings, 95)), 2),
+            'p99_ms': round(float(np.percentile(timings, 99)), 2),
+            'max_ms': round(float(timings.max()), 2),
+        })
+    return result
+
+
+def run(args):
+    with contextlib.redirect_stdout(sys.stderr):
+        dataset_dir, dataset = datasets.prepare(
+            args.products, args.order_items, args.users, args.shops, args.seed, args.db, args.pg_database
+        )
+    inputs = datasets.sample_inputs(dataset_dir, args.inputs, args.seed)
+    mix = parse_mix(args.mix) if args.mix else DEFAULT_MIX
+
+    start = time.perf_counter()
+    warmup_until = start + args.warmup
+    deadline = warmup_until + args.duration
+    samples = []
+    threads = [
+        threading.Thread(target=client, args=(args.url, inputs, mix, deadline, warmup_until, args.seed + i, samples))
+        for i in range(args.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    common = {'benchmark': 'load', 'url': args.url, 'dataset': dataset['name'],
+              'concurrency': args.concurrency, 'duration_s': args.duration}
+    results = []
+    for name in mix:
+        result = dict(common, **summarize(name, [row for row in samples if row[0] == name], args.duration))
+        results.append(result)
+    results.append(dict(common, **summarize('all', samples, args.duration)))
+    for result in results:
+        datasets.emit(result, args.output)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5055')
+    parser.add_argument('--products', type=int, default=100_000)
+    parser.add_argument('--order-items', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=None)
+    parser.add_argument('--shops', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', choices=['sqlite', 'postgres'], default='sqlite',
+                        help='where the dataset was loaded, to pick the same one')
+    parser.add_argument('--pg-database', default=datasets.PG_DATABASE)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--inputs', type=int, default=2000)
+    parser.add_argument('--mix', nargs='+', help='endpoint=weight pairs, e.g. search=3 similar=1')
+    parser.add_argument('--output', help='also append the results to this JSON lines file')
+    run(parser.parse_args())
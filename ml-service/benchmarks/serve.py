@@ -0,0 +1,63 @@
+"""Serve the ML service over a benchmark dataset, for load_test.py.
+
+Prepares the dataset like bench_models.py, points the service at its
+models (ML_MODELS_DIR) and database, and serves it in this process: the
+ASGI app on uvicorn, or the Flask app on its threaded server.
+
+    python benchmarks/serve.py --products 100000 --order-items 1000000
+    python benchmarks/serve.py --db postgres --server wsgi --port 5055
+
+For numbers from the production setup (gunicorn, several workers), load the
+dataset into Postgres with --db postgres and start gunicorn.conf.py with
+ML_MODELS_DIR and DB_NAME set to the dataset's instead.
+"""
+import argparse
+import contextlib
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import datasets
+
+
+def serve(args):
+    with contextlib.redirect_stdout(sys.stderr):
+        dataset_dir, dataset = datasets.prepare(
+            args.products, args.order_items, args.users, args.shops, args.seed, args.db, args.pg_database
+        )
+    os.environ['ML_MODELS_DIR'] = os.path.join(dataset_dir, 'models')
+    import app as flask_module
+    if args.db == 'sqlite':
+        # No Postgres to wait for
+        flask_module.wait_for_db = lambda *a, **k: True
+    else:
+        os.environ['DB_NAME'] = args.pg_database
+
+    if args.server == 'asgi':
+        import uvicorn
+        import asgi
+        if args.db == 'sqlite':
+            datasets.use_sqlite(os.path.join(dataset_dir, 'bench.db'))
+        print(f"Serving {dataset['name']} with uvicorn on port {args.port}", file=sys.stderr)
+        uvicorn.run(asgi.app, host=args.host, port=args.port, log_level='warning')
+    else:
+        import wsgi  # loads the catalog and profiles
+        if args.db == 'sqlite':
+            datasets.use_sqlite(os.path.join(dataset_dir, 'bench.db'))
+        print(f"Serving {dataset['name']} with the Flask server on port {args.port}", file=sys.stderr)
+        flask_module.app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=100_000)
+    parser.add_argument('--order-items', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=None)
+    parser.add_argument('--shops', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', choices=['sqlite', 'postgres'], default='sqlite')
+    parser.add_argument('--pg-database', default=datasets.PG_DATABASE)
+    parser.add_argument('--server', choices=['asgi', 'wsgi'], default='asgi')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5055)
+    serve(parser.parse_args())
@@ -1,4 +1,29 @@
-import pandas as pd
+"""Export training data from the database to Parquet.
+
+Every query is read through a server-side cursor in chunks of
+EXPORT_CHUNK_SIZE rows, and each chunk is written as one compressed
+Parquet row group, so memory stays bounded whatever the table sizes.
+
+    python export_data.py                # full export
+    python export_data.py --incremental  # only paid orders new since the last run
+
+Products and shops are always exported in full. The paid order history is
+a directory of Parquet parts: a full export replaces it, an incremental one
+adds a part with the orders paid since the previous run (tracked in
+data/export_state.json).
+
+All queries run in one read-only REPEATABLE READ transaction, so they
+see the same snapshot: an order paid during the export is either in this
+part or still listed as unpaid for the next run, never lost in between.
+"""
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import psycopg2.extensions
+from datetime import datetime
+import argparse
+import shutil
+import json
 import os
 import sys
 from dotenv import load_dotenv
@@ -8,55 +33,194 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from utils.database import get_db_connection
 
-def export_to_csv():
-    """Fetches data from the database and saves it to CSV files for training."""
-    print("Starting data export...")
-    
+# Rows fetched from the server and written per row group
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 50000))
+COMPRESSION = 'zstd'
+STATE_FILE = 'export_state.json'
+
+PRODUCTS_QUERY = """
+    SELECT p.id, p.name, p.description, p.price, p.shop_id,
+           s.name as shop_name, p.image_url
+    FROM products p
+    JOIN shops s ON p.shop_id = s.id
+    ORDER BY p.id
+"""
+PRODUCTS_SCHEMA = pa.schema([
+    ('id', pa.int64()), ('name', pa.string()), ('description', pa.string()),
+    ('price', pa.float64()), ('shop_id', pa.int64()), ('shop_name', pa.string()),
+    ('image_url', pa.string()),
+])
+
+# Paid orders after the order id watermark, plus earlier orders that were
+# still unpaid at the last export
+ORDERS_QUERY = """
+    SELECT o.user_id, oi.product_id, o.payment_status, o.id as order_id, o.total_amount
+    FROM order_items oi
+    JOIN orders o ON oi.order_id = o.id
+    WHERE o.payment_status = 'paid'
+      AND (o.id > %s OR o.id = ANY(%s))
+    ORDER BY o.id
+"""
+ORDERS_SCHEMA = pa.schema([
+    ('user_id', pa.int64()), ('product_id', pa.int64()),
+    ('payment_status', pa.string()), ('order_id', pa.int64()),
+    ('total_amount', pa.float64()),
+])
+# Orders up to the watermark that may still be paid later
+UNPAID_ORDERS_QUERY = """
+    SELECT id FROM orders
+    WHERE payment_status <> 'paid' AND id <= %s
+"""
+
+SHOPS_QUERY = "SELECT id, name, address, contact, logo FROM shops ORDER BY id"
+SHOPS_SCHEMA = pa.schema([
+    ('id', pa.int64()), ('name', pa.string()), ('address', pa.string()),
+    ('contact', pa.string()), ('logo', pa.string()),
+])
+
+# NUMERIC columns arrive as floats rather than Decimal objects
+DECIMAL_AS_FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, 'DECIMAL_AS_FLOAT',
+    lambda value, cursor: float(value) if value is not None else None
+)
+
+
+def stream_to_parquet(conn, query, params, schema, path, chunk_size=EXPORT_CHUNK_SIZE, on_chunk=None):
+    """Write a query result to a Parquet file one chunk (row group) at a time.
+
+    The file is written under a temporary name and renamed once complete.
+    on_chunk, if given, is called with every Arrow chunk. Returns the row count.
+    """
+    # Dot-prefixed, so dataset readers skip a part still being written
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    rows_written = 0
+    # A named cursor keeps the result on the server and fetches it in chunks
+    with conn.cursor(name='export') as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(query, params)
+        with pq.ParquetWriter(tmp_path, schema, compression=COMPRESSION) as writer:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                chunk = pa.Table.from_arrays(
+                    [pa.array([row[i] for row in rows], type=field.type) for i, field in enumerate(schema)],
+                    schema=schema
+                )
+                writer.write_table(chunk)
+                if on_chunk is not None:
+                    on_chunk(chunk)
+                rows_written += len(rows)
+    os.replace(tmp_path, path)
+    return rows_written
+
+
+def load_state(data_dir):
+    path = os.path.join(data_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(data_dir, state):
+    path = os.path.join(data_dir, STATE_FILE)
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def export_orders(conn, data_dir, state, incremental, chunk_size):
+    """Export paid order items into data/order_history/, returning the new state"""
+    orders_dir = os.path.join(data_dir, 'order_history')
+    previous = state.get('order_history') if incremental else None
+    if previous is None:
+        # Full export: start the directory over, forgetting its parts first so
+        # an incremental run after a failed export starts over as well
+        if state.pop('order_history', None) is not None:
+            save_state(data_dir, state)
+        shutil.rmtree(orders_dir, ignore_errors=True)
+        previous = {'last_order_id': 0, 'unpaid_order_ids': [], 'parts': 0}
+    os.makedirs(orders_dir, exist_ok=True)
+
+    last_order_id = previous['last_order_id']
+
+    def track_watermark(chunk):
+        nonlocal last_order_id
+        if chunk.num_rows:
+            last_order_id = max(last_order_id, pc.max(chunk['order_id']).as_py())
+
+    part = previous['parts']
+    path = os.path.join(orders_dir, f"part-{part:05d}.parquet")
+    count = stream_to_parquet(
+        conn, ORDERS_QUERY, [previous['last_order_id'], previous['unpaid_order_ids']],
+        ORDERS_SCHEMA, path, chunk_size, on_chunk=track_watermark
+    )
+    if count == 0 and part > 0:
+        # Nothing new: do not leave an empty part behind
+        os.remove(path)
+    else:
+        part += 1
+
+    with conn.cursor() as cursor:
+        cursor.execute(UNPAID_ORDERS_QUERY, [last_order_id])
+        unpaid_order_ids = [row[0] for row in cursor.fetchall()]
+
+    print(f"Saved {count} order records to order_history/")
+    return {'last_order_id': last_order_id, 'unpaid_order_ids': unpaid_order_ids, 'parts': part}
+
+
+def export_data(incremental=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """Fetches data from the database and saves it to Parquet files for training."""
+    print(f"Starting {'incremental' if incremental else 'full'} data export...")
+
     # Ensure data directory exists
     data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
-    
+
+    state = load_state(data_dir)
     conn = get_db_connection()
-    
+    psycopg2.extensions.register_type(DECIMAL_AS_FLOAT, conn)
+    # One snapshot for every query below (see the module docstring)
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    # Taken before the snapshot, so later catalog refreshes look back far enough
+    exported_at = datetime.now()
+
     try:
         # 1. Export Products
         print("Exporting products...")
-        products_query = """
-            SELECT p.id, p.name, p.description, p.price, p.shop_id, 
-                   s.name as shop_name, p.image_url
-            FROM products p
-            JOIN shops s ON p.shop_id = s.id
-        """
-        products_df = pd.read_sql(products_query, conn)
-        products_df.to_csv(os.path.join(data_dir, 'products.csv'), index=False)
-        print(f"Saved {len(products_df)} products to products.csv")
+        count = stream_to_parquet(
+            conn, PRODUCTS_QUERY, None, PRODUCTS_SCHEMA, os.path.join(data_dir, 'products.parquet'), chunk_size
+        )
+        print(f"Saved {count} products to products.parquet")
 
         # 2. Export Order Items (for recommendation history and co-purchase)
         print("Exporting order history...")
-        orders_query = """
-            SELECT o.user_id, oi.product_id, o.payment_status, o.id as order_id
-            FROM order_items oi
-            JOIN orders o ON oi.order_id = o.id
-            WHERE o.payment_status = 'paid'
-        """
-        orders_df = pd.read_sql(orders_query, conn)
-        orders_df.to_csv(os.path.join(data_dir, 'order_history.csv'), index=False)
-        print(f"Saved {len(orders_df)} order records to order_history.csv")
+        state['order_history'] = export_orders(conn, data_dir, state, incremental, chunk_size)
 
         # 3. Export Shops
         print("Exporting shops...")
-        shops_query = "SELECT id, name, address FROM shops"
-        shops_df = pd.read_sql(shops_query, conn)
-        shops_df.to_csv(os.path.join(data_dir, 'shops.csv'), index=False)
-        print(f"Saved {len(shops_df)} shops to shops.csv")
+        count = stream_to_parquet(
+            conn, SHOPS_QUERY, None, SHOPS_SCHEMA, os.path.join(data_dir, 'shops.parquet'), chunk_size
+        )
+        print(f"Saved {count} shops to shops.parquet")
 
+        conn.commit()
+        state['exported_at'] = exported_at.isoformat()
+        save_state(data_dir, state)
         print("\nExport completed successfully!")
-        
+
     except Exception as e:
         print(f"Error during export: {e}")
     finally:
         conn.close()
 
 if __name__ == "__main__":
-    export_to_csv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--incremental', action='store_true',
+                        help='only export paid orders new since the last run')
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+                        help='rows per fetch and Parquet row group')
+    args = parser.parse_args()
+    export_data(args.incremental, args.chunk_size)
@@ -0,0 +1,72 @@
+"""Gunicorn settings for the ML service.
+
+Send SIGHUP to the master after retraining: it reloads the catalog once,
+then replaces the workers gracefully so they fork with the new models.
+"""
+import multiprocessing
+import shutil
+import os
+
+bind = f"0.0.0.0:{os.getenv('ML_PORT', 5000)}"
+workers = int(os.getenv('ML_WORKERS', multiprocessing.cpu_count()))
+# start.sh runs asgi:app with uvicorn.workers.UvicornWorker, wsgi:app uses gthread
+worker_class = os.getenv('ML_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('ML_THREADS', 4))
+timeout = int(os.getenv('ML_WORKER_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('ML_GRACEFUL_TIMEOUT', 30))
+pidfile = os.getenv('ML_PIDFILE', '/tmp/ml-service.pid')
+
+# Load the app (and its catalog) in the master before forking workers
+preload_app = True
+
+# Workers write their metrics here and /metrics sums them. Set before the
+# app is imported; cleared at startup only, not when SIGHUP rereads this file.
+if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    metrics_dir = os.getenv('ML_METRICS_DIR', '/tmp/ml-service-metrics')
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = metrics_dir
+
+# Workers clear their caches when another one handles the order-paid event
+if 'CACHE_INVALIDATION_DIR' not in os.environ:
+    cache_dir = os.getenv('ML_CACHE_DIR', '/tmp/ml-service-cache')
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.makedirs(cache_dir)
+    os.environ['CACHE_INVALIDATION_DIR'] = cache_dir
+
+def on_reload(server):
+    """Reload trained models in the master before new workers are forked"""
+    from models.catalog import catalog_store
+    from models.user_profiles import profile_store
+    from models.shop_stats import shop_stats_store
+    from app import search_ranking
+    from wsgi import WARMUP_MODE
+    from utils.database import close_pool
+
+    if WARMUP_MODE != 'preload':
+        # New workers load the current models on their own
+        return
+    server.log.info("Reloading catalog for new workers")
+    try:
+        catalog_store.load()
+        profile_store.load()
+        shop_stats_store.load()
+        search_ranking.warm()
+    except Exception as e:
+        # Keep serving the catalog the master already holds
+        server.log.error(f"Catalog reload failed, keeping current models: {e}")
+    finally:
+        close_pool()
+
+def post_fork(server, worker):
+    """Each worker loads the models unless the master did, then polls for new and edited products, paid orders and shops"""
+    from app import start_auto_refresh
+    from utils.warmup import warmup
+
+    warmup.start(then=start_auto_refresh)
+
+def child_exit(server, worker):
+    """Drop the live-only metrics of a worker that exited"""
+    from utils.metrics import mark_process_dead
+
+    mark_process_dead(worker.pid)
@@ -0,0 +1,164 @@
+import numpy as np
+from scipy import sparse
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import artifacts
+from utils.ranking import top_k_rows
+
+# Lists scanned per query; more lists raise recall and latency
+ANN_NPROBE = int(os.getenv('ANN_NPROBE', 8))
+# Rows scored at once when assigning rows to lists
+ASSIGN_BLOCK_SIZE = 65536
+# Rows sampled per list to fit the centroids
+SAMPLE_PER_LIST = 256
+
+
+def normalize_rows(vectors):
+    """Dense float32 copy of vectors with every non-zero row scaled to unit length"""
+    if sparse.issparse(vectors):
+        vectors = vectors.toarray()
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def _nearest_lists(vectors, centroids, block_size=ASSIGN_BLOCK_SIZE):
+    """Index of the highest dot product centroid for every row"""
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start + block_size]
+        assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def _spherical_kmeans(vectors, n_lists, n_iter, rng):
+    """Unit-length centroids of n_lists clusters by cosine similarity"""
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = _nearest_lists(vectors, centroids)
+        membership = sparse.csr_matrix(
+            (np.ones(len(vectors), dtype=np.float32), (assignments, np.arange(len(vectors)))),
+            shape=(n_lists, len(vectors))
+        )
+        sums = np.asarray(membership @ vectors)
+        norms = np.linalg.norm(sums, axis=1)
+        # Lists left empty restart from a random row
+        empty = norms == 0
+        centroids = np.divide(sums, norms[:, None], out=sums, where=~empty[:, None])
+        centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """Inverted-file approximate nearest neighbour index over unit-length embeddings.
+
+    Rows are clustered around n_lists centroids. A query scores the
+    centroids, then only the rows of the nprobe closest lists, so its cost
+    grows with the list size rather than the catalog.
+
+    Rows (re)assigned after training are held apart in changed_rows and
+    changed_lists, sorted by row, and skipped in the lists they were
+    trained into, so the trained arrays are never copied.
+    """
+
+    def __init__(self, centroids, assignments, embeddings, list_indptr=None, list_rows=None, nprobe=ANN_NPROBE,
+                 changed_rows=None, changed_lists=None):
+        self.centroids = centroids
+        self.assignments = assignments
+        self.embeddings = embeddings
+        self.nprobe = nprobe
+        if list_rows is None:
+            # Rows grouped by list, in catalog order within a list
+            list_rows = np.argsort(assignments, kind='stable').astype(np.int32)
+            list_indptr = np.zeros(len(centroids) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(assignments, minlength=len(centroids)), out=list_indptr[1:])
+        self.list_indptr = list_indptr
+        self.list_rows = list_rows
+        self.changed_rows = changed_rows if changed_rows is not None else np.empty(0, dtype=np.int64)
+        self.changed_lists = changed_lists if changed_lists is not None else np.empty(0, dtype=np.int32)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, n_iter=10, seed=0):
+        """Cluster unit-length embeddings; n_lists defaults to sqrt(rows)"""
+        n_rows = len(embeddings)
+        if n_lists is None:
+            n_lists = int(np.sqrt(n_rows))
+        n_lists = max(1, min(n_lists, n_rows))
+        rng = np.random.default_rng(seed)
+        sample = embeddings
+        if n_rows > n_lists * SAMPLE_PER_LIST:
+            sample = embeddings[np.sort(rng.choice(n_rows, n_lists * SAMPLE_PER_LIST, replace=False))]
+        centroids = _spherical_kmeans(np.asarray(sample, dtype=np.float32), n_lists, n_iter, rng)
+        return cls(centroids, _nearest_lists(embeddings, centroids), embeddings)
+
+    def with_rows(self, rows, embeddings):
+        """A new index over embeddings with the given rows (re)assigned to lists"""
+        rows = np.asarray(rows, dtype=np.int64)
+        keep = ~np.isin(self.changed_rows, rows)
+        changed_rows = np.concatenate([self.changed_rows[keep], rows])
+        changed_lists = np.concatenate([
+            self.changed_lists[keep], _nearest_lists(np.asarray(embeddings[rows], dtype=np.float32), self.centroids)
+        ])
+        order = np.argsort(changed_rows, kind='stable')
+        return IVFIndex(self.centroids, self.assignments, embeddings, self.list_indptr, self.list_rows,
+                        self.nprobe, changed_rows[order], changed_lists[order])
+
+    def save(self, writer):
+        """Add the index arrays to an ArtifactWriter version"""
+        writer.save_array('ivf_centroids', self.centroids)
+        writer.save_array('ivf_assignments', self.assignments)
+        writer.save_array('ivf_list_indptr', self.list_indptr)
+        writer.save_array('ivf_list_rows', self.list_rows)
+
+    @classmethod
+    def load(cls, version_dir, embeddings):
+        """Load the index from an artifact version, or None if it has none"""
+        if not artifacts.has_array(version_dir, 'ivf_centroids'):
+            return None
+        return cls(
+            artifacts.load_array(version_dir, 'ivf_centroids'),
+            artifacts.load_array(version_dir, 'ivf_assignments'),
+            embeddings,
+            artifacts.load_array(version_dir, 'ivf_list_indptr'),
+            artifacts.load_array(version_dir, 'ivf_list_rows'),
+        )
+
+    def query(self, vector, k, nprobe=None, exclude_rows=None):
+        """Approximate top-k rows by dot product with vector, best first.
+
+        Scans the nprobe lists whose centroids score highest, doubling
+        nprobe while fewer than k rows are left after excluding
+        exclude_rows. Returns (rows, scores).
+        """
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        list_order = np.argsort(-(self.centroids @ vector), kind='stable')
+        excluded = np.asarray(exclude_rows if exclude_rows is not None else [], dtype=np.int64)
+
+        while True:
+            lists = list_order[:nprobe]
+            rows = np.concatenate([
+                self.list_rows[self.list_indptr[list_id]:self.list_indptr[list_id + 1]]
+                for list_id in lists
+            ])
+            if len(self.changed_rows):
+                rows = np.concatenate([
+                    rows[~np.isin(rows, self.changed_rows)],
+                    self.changed_rows[np.isin(self.changed_lists, lists)],
+                ])
+            if len(excluded):
+                rows = rows[~np.isin(rows, excluded)]
+            if len(rows) >= k or nprobe >= self.n_lists:
+                break
+            nprobe = min(nprobe * 2, self.n_lists)
+
+        # Catalog order, so ties break like the exact path
+        rows = np.sort(rows)
+        scores = self.embeddings[rows] @ vector
+        top = top_k_rows(scores, k)
+        return rows[top], scores[top]
@@ -1,15 +1,27 @@
-import pandas as pd
+import numpy as np
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils.database import fetch_data
+from models.catalog import catalog_store
+from utils.metrics import stage
 
 class CartSuggestions:
+    def __init__(self, store=None):
+        self.store = store or catalog_store
+    
     def get_complementary_items(self, cart_product_ids, limit=5):
         """Get items frequently bought together with cart items"""
         if not cart_product_ids:
             return []
         
+        # Sum the cart's rows of the precomputed co-purchase matrix when available
+        catalog = self.store.get()
+        cart_rows = catalog.rows_of(cart_product_ids)
+        if catalog.copurchase is not None and cart_rows:
+            rows, counts = catalog.top_copurchased(cart_rows, limit)
+            return catalog.copurchase_records(rows, 'frequency', counts)
+        
         # Create placeholders for SQL IN clause
         placeholders = ','.join(['%s'] * len(cart_product_ids))
         
@@ -31,40 +43,32 @@ class CartSuggestions:
         
         params = list(cart_product_ids) + list(cart_product_ids) + [limit]
         result = fetch_data(query, params=params)
-        return result.to_dict('records')
+        with stage('records'):
+            return result.to_dict('records')
     
     def get_best_deals(self, cart_product_ids, limit=3):
-        """Find better deals for products in cart"""
+        """Find better deals for products in cart.
+
+        Cheaper offers of the same product (same normalized name) from any
+        shop, largest savings first, looked up in the catalog's product groups.
+        """
         if not cart_product_ids:
             return []
         
-        placeholders = ','.join(['%s'] * len(cart_product_ids))
-        
-        query = f"""
-            WITH cart_products AS (
-                SELECT p.id, p.name, p.price as cart_price
-                FROM products p
-                WHERE p.id IN ({placeholders})
-            ),
-            alternatives AS (
-                SELECT cp.id as cart_product_id, cp.name, cp.cart_price,
-                       p.id as alt_product_id, p.price as alt_price,
-                       p.shop_id, s.name as shop_name, p.image_url,
-                       (cp.cart_price - p.price) as savings
-                FROM cart_products cp
-                JOIN products p ON LOWER(TRIM(p.name)) = LOWER(TRIM(cp.name))
-                JOIN shops s ON p.shop_id = s.id
-                WHERE p.id NOT IN ({placeholders})
-                  AND p.price < cp.cart_price
-            )
-            SELECT * FROM alternatives
-            ORDER BY savings DESC
-            LIMIT %s
-        """
+        catalog = self.store.get()
+        cart_rows = list(dict.fromkeys(catalog.rows_of(cart_product_ids)))
+        if not cart_rows or limit <= 0:
+            return []
         
-        params = list(cart_product_ids) + list(cart_product_ids) + [limit]
-        result = fetch_data(query, params=params)
-        return result.to_dict('records')
-
-
-
+        with stage('score'):
+            groups = catalog.product_groups
+            prices = catalog.columns['price']
+            exclude = np.asarray(cart_rows, dtype=np.int64)
+            pairs = []
+            for cart_row in cart_rows:
+                # Each group is sorted by price, so its cheapest offers save the most
+                for alt_row in groups.cheaper_rows(cart_row, prices, limit, exclude):
+                    pairs.append((float(prices[cart_row] - prices[alt_row]), cart_row, int(alt_row)))
+            pairs.sort(key=lambda pair: -pair[0])
+            pairs = pairs[:limit]
+        return catalog.deal_records([pair[1] for pair in pairs], [pair[2] for pair in pairs])
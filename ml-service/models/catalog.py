@@ -0,0 +1,671 @@
+import pandas as pd
+import numpy as np
+import joblib
+from collections.abc import Sequence
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import itertools
+import threading
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.database import fetch_data
+from utils import artifacts
+from utils.artifacts import PatchedArray
+from utils.background import run_periodically
+from utils import metrics
+from utils.serialization import PreEncoded, dumps_str, float_json
+from utils.singleflight import SingleFlight
+from models.search_index import SearchIndex
+from models.ann_index import IVFIndex, normalize_rows
+from models.embeddings import Embedder, load_embeddings, embeddings_with_rows
+from models.product_groups import ProductGroups
+
+# Product columns held by the catalog
+NUMERIC_FIELDS = ('id', 'price', 'shop_id')
+STRING_FIELDS = ('name', 'description', 'shop_name', 'image_url')
+# Fields of the records() results, pre-encoded per product as record_json
+RECORD_FIELDS = ('id', 'name', 'price', 'shop_name', 'image_url')
+# Ids of the catalog snapshots built in this process, for results cached per snapshot
+_snapshot_ids = itertools.count(1)
+# Structures built on first use of a snapshot, once for concurrent callers
+_builds = SingleFlight('catalog_builds')
+
+PRODUCTS_QUERY = """
+    SELECT p.id, p.name, p.description, p.price, p.shop_id,
+           s.name as shop_name, p.image_url
+    FROM products p
+    JOIN shops s ON p.shop_id = s.id
+"""
+
+# Products added since the id watermark, or edited since the updated_at one
+CHANGED_PRODUCTS_QUERY = """
+    SELECT p.id, p.name, p.description, p.price, p.shop_id,
+           s.name as shop_name, p.image_url, p.updated_at
+    FROM products p
+    JOIN shops s ON p.shop_id = s.id
+    WHERE p.id > %s OR p.updated_at > %s
+    ORDER BY p.id
+"""
+# Without the updated_at column (models/alter_products.sql) only new ids are seen
+NEW_PRODUCTS_QUERY = PRODUCTS_QUERY + """
+    WHERE p.id > %s
+    ORDER BY p.id
+"""
+UPDATED_AT_QUERY = """
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'products' AND column_name = 'updated_at'
+"""
+
+# Seconds between background catalog refreshes, 0 disables them
+REFRESH_INTERVAL = float(os.getenv('CATALOG_REFRESH_INTERVAL', 10))
+# Edits are looked up this many seconds before the updated_at watermark, so
+# rows committed late or stamped by a skewed clock are not missed
+REFRESH_OVERLAP = float(os.getenv('CATALOG_REFRESH_OVERLAP', 300))
+
+_MISSING = object()
+
+
+def advance_watermark(watermark, changed_df):
+    """The (id, updated_at) watermark moved past the rows of changed_df"""
+    max_id, updated_at = watermark
+    if len(changed_df):
+        max_id = max(max_id, int(changed_df['id'].max()))
+    if 'updated_at' in changed_df and changed_df['updated_at'].notna().any():
+        updated_at = max(updated_at, pd.Timestamp(changed_df['updated_at'].max()).to_pydatetime())
+    return max_id, updated_at
+
+
+class PatchedColumn:
+    """Read-only string column with rows replaced or appended over a base column.
+
+    The base is a StringColumn or an object array; it is never copied.
+    """
+
+    def __init__(self, base, patches):
+        self.base = base
+        self.patches = patches
+        self.length = max(len(base), max(patches) + 1 if patches else 0)
+
+    @classmethod
+    def patch(cls, column, rows, values):
+        """Column with values at rows; patches of a PatchedColumn are merged"""
+        if isinstance(column, cls):
+            base, patches = column.base, dict(column.patches)
+        else:
+            base, patches = column, {}
+        patches.update(
+            (int(row), value if isinstance(value, str) else None)
+            for row, value in zip(rows, values)
+        )
+        return cls(base, patches)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, row):
+        value = self.patches.get(row, _MISSING)
+        return self.base[row] if value is _MISSING else value
+
+    def raw(self, rows):
+        """UTF-8 bytes of many rows at once, like StringColumn.raw"""
+        values = [self.patches.get(row, _MISSING) for row in rows]
+        base_rows = [row for row, value in zip(rows, values) if value is _MISSING]
+        if isinstance(self.base, np.ndarray):
+            base_values = ((self.base[row] or '').encode('utf-8') for row in base_rows)
+        else:
+            base_values = iter(self.base.raw(base_rows))
+        return [
+            next(base_values) if value is _MISSING else (value or '').encode('utf-8')
+            for value in values
+        ]
+
+    def __iter__(self):
+        return (self[row] for row in range(len(self)))
+
+    def to_list(self):
+        return list(self)
+
+
+def _as_array(column):
+    return column if isinstance(column, PatchedArray) else np.asarray(column)
+
+
+def _base_column(column):
+    """The column a PatchedColumn was patched over"""
+    return column.base if isinstance(column, PatchedColumn) else column
+
+
+def encode_records(ids, names, prices, shop_names, image_urls):
+    """JSON object of the RECORD_FIELDS of every product, as str"""
+    return [
+        dumps_str({
+            'id': int(product_id),
+            'name': name if isinstance(name, str) else None,
+            'price': float(price),
+            'shop_name': shop_name if isinstance(shop_name, str) else None,
+            'image_url': image_url if isinstance(image_url, str) else None,
+        })
+        for product_id, name, price, shop_name, image_url in zip(ids, names, prices, shop_names, image_urls)
+    ]
+
+
+class ProductRecords(PreEncoded, Sequence):
+    """Result of ProductCatalog.records(): a list of dicts, encoded without building them.
+
+    Indexing builds the dict of a row; to_json() splices the catalog's
+    record_json of each row with its score.
+    """
+
+    def __init__(self, catalog, rows, score_field=None, scores=None):
+        self.catalog = catalog
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.score_field = score_field
+        if score_field is not None:
+            # rows and scores pair up like zip(), the shorter one wins
+            scores = np.asarray(scores, dtype=np.float64)
+            self.rows = self.rows[:len(scores)]
+            scores = scores[:len(self.rows)]
+        self.scores = scores
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            scores = self.scores[index] if self.score_field is not None else None
+            return ProductRecords(self.catalog, self.rows[index], self.score_field, scores)
+        score = self.scores[index] if self.score_field is not None else None
+        return self.catalog.record(self.rows[index], self.score_field, score)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, ProductRecords)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def to_json(self):
+        column = self.catalog.record_json
+        rows = self.rows.tolist()
+        if isinstance(column, np.ndarray):
+            fragments = [column[row].encode('utf-8') for row in rows]
+        else:
+            fragments = column.raw(rows)
+        if self.score_field is not None:
+            key = (',' + dumps_str(self.score_field) + ':').encode('utf-8')
+            fragments = [
+                fragment[:-1] + key + float_json(score).encode('ascii') + b'}'
+                for fragment, score in zip(fragments, self.scores.tolist())
+            ]
+        return b'[' + b','.join(fragments) + b']'
+
+
+class ProductCatalog:
+    """Products, their TF-IDF vectors and an id -> row index.
+
+    Product fields are held column by column: numpy arrays for id, price
+    and shop_id, and string sequences (StringColumn or object arrays) for
+    the text fields, so memory-mapped artifacts are used as they are.
+    """
+
+    def __init__(self, columns, product_vectors, vectorizer,
+                 similar_ids=None, similar_scores=None, copurchase=None,
+                 search_index=None, id_order=None, version=None,
+                 stale_neighbour_rows=frozenset(), watermark=None,
+                 embeddings=None, ann_index=None, product_groups=None, embedder=None,
+                 record_json=None, sorted_ids=None, added_ids=None):
+        self.columns = columns
+        # A CSR matrix, or a PatchedArray over one after refreshes (see the product_vectors property)
+        self._product_vectors = product_vectors
+        self._merged_vectors = None
+        self.vectorizer = vectorizer
+        self.version = version
+        # Changes with every snapshot, trained or refreshed
+        self.snapshot_id = next(_snapshot_ids)
+        self.ids = _as_array(columns['id'])
+        self.shop_ids = _as_array(columns['shop_id'])
+        # Rows in id order, so ids resolve to rows with a binary search
+        self._id_order = id_order if id_order is not None else np.argsort(self.ids, kind='stable')
+        self._sorted_ids = sorted_ids if sorted_ids is not None else self.ids[self._id_order]
+        # Ids of the products added since _id_order was built -> their rows
+        self._added_ids = added_ids or {}
+        # Precomputed top-K neighbours from train.py, rows aligned with the catalog
+        self.similar_ids = similar_ids
+        self.similar_scores = similar_scores
+        # Rows added or edited since training, whose table entries are missing or outdated
+        self.stale_neighbour_rows = stale_neighbour_rows
+        # Unit-length dense product vectors and their ANN index, from train.py
+        self.embeddings = embeddings
+        self.ann_index = ann_index
+        # Embeds changed products like train.py did; None when the embeddings are unit TF-IDF vectors
+        self.embedder = embedder
+        # Paid order item pair counts, product x product CSR aligned with the catalog
+        self.copurchase = copurchase
+        # Rows grouped by normalized name with prices sorted, built on first use if train.py did not save it
+        self._product_groups = product_groups
+        # JSON of every product's RECORD_FIELDS, encoded on first use if train.py did not save it
+        self._record_json = record_json
+        # Inverted index over names and descriptions, built here if train.py did not save one
+        self.search_index = search_index or SearchIndex.build(columns['name'], columns['description'])
+        # (highest id, latest updated_at) already in the catalog, for incremental refreshes
+        if watermark is None:
+            watermark = (int(self.ids.max()) if len(self.ids) else 0, datetime.now())
+        self.watermark = watermark
+        self._products_df = None
+
+    @classmethod
+    def from_dataframe(cls, products_df, product_vectors, vectorizer, **kwargs):
+        """Catalog over a products DataFrame (legacy pickles or the database)"""
+        products_df = products_df.reset_index(drop=True)
+        columns = {
+            'id': products_df['id'].to_numpy(dtype=np.int64),
+            'price': products_df['price'].to_numpy(dtype=np.float64),
+            'shop_id': products_df['shop_id'].to_numpy(dtype=np.int64),
+        }
+        for field in STRING_FIELDS:
+            columns[field] = products_df[field].to_numpy(dtype=object)
+        return cls(columns, product_vectors, vectorizer, **kwargs)
+
+    @property
+    def products_df(self):
+        """The catalog as a DataFrame, built on first use"""
+        if self._products_df is None:
+            self._products_df = pd.DataFrame({
+                field: (np.asarray(self.columns[field]) if field in NUMERIC_FIELDS else list(self.columns[field]))
+                for field in NUMERIC_FIELDS + STRING_FIELDS
+            })
+        return self._products_df
+
+    @property
+    def product_vectors(self):
+        """TF-IDF vectors of every product, a CSR matrix (merged on first use after a refresh)"""
+        if not isinstance(self._product_vectors, PatchedArray):
+            return self._product_vectors
+        if self._merged_vectors is None:
+            self._merged_vectors = _builds.do(
+                (self.snapshot_id, 'product_vectors'), lambda: self._product_vectors.tocsr()
+            )
+        return self._merged_vectors
+
+    @property
+    def product_groups(self):
+        """The same product across shops, for best deals"""
+        if self._product_groups is None:
+            self._product_groups = _builds.do((self.snapshot_id, 'product_groups'), lambda: ProductGroups.build(
+                self.columns['name'], self.columns['price']
+            ))
+        return self._product_groups
+
+    @property
+    def record_json(self):
+        """Pre-encoded JSON of every product's records() fields, a string column"""
+        if self._record_json is None:
+            columns = self.columns
+            self._record_json = _builds.do((self.snapshot_id, 'record_json'), lambda: np.array(encode_records(
+                columns['id'], columns['name'], columns['price'], columns['shop_name'], columns['image_url']
+            ), dtype=object))
+        return self._record_json
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row_of(self, product_id):
+        """Row index of a product id, or None if it is not in the catalog"""
+        try:
+            product_id = int(product_id)
+        except (TypeError, ValueError):
+            return None
+        position = np.searchsorted(self._sorted_ids, product_id)
+        if position < len(self._sorted_ids) and self._sorted_ids[position] == product_id:
+            return int(self._id_order[position])
+        return self._added_ids.get(product_id)
+
+    def rows_of(self, product_ids):
+        """Row indices of the product ids that are in the catalog"""
+        rows = (self.row_of(product_id) for product_id in product_ids)
+        return [row for row in rows if row is not None]
+
+    def has_neighbours(self, row):
+        """Whether the precomputed neighbour table is valid for row"""
+        return (self.similar_ids is not None and row < len(self.similar_ids)
+                and row not in self.stale_neighbour_rows)
+
+    def with_updates(self, changed_df):
+        """A new catalog with the changed products replaced or appended.
+
+        changed_df holds PRODUCTS_QUERY columns (plus optional updated_at).
+        Text is vectorized with the fitted vectorizer and only the changed
+        documents are re-indexed for search. The arrays of this catalog,
+        memory-mapped when trained, are shared and never copied: the
+        changed rows are patched over them (PatchedArray, PatchedColumn,
+        and the patched search index, ANN index and product groups), so a
+        refresh costs in proportion to the products changed since training.
+        """
+        changed_df = changed_df.drop_duplicates('id', keep='last').reset_index(drop=True)
+        rows = np.empty(len(changed_df), dtype=np.int64)
+        added_ids = dict(self._added_ids)
+        n_new = len(self)
+        for i, product_id in enumerate(changed_df['id']):
+            row = self.row_of(product_id)
+            if row is None:
+                row = added_ids[int(product_id)] = n_new
+                n_new += 1
+            rows[i] = row
+
+        columns = {}
+        for field in NUMERIC_FIELDS:
+            values = changed_df[field].to_numpy(dtype=np.float64 if field == 'price' else np.int64)
+            columns[field] = PatchedArray.patch(self.columns[field], rows, values, n_new)
+        for field in STRING_FIELDS:
+            columns[field] = PatchedColumn.patch(self.columns[field], rows, changed_df[field].tolist())
+
+        content = changed_df['name'].fillna('') + ' ' + changed_df['description'].fillna('')
+        changed_vectors = self.vectorizer.transform(content).tocsr()
+        product_vectors = PatchedArray.patch(self._product_vectors, rows, changed_vectors, n_new)
+
+        embeddings, ann_index = self.embeddings, self.ann_index
+        if embeddings is not None:
+            if self.embedder is not None:
+                vectors = self.embedder.embed(content)
+            else:
+                vectors = normalize_rows(changed_vectors)
+            embeddings = embeddings_with_rows(embeddings, rows, vectors, n_new)
+            if ann_index is not None:
+                ann_index = ann_index.with_rows(rows, embeddings)
+
+        # The trained index was built from the unpatched columns
+        search_index = self.search_index.with_documents(
+            rows, changed_df['name'].tolist(), changed_df['description'].tolist(), n_new,
+            _base_column(self.columns['name']), _base_column(self.columns['description'])
+        )
+        product_groups = self._product_groups
+        if product_groups is not None:
+            product_groups = product_groups.with_rows(rows, changed_df['name'].tolist())
+        record_json = self._record_json
+        if record_json is not None:
+            changed_json = encode_records(*(
+                [columns[field][row] for row in rows.tolist()] for field in RECORD_FIELDS
+            ))
+            record_json = PatchedColumn.patch(record_json, rows, changed_json)
+
+        return ProductCatalog(
+            columns, product_vectors, self.vectorizer,
+            similar_ids=self.similar_ids, similar_scores=self.similar_scores,
+            copurchase=self.copurchase, search_index=search_index, version=self.version,
+            stale_neighbour_rows=self.stale_neighbour_rows | frozenset(rows.tolist()),
+            embeddings=embeddings, ann_index=ann_index, product_groups=product_groups,
+            embedder=self.embedder, record_json=record_json,
+            id_order=self._id_order, sorted_ids=self._sorted_ids, added_ids=added_ids,
+            watermark=advance_watermark(self.watermark, changed_df)
+        )
+
+    def unchanged(self, changed_df):
+        """Mask of changed_df rows identical to what the catalog already holds"""
+        mask = np.zeros(len(changed_df), dtype=bool)
+        for i, product in enumerate(changed_df.itertuples(index=False)):
+            row = self.row_of(product.id)
+            if row is None:
+                continue
+            values = [getattr(product, field) for field in STRING_FIELDS]
+            values = [value if isinstance(value, str) else None for value in values]
+            mask[i] = (
+                float(self.columns['price'][row]) == float(product.price)
+                and int(self.columns['shop_id'][row]) == int(product.shop_id)
+                and values == [self._string(field, row) for field in STRING_FIELDS]
+            )
+        return mask
+
+    def _string(self, field, row):
+        value = self.columns[field][row]
+        return value if isinstance(value, str) else None
+
+    def record(self, row, score_field=None, score=None):
+        """Result dict of one row, optionally with a score field"""
+        columns = self.columns
+        record = {
+            'id': int(columns['id'][row]),
+            'name': self._string('name', row),
+            'price': float(columns['price'][row]),
+            'shop_name': self._string('shop_name', row),
+            'image_url': self._string('image_url', row),
+        }
+        if score_field is not None:
+            record[score_field] = float(score)
+        return record
+
+    def records(self, rows, score_field=None, scores=None):
+        """Results for the given rows, optionally with a score field (ProductRecords)"""
+        return ProductRecords(self, rows, score_field, scores)
+
+    def copurchase_records(self, rows, count_field, counts):
+        """Result dicts in the layout of the co-purchase SQL queries"""
+        columns = self.columns
+        with metrics.stage('records'):
+            return [
+                {
+                    'product_id': int(columns['id'][row]),
+                    count_field: int(count),
+                    'name': self._string('name', row),
+                    'price': float(columns['price'][row]),
+                    'shop_id': int(columns['shop_id'][row]),
+                    'shop_name': self._string('shop_name', row),
+                    'image_url': self._string('image_url', row),
+                }
+                for row, count in zip(rows, counts)
+            ]
+
+    def deal_records(self, cart_rows, alt_rows):
+        """Result dicts in the layout of the best deals SQL query, one per (cart row, cheaper row) pair"""
+        columns = self.columns
+        prices = columns['price']
+        with metrics.stage('records'):
+            return [
+                {
+                    'cart_product_id': int(columns['id'][cart_row]),
+                    'name': self._string('name', cart_row),
+                    'cart_price': float(prices[cart_row]),
+                    'alt_product_id': int(columns['id'][alt_row]),
+                    'alt_price': float(prices[alt_row]),
+                    'shop_id': int(columns['shop_id'][alt_row]),
+                    'shop_name': self._string('shop_name', alt_row),
+                    'image_url': self._string('image_url', alt_row),
+                    'savings': round(float(prices[cart_row] - prices[alt_row]), 2),
+                }
+                for cart_row, alt_row in zip(cart_rows, alt_rows)
+            ]
+
+    def top_copurchased(self, rows, limit):
+        """Rows most often bought together with the given rows, with their counts.
+
+        Counts are summed once over each distinct given row, like the SQL's
+        IN (...), and the given rows are themselves excluded. Only rows with
+        a non-zero count are returned.
+        """
+        # Products added since training have no order history in the matrix
+        rows = [row for row in dict.fromkeys(rows) if row < self.copurchase.shape[0]]
+        counts = np.asarray(self.copurchase[rows].sum(axis=0)).ravel()
+        counts[rows] = 0
+        candidates = np.flatnonzero(counts)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-counts[candidates], limit - 1)[:limit]]
+        candidates = candidates[np.argsort(-counts[candidates], kind='stable')]
+        return candidates, counts[candidates]
+
+
+class CatalogStore:
+    """Holds the single ProductCatalog shared by every model class"""
+
+    def __init__(self, models_dir=None):
+        base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.models_dir = models_dir or os.getenv('ML_MODELS_DIR') or os.path.join(base_dir, 'data', 'models')
+        self._catalog = None
+        self._lock = threading.Lock()
+        self._pinned = threading.local()
+        self._refresh_lock = threading.Lock()
+        # First-use loads from concurrent requests, run once
+        self._flight = SingleFlight('catalog')
+        self._tracks_updates = None
+        self._refresher = None
+
+    @property
+    def loaded(self):
+        return self._catalog is not None
+
+    def load(self):
+        """Load the catalog from saved models or database and publish it"""
+        version_dir = artifacts.current_version_dir(self.models_dir)
+        vectorizer_path = os.path.join(self.models_dir, 'tfidf_vectorizer.pkl')
+        vectors_path = os.path.join(self.models_dir, 'product_vectors.pkl')
+        processed_path = os.path.join(self.models_dir, 'products_processed.pkl')
+
+        with metrics.MODEL_LOAD_SECONDS.labels('catalog').time():
+            if version_dir is not None:
+                print(f"Loading catalog artifacts {os.path.basename(version_dir)}...")
+                catalog = self._load_artifacts(version_dir)
+            elif os.path.exists(vectorizer_path) and os.path.exists(vectors_path) and os.path.exists(processed_path):
+                print("Loading legacy pickled catalog models...")
+                products_df = pd.read_pickle(processed_path)
+                catalog = ProductCatalog.from_dataframe(
+                    products_df,
+                    joblib.load(vectors_path),
+                    joblib.load(vectorizer_path),
+                    watermark=(int(products_df['id'].max()) if len(products_df) else 0,
+                               datetime.fromtimestamp(os.path.getmtime(processed_path)))
+                )
+            else:
+                print("Saved models not found. Loading catalog from database...")
+                from sklearn.feature_extraction.text import TfidfVectorizer
+                products_df = fetch_data(PRODUCTS_QUERY)
+                content = products_df['name'].fillna('') + ' ' + products_df['description'].fillna('')
+                vectorizer = TfidfVectorizer(max_features=100, stop_words='english')
+                product_vectors = vectorizer.fit_transform(content)
+                catalog = ProductCatalog.from_dataframe(products_df, product_vectors, vectorizer)
+
+        self.publish(catalog)
+        print(f"Catalog loaded with {len(catalog)} products")
+        return catalog
+
+    def _load_artifacts(self, version_dir):
+        """Catalog over a memory-mapped artifact version written by train.py"""
+        manifest = artifacts.read_manifest(version_dir)
+        shapes = manifest['shapes']
+        n_products = manifest['n_products']
+
+        columns = {field: artifacts.load_array(version_dir, field) for field in NUMERIC_FIELDS}
+        for field in STRING_FIELDS:
+            columns[field] = artifacts.load_strings(version_dir, field)
+
+        similar_ids, similar_scores = None, None
+        if artifacts.has_array(version_dir, 'similar_ids'):
+            similar_ids = artifacts.load_array(version_dir, 'similar_ids')
+            similar_scores = artifacts.load_array(version_dir, 'similar_scores')
+        copurchase = None
+        if 'copurchase' in shapes:
+            copurchase = artifacts.load_csr(version_dir, 'copurchase', shapes['copurchase'])
+        embeddings = load_embeddings(version_dir)
+        ann_index = IVFIndex.load(version_dir, embeddings) if embeddings is not None else None
+        record_json = None
+        if artifacts.has_array(version_dir, 'record_json.offsets'):
+            record_json = artifacts.load_strings(version_dir, 'record_json')
+        # Products edited after the export are picked up by the next refresh
+        watermark = None
+        if manifest.get('exported_at'):
+            ids = columns['id']
+            watermark = (int(ids.max()) if len(ids) else 0, datetime.fromisoformat(manifest['exported_at']))
+
+        catalog = ProductCatalog(
+            columns,
+            artifacts.load_csr(version_dir, 'product_vectors', shapes['product_vectors']),
+            artifacts.vectorizer_from_manifest(manifest['vectorizer']),
+            similar_ids=similar_ids, similar_scores=similar_scores,
+            copurchase=copurchase,
+            search_index=SearchIndex.load(version_dir),
+            id_order=artifacts.load_array(version_dir, 'id_order'),
+            version=manifest['version'],
+            watermark=watermark,
+            embeddings=embeddings, ann_index=ann_index,
+            product_groups=ProductGroups.load(version_dir),
+            embedder=Embedder.load(version_dir, manifest),
+            record_json=record_json
+        )
+        if len(catalog) != n_products or catalog.product_vectors.shape[0] != n_products:
+            raise ValueError(f"Artifact version {version_dir} is inconsistent")
+        return catalog
+
+    def publish(self, catalog):
+        """Make catalog the one returned to every model from now on"""
+        self._catalog = catalog
+        return catalog
+
+    def _track_updates(self):
+        """Whether products has the updated_at column, checked once"""
+        if self._tracks_updates is None:
+            self._tracks_updates = not fetch_data(UPDATED_AT_QUERY).empty
+            if not self._tracks_updates:
+                print("products.updated_at not found, refreshes only pick up new products")
+        return self._tracks_updates
+
+    def refresh(self):
+        """Apply products added or edited since the catalog watermark.
+
+        The updated catalog is published as a new snapshot; requests already
+        running keep the one they started with. Returns the number of
+        products applied.
+        """
+        with self._refresh_lock, metrics.MODEL_REFRESH_SECONDS.labels('catalog').time():
+            catalog = self.get()
+            max_id, updated_at = catalog.watermark
+            if self._track_updates():
+                since = updated_at - timedelta(seconds=REFRESH_OVERLAP)
+                changed = fetch_data(CHANGED_PRODUCTS_QUERY, params=[max_id, since])
+            else:
+                changed = fetch_data(NEW_PRODUCTS_QUERY, params=[max_id])
+            watermark = advance_watermark(catalog.watermark, changed)
+            # The overlap window returns rows already applied
+            changed = changed[~catalog.unchanged(changed)]
+            if changed.empty:
+                catalog.watermark = watermark
+                return 0
+
+            updated = catalog.with_updates(changed)
+            updated.watermark = watermark
+            with self._lock:
+                # A full reload meanwhile wins over this refresh
+                if self._catalog is not catalog:
+                    return 0
+                self.publish(updated)
+            print(f"Catalog refreshed with {len(changed)} added or edited products")
+            return len(changed)
+
+    def start_auto_refresh(self, interval=REFRESH_INTERVAL):
+        """Refresh the catalog every interval seconds in a daemon thread"""
+        if interval <= 0 or (self._refresher is not None and self._refresher.is_alive()):
+            return
+        self._refresher = run_periodically('Catalog refresh', interval, self.refresh)
+
+    @contextmanager
+    def pinned(self, catalog=None):
+        """Serve one snapshot (catalog, or the current one) to every get() in this thread for the block"""
+        previous = getattr(self._pinned, 'catalog', None)
+        if catalog is None:
+            catalog = previous if previous is not None else self.get()
+        self._pinned.catalog = catalog
+        try:
+            yield self._pinned.catalog
+        finally:
+            self._pinned.catalog = previous
+
+    def get(self):
+        """Return the current catalog, loading it on first use"""
+        catalog = getattr(self._pinned, 'catalog', None)
+        if catalog is None:
+            catalog = self._catalog
+        if catalog is None:
+            catalog = self._flight.do('load', lambda: self._catalog if self._catalog is not None else self.load())
+        return catalog
+
+
+# Shared by every model class in the process
+catalog_store = CatalogStore()
@@ -0,0 +1,140 @@
+import numpy as np
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import artifacts
+from utils.artifacts import PatchedArray
+from models.ann_index import normalize_rows
+
+# Precision the service holds the embeddings in: float32, or int8 for a quarter
+# of the memory at the cost of slower full scans
+EMBEDDING_PRECISION = os.getenv('EMBEDDING_PRECISION', 'float32')
+# Rows dequantized at once when scanning int8 embeddings
+SCAN_BLOCK_SIZE = 65536
+
+
+def quantize(embeddings):
+    """int8 codes and float32 per-row scales approximating unit-length embeddings"""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    scales = np.abs(embeddings).max(axis=1, initial=0.0) / 127
+    codes = np.divide(embeddings, scales[:, None], out=np.zeros_like(embeddings), where=scales[:, None] > 0)
+    return np.rint(codes).astype(np.int8), scales.astype(np.float32)
+
+
+class QuantizedEmbeddings:
+    """int8 embeddings with one scale per row, read like the float32 matrix.
+
+    Indexing returns the rows dequantized, so the IVF index and user
+    profiles use it as they use the float32 array; dot() scans every row
+    in blocks of SCAN_BLOCK_SIZE.
+    """
+
+    dtype = np.dtype(np.float32)
+
+    def __init__(self, codes, scales):
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def from_floats(cls, embeddings):
+        return cls(*quantize(embeddings))
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, rows):
+        return self.codes[rows].astype(np.float32) * np.asarray(self.scales[rows])[..., None]
+
+    def dot(self, vectors):
+        """Dot products of every row with a vector (n,), or with the rows of a matrix (n, m)"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        scores = np.empty((len(self),) + vectors.shape[:-1], dtype=np.float32)
+        for start in range(0, len(self), SCAN_BLOCK_SIZE):
+            stop = min(start + SCAN_BLOCK_SIZE, len(self))
+            block = self.codes[start:stop].astype(np.float32) @ vectors.T
+            scales = self.scales[start:stop]
+            scores[start:stop] = block * (scales if block.ndim == 1 else scales[:, None])
+        return scores
+
+
+def embedding_scores(embeddings, vectors):
+    """Dot products of every embedding with a vector (n,), or with the rows of a matrix (n, m)"""
+    if isinstance(embeddings, PatchedArray):
+        scores = embedding_scores(embeddings.base, vectors)
+        if len(scores) < len(embeddings):
+            # Rows of the products added since training
+            grown = np.zeros((len(embeddings),) + scores.shape[1:], dtype=scores.dtype)
+            grown[:len(scores)] = scores
+            scores = grown
+        scores[embeddings.rows] = embedding_scores(embeddings.values, vectors)
+        return scores
+    if isinstance(embeddings, QuantizedEmbeddings):
+        return embeddings.dot(vectors)
+    return embeddings @ np.asarray(vectors, dtype=np.float32).T
+
+
+def embeddings_with_rows(embeddings, rows, vectors, n_rows):
+    """Embeddings grown to n_rows, with the given rows set to unit-length vectors.
+
+    The trained embeddings are left as they are; the changed rows are
+    patched over them (see PatchedArray).
+    """
+    base = embeddings.base if isinstance(embeddings, PatchedArray) else embeddings
+    if isinstance(base, QuantizedEmbeddings):
+        # At the precision of the rows around them
+        vectors = QuantizedEmbeddings.from_floats(vectors)[:]
+    return PatchedArray.patch(embeddings, rows, np.asarray(vectors, dtype=np.float32), n_rows)
+
+
+def save_embeddings(writer, embeddings):
+    """Add float32 embeddings and their int8 copy to an ArtifactWriter version"""
+    writer.save_array('embeddings', np.asarray(embeddings, dtype=np.float32))
+    codes, scales = quantize(embeddings)
+    writer.save_array('embeddings_int8', codes)
+    writer.save_array('embeddings_scale', scales)
+
+
+def load_embeddings(version_dir, precision=EMBEDDING_PRECISION):
+    """Embeddings of an artifact version in the given precision, or None if it has none"""
+    if precision == 'int8' and artifacts.has_array(version_dir, 'embeddings_int8'):
+        return QuantizedEmbeddings(
+            artifacts.load_array(version_dir, 'embeddings_int8'),
+            artifacts.load_array(version_dir, 'embeddings_scale'),
+        )
+    if not artifacts.has_array(version_dir, 'embeddings'):
+        return None
+    return artifacts.load_array(version_dir, 'embeddings')
+
+
+class Embedder:
+    """Embeds product text like train.py: TF-IDF, then the TruncatedSVD components.
+
+    Used for products added or edited after training. Artifacts trained
+    without it hold unit-length TF-IDF vectors as embeddings instead.
+    """
+
+    def __init__(self, vectorizer, components):
+        self.vectorizer = vectorizer
+        self.components = components
+
+    def embed(self, texts):
+        """Unit-length float32 embeddings of texts"""
+        return normalize_rows(self.vectorizer.transform(texts) @ self.components.T)
+
+    @classmethod
+    def load(cls, version_dir, manifest):
+        """Load the embedder from an artifact version, or None if it has none"""
+        if manifest.get('embedder') is None:
+            return None
+        return cls(
+            artifacts.vectorizer_from_manifest(manifest['embedder']),
+            artifacts.load_array(version_dir, 'embedding_components'),
+        )
@@ -0,0 +1,193 @@
+import numpy as np
+import pandas as pd
+import unicodedata
+import re
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import artifacts
+
+# 'exact' groups names equal after LOWER(TRIM(name)), like the SQL join it
+# replaces; 'fuzzy' also ignores accents, punctuation and how units are written
+BEST_DEALS_MATCH = os.getenv('BEST_DEALS_MATCH', 'exact')
+
+# Unit spellings -> canonical unit, for fuzzy matching
+UNIT_ALIASES = {
+    'g': 'g', 'gm': 'g', 'gms': 'g', 'gram': 'g', 'grams': 'g', 'gr': 'g',
+    'kg': 'kg', 'kgs': 'kg', 'kilo': 'kg', 'kilos': 'kg', 'kilogram': 'kg', 'kilograms': 'kg',
+    'mg': 'mg',
+    'l': 'l', 'lt': 'l', 'ltr': 'l', 'ltrs': 'l', 'litre': 'l', 'litres': 'l', 'liter': 'l', 'liters': 'l',
+    'ml': 'ml', 'mls': 'ml', 'millilitre': 'ml', 'milliliter': 'ml',
+    'pc': 'pc', 'pcs': 'pc', 'piece': 'pc', 'pieces': 'pc',
+    'pk': 'pack', 'pack': 'pack', 'packs': 'pack',
+    'dozen': 'dozen', 'dz': 'dozen',
+}
+# Punctuation, except a decimal point between digits
+_PUNCTUATION = re.compile(r"[^\w\s.]|_|(?<!\d)\.|\.(?!\d)")
+_QUANTITY = re.compile(r"(\d+(?:\.\d+)?)\s*([a-z]+)\b")
+_SPACES = re.compile(r"\s+")
+
+
+def _quantity(match):
+    number, unit = match.groups()
+    if unit not in UNIT_ALIASES:
+        return match.group(0)
+    if '.' in number:
+        number = number.rstrip('0').rstrip('.')
+    return f"{number}{UNIT_ALIASES[unit]}"
+
+
+def normalize_name(name, match=BEST_DEALS_MATCH):
+    """Group key of a product name, or None for missing names"""
+    if not isinstance(name, str):
+        return None
+    if match != 'fuzzy':
+        # Postgres TRIM strips spaces only
+        return name.strip(' ').lower()
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(char for char in name if not unicodedata.combining(char)).lower()
+    name = _PUNCTUATION.sub(' ', name)
+    name = _QUANTITY.sub(_quantity, name)
+    return _SPACES.sub(' ', name).strip()
+
+
+class ProductGroups:
+    """The same product across shops: catalog rows grouped by normalized name.
+
+    group_of maps every row to its group (-1 for rows without a name) and
+    each group's rows are a CSR slice sorted by price, so the cheaper
+    offers of a product are a prefix of its group.
+    """
+
+    def __init__(self, keys, group_of, indptr, rows, match=BEST_DEALS_MATCH):
+        self.keys = keys
+        self.group_of = group_of
+        self.indptr = indptr
+        self.rows = rows
+        self.match = match
+        self._key_groups = None
+
+    @classmethod
+    def _from_groups(cls, keys, group_of, prices, match):
+        grouped = np.flatnonzero(group_of >= 0)
+        # By group, then price; lexsort is stable, so ties keep catalog order
+        rows = grouped[np.lexsort((prices[grouped], group_of[grouped]))]
+        indptr = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(group_of[grouped], minlength=len(keys)), out=indptr[1:])
+        return cls(keys, group_of, indptr, rows.astype(np.int64), match)
+
+    @classmethod
+    def build(cls, names, prices, match=BEST_DEALS_MATCH):
+        """Groups over a name column and the price array aligned with it"""
+        codes, keys = pd.factorize(pd.Series([normalize_name(name, match) for name in names], dtype=object))
+        return cls._from_groups(
+            np.asarray(keys, dtype=object), codes.astype(np.int32), np.asarray(prices, dtype=np.float64), match
+        )
+
+    def with_rows(self, rows, names):
+        """Groups with the given rows renamed, repriced or added (PatchedProductGroups)"""
+        return PatchedProductGroups.patch(self, rows, names)
+
+    def key_groups(self):
+        """Group of every key, built on first use"""
+        if self._key_groups is None:
+            self._key_groups = {key: group for group, key in enumerate(self.keys)}
+        return self._key_groups
+
+    def group(self, row):
+        """Group of a row, -1 for rows without a name"""
+        return int(self.group_of[row]) if row < len(self.group_of) else -1
+
+    def members(self, group, prices):
+        """Rows of a group sorted by price"""
+        return self.rows[self.indptr[group]:self.indptr[group + 1]]
+
+    def cheaper_rows(self, row, prices, limit, exclude_rows=()):
+        """Up to limit rows of row's group priced below it, cheapest first"""
+        group = self.group(row)
+        if group < 0:
+            return np.empty(0, dtype=np.int64)
+        members = self.members(group, prices)
+        members = members[:np.searchsorted(prices[members], prices[row], side='left')]
+        if len(exclude_rows):
+            members = members[~np.isin(members, exclude_rows)]
+        return members[:limit]
+
+    def save(self, writer):
+        """Add the groups to an ArtifactWriter version"""
+        writer.save_strings('group_keys', list(self.keys))
+        writer.save_array('group_of', self.group_of)
+        writer.save_array('group_indptr', self.indptr)
+        writer.save_array('group_rows', self.rows)
+
+    @classmethod
+    def load(cls, version_dir, match=BEST_DEALS_MATCH):
+        """Load the groups of an artifact version, or None if it has none for this match mode"""
+        manifest = artifacts.read_manifest(version_dir)
+        if manifest.get('product_groups_match') != match or not artifacts.has_array(version_dir, 'group_of'):
+            return None
+        return cls(
+            artifacts.load_strings(version_dir, 'group_keys'),
+            artifacts.load_array(version_dir, 'group_of'),
+            artifacts.load_array(version_dir, 'group_indptr'),
+            artifacts.load_array(version_dir, 'group_rows'),
+            match
+        )
+
+
+class PatchedProductGroups(ProductGroups):
+    """Groups with rows renamed, repriced or added over trained ProductGroups.
+
+    The trained arrays are shared, not copied. Changed rows are skipped in
+    the groups they were trained into and merged, by price, into their
+    current group when it is read. Groups of new names are numbered after
+    the trained ones.
+    """
+
+    def __init__(self, base, new_keys, changed, added_members):
+        self.base = base
+        self.match = base.match
+        # Groups of names not seen in training, numbered from len(base.keys)
+        self.new_keys = new_keys
+        # Changed row -> its group, and group -> its changed rows
+        self.changed = changed
+        self.added_members = added_members
+        self.changed_rows = np.asarray(sorted(changed), dtype=np.int64)
+
+    @classmethod
+    def patch(cls, groups, rows, names):
+        if isinstance(groups, cls):
+            base, new_keys = groups.base, dict(groups.new_keys)
+            changed, added_members = dict(groups.changed), dict(groups.added_members)
+        else:
+            base, new_keys, changed, added_members = groups, {}, {}, {}
+        key_groups = base.key_groups()
+        for row, name in zip(rows, names):
+            row = int(row)
+            previous = changed.get(row, -1)
+            if previous >= 0:
+                added_members[previous] = added_members[previous] - {row}
+            key = normalize_name(name, base.match)
+            group = -1
+            if key is not None:
+                group = key_groups.get(key, new_keys.get(key, -1))
+                if group < 0:
+                    group = new_keys[key] = len(base.keys) + len(new_keys)
+            changed[row] = group
+            if group >= 0:
+                added_members[group] = added_members.get(group, frozenset()) | {row}
+        return cls(base, new_keys, changed, added_members)
+
+    def group(self, row):
+        group = self.changed.get(row)
+        return self.base.group(row) if group is None else group
+
+    def members(self, group, prices):
+        members = self.base.members(group, prices) if group < len(self.base.keys) else np.empty(0, dtype=np.int64)
+        members = members[~np.isin(members, self.changed_rows)]
+        added = self.added_members.get(group)
+        if added:
+            members = np.concatenate([members, sorted(added)]).astype(np.int64)
+            # By price, then row, like the trained groups
+            members = members[np.lexsort((members, prices[members]))]
+        return members
@@ -1,64 +1,23 @@
-import pandas as pd
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import joblib
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils.database import fetch_data
+from models.catalog import catalog_store
+from models.user_profiles import profile_store
+from models.embeddings import embedding_scores
+from utils.ranking import top_k_rows
+from utils.cache import get_cache
+from utils.metrics import stage
+
+# Anonymous home page results, invalidated when an order is paid
+popular_products_cache = get_cache('popular_products', ttl=60)
 
 class HomePageRecommendations:
-    def __init__(self):
-        self.vectorizer = TfidfVectorizer(max_features=100, stop_words='english')
-        self.product_vectors = None
-        self.products_df = None
-        self.base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        self.models_dir = os.path.join(self.base_dir, 'data', 'models')
+    def __init__(self, store=None, profiles=None):
+        self.store = store or catalog_store
+        self.profiles = profiles or profile_store
         
-    def load_products(self):
-        """Load products from saved models or database"""
-        vectorizer_path = os.path.join(self.models_dir, 'tfidf_vectorizer.pkl')
-        vectors_path = os.path.join(self.models_dir, 'product_vectors.pkl')
-        processed_path = os.path.join(self.models_dir, 'products_processed.pkl')
-
-        if os.path.exists(vectorizer_path) and os.path.exists(vectors_path) and os.path.exists(processed_path):
-            print("Loading pre-trained recommendation models...")
-            self.vectorizer = joblib.load(vectorizer_path)
-            self.product_vectors = joblib.load(vectors_path)
-            self.products_df = pd.read_pickle(processed_path)
-        else:
-            print("Saved models not found. Loading from database...")
-            query = """
-                SELECT p.id, p.name, p.description, p.price, p.shop_id, 
-                       s.name as shop_name, p.image_url
-                FROM products p
-                JOIN shops s ON p.shop_id = s.id
-            """
-            self.products_df = fetch_data(query)
-            
-            # Create content for vectorization
-            self.products_df['content'] = (
-                self.products_df['name'].fillna('') + ' ' + 
-                self.products_df['description'].fillna('')
-            )
-            
-            # Vectorize products
-            self.product_vectors = self.vectorizer.fit_transform(
-                self.products_df['content']
-            )
-    
-    def get_user_purchase_history(self, user_id):
-        """Get user's purchase history"""
-        query = """
-            SELECT DISTINCT oi.product_id, COUNT(*) as purchase_count
-            FROM order_items oi
-            JOIN orders o ON oi.order_id = o.id
-            WHERE o.user_id = %s AND o.payment_status = 'paid'
-            GROUP BY oi.product_id
-        """
-        return fetch_data(query, params=[user_id])
-    
     def get_user_cart_items(self, user_id):
         """Get user's current cart items"""
         query = """
@@ -68,56 +27,70 @@ class HomePageRecommendations:
         """
         return fetch_data(query, params=[user_id])
     
-    def recommend_for_user(self, user_id, limit=8):
-        """Get personalized recommendations for home page"""
-        if self.products_df is None:
-            self.load_products()
+    def recommend_for_user(self, user_id, limit=8, cart_product_ids=None):
+        """Get personalized recommendations for home page.
+
+        cart_product_ids, when the caller knows them, saves the cart query.
+        """
+        catalog = self.store.get()
         
-        # Get user purchase history
-        purchase_history = self.get_user_purchase_history(user_id)
+        # Purchases come from the user's profile rather than the database
+        profile = self.profiles.get(user_id)
         
-        if len(purchase_history) == 0:
+        if len(profile.purchased_ids) == 0:
             # No purchase history - return popular products
             return self.get_popular_products(limit)
         
         # Get user's purchased product IDs
-        purchased_product_ids = set(purchase_history['product_id'].tolist())
+        purchased_product_ids = set(profile.purchased_ids.tolist())
         
         # Get user's cart items to exclude
-        cart_items = self.get_user_cart_items(user_id)
-        cart_product_ids = set(cart_items['product_id'].tolist()) if len(cart_items) > 0 else set()
+        if cart_product_ids is None:
+            cart_items = self.get_user_cart_items(user_id)
+            cart_product_ids = cart_items['product_id'].tolist() if len(cart_items) > 0 else []
+        cart_product_ids = set(cart_product_ids)
         
         # Get vectors for purchased products
-        purchased_indices = self.products_df[
-            self.products_df['id'].isin(purchased_product_ids)
-        ].index.tolist()
+        purchased_indices = catalog.rows_of(purchased_product_ids)
         
         if len(purchased_indices) == 0:
             return self.get_popular_products(limit)
         
-        # Average vector of purchased products
-        user_vector = self.product_vectors[purchased_indices].mean(axis=0)
+        excluded_rows = catalog.rows_of(purchased_product_ids | cart_product_ids)
         
-        # Calculate similarity with all products
-        similarities = cosine_similarity(user_vector, self.product_vectors).flatten()
+        # Approximate search over the ANN index when train.py built one
+        if catalog.ann_index is not None:
+            user_vector = profile.vector
+            if user_vector is None:
+                user_vector = catalog.embeddings[purchased_indices].mean(axis=0)
+            norm = np.linalg.norm(user_vector)
+            if norm > 0:
+                with stage('score'):
+                    rows, scores = catalog.ann_index.query(user_vector / norm, limit, exclude_rows=excluded_rows)
+                return catalog.records(rows, 'similarity_score', scores)
         
-        # Create recommendations dataframe
-        recommendations = self.products_df.copy()
-        recommendations['similarity_score'] = similarities
+        # Calculate similarity of the purchased products' average with all products
+        with stage('score'):
+            if catalog.embeddings is not None:
+                user_vector = catalog.embeddings[purchased_indices].mean(axis=0)
+                similarities = embedding_scores(catalog.embeddings, user_vector / max(np.linalg.norm(user_vector), 1e-12))
+            else:
+                from sklearn.metrics.pairwise import cosine_similarity
+                user_vector = np.asarray(catalog.product_vectors[purchased_indices].mean(axis=0))
+                similarities = cosine_similarity(user_vector, catalog.product_vectors).ravel()
         
-        # Filter out already purchased and cart items
-        recommendations = recommendations[
-            ~recommendations['id'].isin(purchased_product_ids | cart_product_ids)
-        ]
+        # Top N, leaving out already purchased and cart items
+        rows = top_k_rows(similarities, limit, exclude_rows=excluded_rows)
         
-        # Sort by similarity and get top N
-        recommendations = recommendations.nlargest(limit, 'similarity_score')
-        
-        # Convert to list of dicts
-        return recommendations[['id', 'name', 'price', 'shop_name', 'image_url', 'similarity_score']].to_dict('records')
+        return catalog.records(rows, 'similarity_score', similarities[rows])
     
     def get_popular_products(self, limit=8):
-        """Get popular products based on purchase frequency"""
+        """Get popular products based on purchase frequency (cached, same for everyone)"""
+        return popular_products_cache.get_or_compute(
+            limit, lambda: self._fetch_popular_products(limit)
+        )
+    
+    def _fetch_popular_products(self, limit):
         query = """
             SELECT p.id, p.name, p.price, p.shop_id, 
                    s.name as shop_name, p.image_url,
@@ -130,7 +103,8 @@ class HomePageRecommendations:
             LIMIT %s
         """
         popular = fetch_data(query, params=[limit])
-        return popular.to_dict('records')
+        with stage('records'):
+            return popular.to_dict('records')
 
 
 
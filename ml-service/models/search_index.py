@@ -0,0 +1,414 @@
+import numpy as np
+from bisect import bisect_left
+import functools
+import re
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import artifacts
+from utils.artifacts import PatchedArray
+
+TOKEN_PATTERN = re.compile(r"\w+")
+# Most frequent vocabulary terms a trailing query prefix expands to
+MAX_PREFIX_EXPANSIONS = 50
+
+
+@functools.lru_cache(maxsize=1)
+def stop_words():
+    """scikit-learn's English stop words, imported on first use to keep startup fast"""
+    from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+    return ENGLISH_STOP_WORDS
+
+
+def tokenize(text):
+    """Lowercase word tokens of text without English stop words"""
+    if not isinstance(text, str):
+        return []
+    excluded = stop_words()
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in excluded]
+
+
+def normalize_query(query_text):
+    """(tokens, prefix) of a query, equal for queries differing only in case, spacing or stop words.
+
+    prefix tells whether the last token also matches as a prefix, which
+    a trailing space turns off.
+    """
+    tokens = tuple(tokenize(query_text))
+    return tokens, bool(tokens) and not query_text[-1:].isspace()
+
+
+def _posting_pairs(documents, doc_rows, term_ids):
+    """Sorted (term, row, count) arrays, one entry per distinct term of each document"""
+    rows, terms = [], []
+    for row, tokens in zip(doc_rows, documents):
+        rows.extend([row] * len(tokens))
+        terms.extend(term_ids[token] for token in tokens)
+    rows = np.asarray(rows, dtype=np.int64)
+    terms = np.asarray(terms, dtype=np.int64)
+
+    # Count each (term, row) pair once, sorted by term then row
+    stride = int(max(doc_rows, default=0)) + 1
+    pairs, counts = np.unique(terms * stride + rows, return_counts=True)
+    terms, rows = np.divmod(pairs, stride)
+    return terms, rows, counts
+
+
+def _indptr(terms, n_terms):
+    """CSR row pointers for postings sorted by term"""
+    indptr = np.zeros(n_terms + 1, dtype=np.int64)
+    np.cumsum(np.bincount(terms, minlength=n_terms), out=indptr[1:])
+    return indptr
+
+
+def _postings(documents, term_ids):
+    """CSR postings (indptr, rows, term frequencies) for tokenized documents"""
+    terms, rows, counts = _posting_pairs(documents, range(len(documents)), term_ids)
+    return _indptr(terms, len(term_ids)), rows.astype(np.int32), counts.astype(np.float32)
+
+
+class SearchIndex:
+    """Token -> postings inverted index over product names and descriptions.
+
+    Documents are catalog rows. Full-text postings carry term frequencies
+    for BM25 scoring; a second set of name-only postings drives name-match
+    boosting. The vocabulary is sorted so prefixes resolve with a bisect.
+    """
+
+    def __init__(self, vocabulary, indptr, rows, term_freqs, doc_lengths,
+                 name_indptr, name_rows, k1=1.2, b=0.75):
+        self.vocabulary = vocabulary
+        self.term_ids = {term: term_id for term_id, term in enumerate(vocabulary)}
+        self.indptr = indptr
+        self.rows = rows
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.name_indptr = name_indptr
+        self.name_rows = name_rows
+        self.k1 = k1
+        self.b = b
+
+        self.n_docs = len(doc_lengths)
+        self.avg_doc_length = float(doc_lengths.mean()) if self.n_docs else 0.0
+        doc_freqs = np.diff(indptr)
+        self.doc_freqs = doc_freqs
+        self.idf = np.log1p((self.n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+
+    @classmethod
+    def build(cls, names, descriptions):
+        """Index products given their names and descriptions in catalog order"""
+        name_tokens = [tokenize(name) for name in names]
+        documents = [
+            tokens + tokenize(description)
+            for tokens, description in zip(name_tokens, descriptions)
+        ]
+        vocabulary = sorted({token for tokens in documents for token in tokens})
+        term_ids = {term: term_id for term_id, term in enumerate(vocabulary)}
+
+        indptr, rows, term_freqs = _postings(documents, term_ids)
+        name_indptr, name_rows, _ = _postings(name_tokens, term_ids)
+        doc_lengths = np.asarray([len(tokens) for tokens in documents], dtype=np.float32)
+        return cls(vocabulary, indptr, rows, term_freqs, doc_lengths, name_indptr, name_rows)
+
+    def with_documents(self, rows, names, descriptions, n_docs, base_names, base_descriptions):
+        """A new index with the given rows (re)indexed, this one left as it is.
+
+        Only the changed documents are tokenized; rows at or past the
+        current document count are appended and n_docs is the new count.
+        base_names and base_descriptions are the columns this index was
+        built from. See PatchedSearchIndex.
+        """
+        return PatchedSearchIndex(self).with_documents(rows, names, descriptions, n_docs, base_names, base_descriptions)
+
+    def save(self, writer):
+        """Add the index arrays to an ArtifactWriter version"""
+        writer.save_strings('search_vocabulary', self.vocabulary)
+        writer.save_array('search_indptr', self.indptr)
+        writer.save_array('search_rows', self.rows)
+        writer.save_array('search_term_freqs', self.term_freqs)
+        writer.save_array('search_doc_lengths', self.doc_lengths)
+        writer.save_array('search_name_indptr', self.name_indptr)
+        writer.save_array('search_name_rows', self.name_rows)
+
+    @classmethod
+    def load(cls, version_dir):
+        """Load the index from an artifact version, or None if it has none"""
+        if not artifacts.has_array(version_dir, 'search_indptr'):
+            return None
+        return cls(
+            artifacts.load_strings(version_dir, 'search_vocabulary').to_list(),
+            artifacts.load_array(version_dir, 'search_indptr'),
+            artifacts.load_array(version_dir, 'search_rows'),
+            artifacts.load_array(version_dir, 'search_term_freqs'),
+            artifacts.load_array(version_dir, 'search_doc_lengths'),
+            artifacts.load_array(version_dir, 'search_name_indptr'),
+            artifacts.load_array(version_dir, 'search_name_rows'),
+        )
+
+    def term_id(self, token):
+        """Id of a vocabulary term, or None"""
+        return self.term_ids.get(token)
+
+    def term(self, term_id):
+        return self.vocabulary[term_id]
+
+    def term_doc_freqs(self, term_ids):
+        """Number of documents containing each term"""
+        return self.doc_freqs[term_ids]
+
+    def _prefix_range(self, prefix):
+        """Ids of the terms starting with prefix, in vocabulary order"""
+        start = bisect_left(self.vocabulary, prefix)
+        stop = bisect_left(self.vocabulary, prefix + '\uffff', lo=start)
+        return np.arange(start, stop)
+
+    def _term_postings(self, term_id):
+        """(rows, term frequencies) of the documents containing a term"""
+        start, stop = self.indptr[term_id], self.indptr[term_id + 1]
+        return self.rows[start:stop], self.term_freqs[start:stop]
+
+    def _name_postings(self, term_id):
+        """Rows whose name contains a term"""
+        return self.name_rows[self.name_indptr[term_id]:self.name_indptr[term_id + 1]]
+
+    def _idf(self, term_id):
+        return self.idf[term_id]
+
+    def prefix_terms(self, prefix, limit=MAX_PREFIX_EXPANSIONS):
+        """Ids of vocabulary terms starting with prefix, most frequent first"""
+        term_ids = self._prefix_range(prefix)
+        doc_freqs = self.term_doc_freqs(term_ids)
+        # Terms whose products were all edited away keep an empty postings list
+        term_ids, doc_freqs = term_ids[doc_freqs > 0], doc_freqs[doc_freqs > 0]
+        return term_ids[np.argsort(-doc_freqs, kind='stable')[:max(limit, 0)]]
+
+    def suggest(self, prefix, limit=10):
+        """Autocomplete terms for prefix with the number of products containing them"""
+        tokens = tokenize(prefix) or TOKEN_PATTERN.findall(prefix.lower())
+        if not tokens:
+            return []
+        term_ids = self.prefix_terms(tokens[-1], limit)
+        return [
+            {'term': self.term(term_id), 'product_count': int(doc_freq)}
+            for term_id, doc_freq in zip(term_ids, self.term_doc_freqs(term_ids))
+        ]
+
+    def query_terms(self, query_text, expand_prefix=True):
+        """Term id groups for a query; the last token also matches as a prefix.
+
+        Each group is the set of terms one query token may match.
+        query_text may also be a normalize_query() result.
+        """
+        tokens, prefix = query_text if isinstance(query_text, tuple) else normalize_query(query_text)
+        groups = []
+        for i, token in enumerate(tokens):
+            if expand_prefix and prefix and i == len(tokens) - 1:
+                term_ids = self.prefix_terms(token)
+            else:
+                term_id = self.term_id(token)
+                term_ids = np.asarray([] if term_id is None else [term_id], dtype=np.int64)
+            groups.append(term_ids)
+        return groups
+
+    def _term_scores(self, term_id):
+        """BM25 contribution of one term to each of its posting rows"""
+        rows, tf = self._term_postings(term_id)
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[rows] / self.avg_doc_length)
+        return rows, self._idf(term_id) * tf * (self.k1 + 1) / (tf + norm)
+
+    def score(self, groups):
+        """BM25 scores of every row matching at least one query group.
+
+        A row scores the best of the terms in each group, summed over
+        groups. Returns (rows, scores) with rows sorted ascending.
+        """
+        all_rows, all_scores = [], []
+        for term_ids in groups:
+            if len(term_ids) == 0:
+                continue
+            parts = [self._term_scores(term_id) for term_id in term_ids]
+            rows = np.concatenate([part[0] for part in parts])
+            scores = np.concatenate([part[1] for part in parts])
+            if len(term_ids) > 1:
+                order = np.argsort(rows, kind='stable')
+                rows, scores = rows[order], scores[order]
+                rows, starts = np.unique(rows, return_index=True)
+                scores = np.maximum.reduceat(scores, starts)
+            all_rows.append(rows)
+            all_scores.append(scores)
+
+        if not all_rows:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        rows, inverse = np.unique(np.concatenate(all_rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(all_scores))
+        return rows, scores
+
+    def name_match_rows(self, groups):
+        """Rows whose name contains a term of every query group"""
+        matched = None
+        for term_ids in groups:
+            rows = [self._name_postings(term_id) for term_id in term_ids]
+            rows = np.unique(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int32)
+            matched = rows if matched is None else np.intersect1d(matched, rows, assume_unique=True)
+            if len(matched) == 0:
+                break
+        return matched if matched is not None else np.empty(0, dtype=np.int32)
+
+
+class PatchedSearchIndex(SearchIndex):
+    """Documents added or re-indexed over a trained SearchIndex, which is left untouched.
+
+    The postings of changed rows are held in small dicts and their trained
+    postings are skipped when read. Document frequencies and the average
+    document length are corrected for what the changed rows gained or
+    lost, so scores are those of an index rebuilt over the current
+    documents. Terms not in the trained vocabulary get ids after it.
+    """
+
+    def __init__(self, base, new_terms=None, postings=None, name_postings=None, removed=None,
+                 documents=None, doc_lengths=None, total_length=None):
+        self.base = base
+        self.k1 = base.k1
+        self.b = base.b
+        # Terms missing from the trained vocabulary -> their ids
+        self.new_terms = new_terms or {}
+        self._new_vocabulary = sorted(self.new_terms)
+        self._new_term_names = {term_id: term for term, term_id in self.new_terms.items()}
+        # Term id -> {row: term frequency}, and term id -> rows with it in their name, for changed rows
+        self.postings = postings or {}
+        self.name_postings = name_postings or {}
+        # Term id -> trained documents that contained it and have changed since
+        self.removed = removed or {}
+        # Changed row -> (term ids, name term ids, length) of its current document
+        self.documents = documents or {}
+        self.changed_rows = np.asarray(sorted(self.documents), dtype=np.int64)
+
+        self.doc_lengths = doc_lengths if doc_lengths is not None else base.doc_lengths
+        self.n_docs = len(self.doc_lengths)
+        self.total_length = base.avg_doc_length * base.n_docs if total_length is None else total_length
+        self.avg_doc_length = self.total_length / self.n_docs if self.n_docs else 0.0
+        # Change of each term's document frequency since training, sorted by term id
+        terms = sorted(set(self.postings) | set(self.removed))
+        self._delta_terms = np.asarray(terms, dtype=np.int64)
+        self._delta_freqs = np.asarray(
+            [len(self.postings.get(term_id, ())) - self.removed.get(term_id, 0) for term_id in terms], dtype=np.int64
+        )
+
+    def with_documents(self, rows, names, descriptions, n_docs, base_names, base_descriptions):
+        rows = np.asarray(rows, dtype=np.int64)
+        base = self.base
+        new_terms = dict(self.new_terms)
+        postings, name_postings = dict(self.postings), dict(self.name_postings)
+        removed, documents = dict(self.removed), dict(self.documents)
+        total_length = self.total_length
+
+        def term_ids(tokens):
+            ids = []
+            for token in tokens:
+                term_id = base.term_ids.get(token, new_terms.get(token))
+                if term_id is None:
+                    term_id = new_terms[token] = len(base.vocabulary) + len(new_terms)
+                ids.append(term_id)
+            return ids
+
+        lengths = []
+        for row, name, description in zip(rows.tolist(), names, descriptions):
+            if row in documents:
+                # Changed before: drop the postings of its previous version
+                terms, name_terms, length = documents[row]
+                for term_id in terms:
+                    postings[term_id] = {other: freq for other, freq in postings[term_id].items() if other != row}
+                    if not postings[term_id]:
+                        del postings[term_id]
+                for term_id in name_terms:
+                    name_postings[term_id] = name_postings[term_id] - {row}
+                total_length -= length
+            elif row < base.n_docs:
+                # First change since training: its trained postings stop counting
+                trained = tokenize(base_names[row]) + tokenize(base_descriptions[row])
+                for term_id in {base.term_ids[token] for token in trained if token in base.term_ids}:
+                    removed[term_id] = removed.get(term_id, 0) + 1
+                total_length -= float(base.doc_lengths[row])
+
+            name_tokens = tokenize(name)
+            document = term_ids(name_tokens + tokenize(description))
+            counts = {}
+            for term_id in document:
+                counts[term_id] = counts.get(term_id, 0) + 1
+            for term_id, count in counts.items():
+                postings[term_id] = {**postings.get(term_id, {}), row: count}
+            name_terms = set(term_ids(name_tokens))
+            for term_id in name_terms:
+                name_postings[term_id] = name_postings.get(term_id, frozenset()) | {row}
+            documents[row] = (tuple(counts), tuple(name_terms), len(document))
+            total_length += len(document)
+            lengths.append(len(document))
+
+        doc_lengths = PatchedArray.patch(self.doc_lengths, rows, np.asarray(lengths, dtype=np.float32), n_docs)
+        return PatchedSearchIndex(base, new_terms, postings, name_postings, removed,
+                                  documents, doc_lengths, total_length)
+
+    def save(self, writer):
+        raise NotImplementedError("Only trained indexes are saved")
+
+    def term_id(self, token):
+        term_id = self.base.term_ids.get(token)
+        return self.new_terms.get(token) if term_id is None else term_id
+
+    def term(self, term_id):
+        if term_id < len(self.base.vocabulary):
+            return self.base.vocabulary[term_id]
+        return self._new_term_names[term_id]
+
+    def term_doc_freqs(self, term_ids):
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        trained = term_ids < len(self.base.vocabulary)
+        doc_freqs = np.zeros(len(term_ids), dtype=np.int64)
+        doc_freqs[trained] = self.base.doc_freqs[term_ids[trained]]
+        if len(self._delta_terms):
+            positions = np.minimum(np.searchsorted(self._delta_terms, term_ids), len(self._delta_terms) - 1)
+            found = self._delta_terms[positions] == term_ids
+            doc_freqs[found] += self._delta_freqs[positions[found]]
+        return doc_freqs
+
+    def _prefix_range(self, prefix):
+        term_ids = self.base._prefix_range(prefix)
+        start = bisect_left(self._new_vocabulary, prefix)
+        stop = bisect_left(self._new_vocabulary, prefix + '\uffff', lo=start)
+        if start == stop:
+            return term_ids
+        # New terms go where a rebuilt, sorted vocabulary would have them
+        new = self._new_vocabulary[start:stop]
+        positions = np.searchsorted(term_ids, [bisect_left(self.base.vocabulary, term) for term in new])
+        return np.insert(term_ids, positions, [self.new_terms[term] for term in new])
+
+    def _term_postings(self, term_id):
+        if term_id < len(self.base.vocabulary):
+            rows, term_freqs = self.base._term_postings(term_id)
+            if len(self.changed_rows):
+                kept = ~np.isin(rows, self.changed_rows)
+                rows, term_freqs = rows[kept], term_freqs[kept]
+        else:
+            rows, term_freqs = np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        changed = self.postings.get(term_id)
+        if changed:
+            rows = np.concatenate([rows, np.fromiter(changed.keys(), dtype=np.int64, count=len(changed))])
+            term_freqs = np.concatenate([
+                term_freqs, np.fromiter(changed.values(), dtype=np.float32, count=len(changed))
+            ])
+        return rows, term_freqs
+
+    def _name_postings(self, term_id):
+        rows = np.empty(0, dtype=np.int32)
+        if term_id < len(self.base.vocabulary):
+            rows = self.base._name_postings(term_id)
+            if len(self.changed_rows):
+                rows = rows[~np.isin(rows, self.changed_rows)]
+        changed = self.name_postings.get(term_id)
+        if changed:
+            rows = np.concatenate([rows, sorted(changed)]).astype(np.int64)
+        return rows
+
+    def _idf(self, term_id):
+        doc_freq = self.term_doc_freqs([term_id])[0]
+        return np.float32(np.log1p((self.n_docs - doc_freq + 0.5) / (doc_freq + 0.5)))
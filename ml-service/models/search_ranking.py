@@ -1,106 +1,110 @@
-import pandas as pd
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import joblib
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils.database import fetch_data
+from models.catalog import catalog_store
+from models.user_profiles import profile_store
+from models.search_index import normalize_query
+from utils.ranking import top_k_rows
+from utils.cache import get_cache
+from utils.metrics import stage
+
+# Normalized queries whose ranked products are kept, least recently used evicted first
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', 2048))
+# Largest limit answered from the cache, larger ones are scored every time
+SEARCH_CACHE_DEPTH = int(os.getenv('SEARCH_CACHE_DEPTH', 100))
+# Queries searched once the catalog is loaded, one per line; skipped when the file is missing
+SEARCH_HEAD_QUERIES = os.getenv('SEARCH_HEAD_QUERIES', os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'head_queries.txt'
+))
+
+# Relevance added to products whose name contains every query term
+NAME_MATCH_BOOST = 0.3
+# Relevance added to products of shops the user ordered from
+SHOP_BOOST = 0.1
+
+# Un-personalized ranking of each normalized query, keyed by catalog snapshot
+search_cache = get_cache('search', ttl=3600, maxsize=SEARCH_CACHE_SIZE)
 
 class SearchRanking:
-    def __init__(self):
-        self.vectorizer = TfidfVectorizer(max_features=100, stop_words='english')
-        self.product_vectors = None
-        self.products_df = None
-        self.base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        self.models_dir = os.path.join(self.base_dir, 'data', 'models')
-        
-    def load_products(self):
-        """Load products from saved models or database"""
-        vectorizer_path = os.path.join(self.models_dir, 'tfidf_vectorizer.pkl')
-        vectors_path = os.path.join(self.models_dir, 'product_vectors.pkl')
-        processed_path = os.path.join(self.models_dir, 'products_processed.pkl')
-
-        if os.path.exists(vectorizer_path) and os.path.exists(vectors_path) and os.path.exists(processed_path):
-            print("Loading pre-trained search models...")
-            self.vectorizer = joblib.load(vectorizer_path)
-            self.product_vectors = joblib.load(vectors_path)
-            self.products_df = pd.read_pickle(processed_path)
-            # Ensure search_content exists in the loaded dataframe
-            if 'search_content' not in self.products_df.columns:
-                self.products_df['search_content'] = (
-                    self.products_df['name'].fillna('') + ' ' + 
-                    self.products_df['description'].fillna('')
-                )
-        else:
-            print("Saved models not found. Loading from database...")
-            query = """
-                SELECT p.id, p.name, p.description, p.price, p.shop_id, 
-                       s.name as shop_name, p.image_url
-                FROM products p
-                JOIN shops s ON p.shop_id = s.id
-            """
-            self.products_df = fetch_data(query)
-            self.products_df['search_content'] = (
-                self.products_df['name'].fillna('') + ' ' + 
-                self.products_df['description'].fillna('')
-            )
-            self.product_vectors = self.vectorizer.fit_transform(
-                self.products_df['search_content']
-            )
-    
+    def __init__(self, store=None, profiles=None):
+        self.store = store or catalog_store
+        self.profiles = profiles or profile_store
+
     def search_products(self, query_text, limit=20, user_id=None):
-        """Search products with ML-based ranking"""
-        if self.products_df is None:
-            self.load_products()
-        
-        # Vectorize search query
-        query_vector = self.vectorizer.transform([query_text])
-        
-        # Calculate similarity
-        similarities = cosine_similarity(query_vector, self.product_vectors).flatten()
-        
-        # Create results
-        results = self.products_df.copy()
-        results['relevance_score'] = similarities
-        
-        # Boost score for exact name matches
-        results['name_match'] = results['name'].str.contains(
-            query_text, case=False, na=False
-        )
-        results['relevance_score'] = np.where(
-            results['name_match'],
-            results['relevance_score'] + 0.3,
-            results['relevance_score']
-        )
-        
+        """Search products with BM25 ranking over the inverted index"""
+        catalog = self.store.get()
+        query = normalize_query(query_text)
+        if limit <= SEARCH_CACHE_DEPTH:
+            rows, relevance = self.ranked(catalog, query)
+        else:
+            rows, relevance = self.score(catalog, query)
+        if len(rows) == 0:
+            return []
+        relevance = relevance.copy()
+
         # If user_id provided, boost products from shops user prefers
         if user_id:
-            user_shops_query = """
-                SELECT DISTINCT p.shop_id
-                FROM order_items oi
-                JOIN orders o ON oi.order_id = o.id
-                JOIN products p ON oi.product_id = p.id
-                WHERE o.user_id = %s AND o.payment_status = 'paid'
-            """
-            user_shops = fetch_data(user_shops_query, params=[user_id])
-            if len(user_shops) > 0:
-                preferred_shops = set(user_shops['shop_id'].tolist())
-                results['preferred_shop'] = results['shop_id'].isin(preferred_shops)
-                results['relevance_score'] = np.where(
-                    results['preferred_shop'],
-                    results['relevance_score'] + 0.1,
-                    results['relevance_score']
-                )
-        
+            preferred_shops = self.profiles.get(user_id).shop_ids
+            if len(preferred_shops) > 0:
+                relevance[np.isin(catalog.shop_ids[rows], preferred_shops)] += SHOP_BOOST
+
         # Sort by relevance
-        results = results.nlargest(limit, 'relevance_score')
-        
-        # Filter out zero relevance
-        results = results[results['relevance_score'] > 0]
-        
-        return results[['id', 'name', 'price', 'shop_name', 'image_url', 'relevance_score']].to_dict('records')
+        top = top_k_rows(relevance, limit)
+
+        return catalog.records(rows[top], 'relevance_score', relevance[top])
+
+    def score(self, catalog, query):
+        """(rows, relevance) of every product matching a normalized query, rows ascending"""
+        search_index = catalog.search_index
+
+        # Score only the products that match a query term
+        with stage('score'):
+            groups = search_index.query_terms(query)
+            rows, relevance = search_index.score(groups)
+            if len(rows) == 0:
+                return rows, relevance
+
+            # Scale BM25 to (0, 1] so the boosts keep their weight
+            relevance = relevance / relevance.max()
+
+            # Boost score for products whose name contains every query term
+            name_matched = search_index.name_match_rows(groups)
+            relevance[np.isin(rows, name_matched, assume_unique=True)] += NAME_MATCH_BOOST
+        return rows, relevance
+
+    def ranked(self, catalog, query):
+        """score() of a query cut to the products any limit up to SEARCH_CACHE_DEPTH can return.
+
+        Cached per catalog snapshot, so a refreshed or reloaded catalog
+        is never answered from the previous one. Products below the
+        SEARCH_CACHE_DEPTH-th relevance by more than SHOP_BOOST are
+        dropped: no personalization can lift them into the results.
+        """
+        return search_cache.get_or_compute((catalog.snapshot_id, query), lambda: self._ranked(catalog, query))
 
+    def _ranked(self, catalog, query):
+        rows, relevance = self.score(catalog, query)
+        if len(rows) > SEARCH_CACHE_DEPTH:
+            depth_score = np.partition(relevance, len(relevance) - SEARCH_CACHE_DEPTH)[-SEARCH_CACHE_DEPTH]
+            # The margin absorbs rounding of the boost
+            keep = relevance >= depth_score - SHOP_BOOST * 1.001
+            rows, relevance = rows[keep], relevance[keep]
+        return rows, relevance
 
+    def warm(self, queries=None):
+        """Cache the rankings of head queries (SEARCH_HEAD_QUERIES by default). Returns how many."""
+        if queries is None:
+            if not os.path.exists(SEARCH_HEAD_QUERIES):
+                return 0
+            with open(SEARCH_HEAD_QUERIES, encoding='utf-8') as f:
+                queries = [line.strip() for line in f if line.strip()]
+        catalog = self.store.get()
+        for query_text in queries:
+            self.ranked(catalog, normalize_query(query_text))
+        print(f"Search cache warmed with {len(queries)} head queries")
+        return len(queries)
 
+    def suggest_terms(self, prefix, limit=10):
+        """Autocomplete search terms starting with the last word of prefix"""
+        return self.store.get().search_index.suggest(prefix, limit)
@@ -1,61 +1,65 @@
-import pandas as pd
+import numpy as np
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils.database import fetch_data
+from models.catalog import catalog_store
+from models.user_profiles import profile_store
+from models.shop_stats import shop_stats_store
+from utils.cache import get_cache
+from utils.metrics import stage
+
+# Anonymous shop listing, invalidated when an order is paid
+shop_ranking_cache = get_cache('shop_ranking', ttl=60)
 
 class ShopRanking:
+    def __init__(self, store=None, profiles=None, shops=None):
+        self.store = store or catalog_store
+        self.profiles = profiles or profile_store
+        self.shops = shops or shop_stats_store
+    
     def get_personalized_shop_ranking(self, user_id):
         """Rank shops based on user preferences"""
-        # Get user's purchase history by shop
-        query = """
-            SELECT s.id, s.name, s.address, s.contact, s.logo,
-                   COUNT(DISTINCT o.id) as order_count,
-                   SUM(o.total_amount) as total_spent,
-                   AVG(o.total_amount) as avg_order_value
-            FROM shops s
-            LEFT JOIN products p ON s.id = p.shop_id
-            LEFT JOIN order_items oi ON p.id = oi.product_id
-            LEFT JOIN orders o ON oi.order_id = o.id AND o.user_id = %s
-            GROUP BY s.id, s.name, s.address, s.contact, s.logo
-            ORDER BY order_count DESC, total_spent DESC, s.name
-        """
-        
-        shops = fetch_data(query, params=[user_id])
+        stats = self.shops.get()
+        # The user's paid orders and spend per shop
+        profile = self.profiles.get(user_id)
         
-        # Calculate preference score
-        if len(shops) > 0:
-            max_orders = shops['order_count'].max() if shops['order_count'].max() > 0 else 1
-            max_spent = shops['total_spent'].max() if shops['total_spent'].max() > 0 else 1
+        with stage('score'):
+            order_count = np.zeros(len(stats), dtype=np.int64)
+            total_spent = np.zeros(len(stats), dtype=np.float64)
+            item_count = np.zeros(len(stats), dtype=np.int64)
+            positions, found = stats.positions(profile.shop_ids)
+            order_count[positions] = profile.shop_orders[found]
+            total_spent[positions] = profile.shop_spend[found]
+            item_count[positions] = profile.shop_items[found]
             
-            shops['preference_score'] = (
-                (shops['order_count'] / max_orders) * 0.5 +
-                (shops['total_spent'] / max_spent) * 0.5
-            )
-            shops = shops.sort_values('preference_score', ascending=False)
+            # Calculate preference score
+            max_orders = order_count.max() if len(stats) and order_count.max() > 0 else 1
+            max_spent = total_spent.max() if len(stats) and total_spent.max() > 0 else 1
+            preference_score = (order_count / max_orders) * 0.5 + (total_spent / max_spent) * 0.5
+            avg_order_value = np.full(len(stats), None, dtype=object)
+            # AVG(o.total_amount) over the order items, as the SQL computed it
+            ordered = item_count > 0
+            avg_order_value[ordered] = total_spent[ordered] / item_count[ordered]
+            
+            # Highest score first, then orders, spend and name
+            order = np.lexsort((stats.name_rank, -total_spent, -order_count, -preference_score))
         
-        return shops.to_dict('records')
+        return stats.records(
+            order, order_count=order_count, total_spent=total_spent,
+            avg_order_value=avg_order_value, preference_score=preference_score
+        )
     
     def get_all_shops_ranked(self, user_id=None):
         """Get all shops with ranking"""
         if user_id:
             return self.get_personalized_shop_ranking(user_id)
         
-        # Default ranking by popularity
-        query = """
-            SELECT s.id, s.name, s.address, s.contact, s.logo,
-                   COUNT(DISTINCT o.id) as order_count,
-                   COUNT(DISTINCT p.id) as product_count
-            FROM shops s
-            LEFT JOIN products p ON s.id = p.shop_id
-            LEFT JOIN order_items oi ON p.id = oi.product_id
-            LEFT JOIN orders o ON oi.order_id = o.id AND o.payment_status = 'paid'
-            GROUP BY s.id, s.name, s.address, s.contact, s.logo
-            ORDER BY order_count DESC, product_count DESC, s.name
-        """
-        
-        shops = fetch_data(query)
-        return shops.to_dict('records')
-
-
-
+        # Default ranking by popularity, the same for every anonymous user
+        return shop_ranking_cache.get_or_compute('all', self._rank_popular_shops)
+    
+    def _rank_popular_shops(self):
+        stats = self.shops.get()
+        with stage('score'):
+            product_count = stats.product_counts(self.store.get())
+            order = np.lexsort((stats.name_rank, -product_count, -stats.order_counts))
+        return stats.records(order, order_count=stats.order_counts, product_count=product_count)
@@ -0,0 +1,229 @@
+import pandas as pd
+import numpy as np
+import threading
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.database import fetch_data
+from utils import artifacts
+from utils.background import run_periodically
+from utils import metrics
+from utils.singleflight import SingleFlight
+from utils import cache
+from models.catalog import catalog_store
+
+# Seconds between reloads of the shop list (names, addresses, new shops), 0 disables them
+SHOP_REFRESH_INTERVAL = float(os.getenv('SHOP_REFRESH_INTERVAL', 60))
+
+# Shop fields returned with every listing
+SHOP_FIELDS = ('name', 'address', 'contact', 'logo')
+
+SHOPS_QUERY = "SELECT id, name, address, contact, logo FROM shops ORDER BY id"
+# Paid orders holding products of each shop, for a service without trained stats
+SHOP_ORDERS_COLUMNS = """
+    SELECT p.shop_id, COUNT(DISTINCT o.id) as order_count
+    FROM order_items oi
+    JOIN orders o ON oi.order_id = o.id
+    JOIN products p ON oi.product_id = p.id
+    WHERE o.payment_status = 'paid'
+"""
+SHOP_ORDERS_QUERY = SHOP_ORDERS_COLUMNS + """
+    GROUP BY p.shop_id
+"""
+# The same, limited to the orders the training run of an artifact version saw
+TRAINED_SHOP_ORDERS_QUERY = SHOP_ORDERS_COLUMNS + """
+      AND o.id <= %s AND o.id <> ALL(%s)
+    GROUP BY p.shop_id
+"""
+
+
+def order_counts_by_shop(items):
+    """shop_id -> number of distinct orders among order items (order_id, shop_id)"""
+    pairs = items[['order_id', 'shop_id']].drop_duplicates()
+    return pairs.groupby('shop_id').size()
+
+
+class ShopStats:
+    """Every shop's listing fields and paid order count, in arrays sorted by shop id.
+
+    Order counts hold the distinct paid orders with an item of the shop,
+    like COUNT(DISTINCT o.id) over the shops/products/orders join, and grow
+    as new paid orders are added. Product counts come from the catalog.
+    """
+
+    def __init__(self, shop_ids, fields, order_counts):
+        self.shop_ids = np.asarray(shop_ids, dtype=np.int64)
+        self.fields = fields
+        self.order_counts = np.asarray(order_counts, dtype=np.int64)
+        # Rank of every shop's name, for ties broken by name like ORDER BY s.name
+        names = np.array([name or '' for name in fields['name']], dtype=object)
+        self.name_rank = np.empty(len(names), dtype=np.int64)
+        self.name_rank[np.argsort(names, kind='stable')] = np.arange(len(names))
+
+    def __len__(self):
+        return len(self.shop_ids)
+
+    @classmethod
+    def from_dataframe(cls, shops_df, order_counts=None):
+        """Stats over a SHOPS_QUERY DataFrame, with order counts as a shop_id Series"""
+        shops_df = shops_df.sort_values('id')
+        shop_ids = shops_df['id'].to_numpy(dtype=np.int64)
+        fields = {
+            field: [value if isinstance(value, str) else None for value in shops_df[field]]
+            if field in shops_df else [None] * len(shops_df)
+            for field in SHOP_FIELDS
+        }
+        counts = np.zeros(len(shop_ids), dtype=np.int64)
+        if order_counts is not None:
+            counts = order_counts.reindex(shop_ids, fill_value=0).to_numpy(dtype=np.int64)
+        return cls(shop_ids, fields, counts)
+
+    @classmethod
+    def build(cls, shops_df, orders_df, product_ids, product_shop_ids):
+        """Stats from the exported shops and paid order items (order_id, product_id).
+
+        Items of products outside the catalog are dropped, like the
+        products join of the SQL query.
+        """
+        order_counts = None
+        if orders_df is not None:
+            shop_of = pd.Series(np.asarray(product_shop_ids), index=np.asarray(product_ids))
+            items = orders_df[orders_df['product_id'].isin(shop_of.index)]
+            items = pd.DataFrame({
+                'order_id': items['order_id'].to_numpy(),
+                'shop_id': shop_of.loc[items['product_id']].to_numpy(),
+            })
+            order_counts = order_counts_by_shop(items)
+        return cls.from_dataframe(shops_df, order_counts)
+
+    def positions(self, shop_ids):
+        """Positions of shop_ids in the stats, and the mask of those found"""
+        shop_ids = np.asarray(shop_ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.shop_ids, shop_ids), max(len(self) - 1, 0))
+        found = self.shop_ids[positions] == shop_ids if len(self) else np.zeros(len(shop_ids), dtype=bool)
+        return positions[found], found
+
+    def with_orders(self, items):
+        """Stats with newly paid order items (order_id, shop_id) counted"""
+        counts = order_counts_by_shop(items)
+        positions, found = self.positions(counts.index.to_numpy())
+        order_counts = self.order_counts.copy()
+        order_counts[positions] += counts.to_numpy()[found]
+        return ShopStats(self.shop_ids, self.fields, order_counts)
+
+    def with_shops(self, shops_df):
+        """Stats over the current shop list, keeping the counts of shops already known"""
+        return ShopStats.from_dataframe(shops_df, pd.Series(self.order_counts, index=self.shop_ids))
+
+    def product_counts(self, catalog):
+        """Catalog products of every shop"""
+        positions, _ = self.positions(catalog.shop_ids)
+        return np.bincount(positions, minlength=len(self))
+
+    def records(self, positions, **columns):
+        """Result dicts for the shops at positions, with extra per-shop columns"""
+        with metrics.stage('records'):
+            results = []
+            for position in positions:
+                record = {'id': int(self.shop_ids[position])}
+                for field in SHOP_FIELDS:
+                    record[field] = self.fields[field][position]
+                for name, column in columns.items():
+                    value = column[position]
+                    record[name] = value.item() if isinstance(value, np.generic) else value
+                results.append(record)
+            return results
+
+    def save(self, writer):
+        """Add the stats to an ArtifactWriter version"""
+        writer.save_array('shops_id', self.shop_ids)
+        writer.save_array('shops_order_count', self.order_counts)
+        for field in SHOP_FIELDS:
+            writer.save_strings(f"shops_{field}", self.fields[field])
+
+    @classmethod
+    def load(cls, version_dir):
+        """Load the stats from an artifact version, or None if it has none"""
+        if not artifacts.has_array(version_dir, 'shops_id'):
+            return None
+        return cls(
+            np.array(artifacts.load_array(version_dir, 'shops_id')),
+            {field: artifacts.load_strings(version_dir, f"shops_{field}").to_list() for field in SHOP_FIELDS},
+            np.array(artifacts.load_array(version_dir, 'shops_order_count'))
+        )
+
+
+class ShopStatsStore:
+    """Holds the ShopStats served by the shop listings.
+
+    Loaded from the trained artifacts, or aggregated once from the database
+    without them. Paid orders are added by the user profile refresh, which
+    already fetches them, and the shop list is reloaded every
+    SHOP_REFRESH_INTERVAL seconds.
+    """
+
+    def __init__(self, store=None):
+        self.store = store or catalog_store
+        self._stats = None
+        self._lock = threading.Lock()
+        # Loads of concurrent first uses, run once
+        self._flight = SingleFlight('shop_stats')
+        self._refresher = None
+
+    def load(self):
+        """Load the stats of the current artifact version, or aggregate them from the database"""
+        version_dir = artifacts.current_version_dir(self.store.models_dir)
+        with metrics.MODEL_LOAD_SECONDS.labels('shop_stats').time():
+            stats = ShopStats.load(version_dir) if version_dir is not None else None
+            if stats is None:
+                watermark = artifacts.read_manifest(version_dir).get('orders_watermark') if version_dir else None
+                if watermark is not None:
+                    # Orders after the training run are added by the profile refresh
+                    counts = fetch_data(TRAINED_SHOP_ORDERS_QUERY,
+                                        params=[watermark['last_order_id'], watermark['unpaid_order_ids']])
+                else:
+                    counts = fetch_data(SHOP_ORDERS_QUERY)
+                stats = ShopStats.from_dataframe(
+                    fetch_data(SHOPS_QUERY), counts.set_index('shop_id')['order_count']
+                )
+        with self._lock:
+            self._stats = stats
+        print(f"Shop stats loaded for {len(stats)} shops")
+        return stats
+
+    def get(self):
+        """Return the current stats, loading them on first use"""
+        stats = self._stats
+        if stats is None:
+            stats = self._flight.do('load', lambda: self._stats if self._stats is not None else self.load())
+        return stats
+
+    def add_orders(self, items):
+        """Count newly paid order items (order_id, shop_id).
+
+        Rankings this worker cached from the older counts are dropped; every
+        worker runs this from its own profile refresh.
+        """
+        if items.empty or self._stats is None:
+            return
+        with self._lock:
+            self._stats = self._stats.with_orders(items)
+        cache.invalidate_local('popular_products', 'shop_ranking')
+
+    def refresh(self):
+        """Reload the shop list, keeping the order counts. Returns the number of shops."""
+        shops_df = fetch_data(SHOPS_QUERY)
+        with self._lock:
+            if self._stats is not None:
+                self._stats = self._stats.with_shops(shops_df)
+        return len(shops_df)
+
+    def start_auto_refresh(self, interval=SHOP_REFRESH_INTERVAL):
+        """Reload the shop list every interval seconds in a daemon thread"""
+        if interval <= 0 or (self._refresher is not None and self._refresher.is_alive()):
+            return
+        self._refresher = run_periodically('Shop list refresh', interval, self.refresh)
+
+
+# Shared by every model class in the process
+shop_stats_store = ShopStatsStore()
@@ -1,51 +1,26 @@
-import pandas as pd
-import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import joblib
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils.database import fetch_data
+from models.catalog import catalog_store
+from models.embeddings import embedding_scores
+from utils.ranking import top_k_rows
+from utils.metrics import stage
 
 class ProductSimilarity:
-    def __init__(self):
-        self.vectorizer = TfidfVectorizer(max_features=100, stop_words='english')
-        self.product_vectors = None
-        self.products_df = None
-        self.base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        self.models_dir = os.path.join(self.base_dir, 'data', 'models')
-        
-    def load_products(self):
-        """Load products from saved models or database"""
-        vectorizer_path = os.path.join(self.models_dir, 'tfidf_vectorizer.pkl')
-        vectors_path = os.path.join(self.models_dir, 'product_vectors.pkl')
-        processed_path = os.path.join(self.models_dir, 'products_processed.pkl')
-
-        if os.path.exists(vectorizer_path) and os.path.exists(vectors_path) and os.path.exists(processed_path):
-            print("Loading pre-trained similarity models...")
-            self.vectorizer = joblib.load(vectorizer_path)
-            self.product_vectors = joblib.load(vectors_path)
-            self.products_df = pd.read_pickle(processed_path)
-        else:
-            print("Saved models not found. Loading from database...")
-            query = """
-                SELECT p.id, p.name, p.description, p.price, p.shop_id, 
-                       s.name as shop_name, p.image_url
-                FROM products p
-                JOIN shops s ON p.shop_id = s.id
-            """
-            self.products_df = fetch_data(query)
-            self.products_df['content'] = (
-                self.products_df['name'].fillna('') + ' ' + 
-                self.products_df['description'].fillna('')
-            )
-            self.product_vectors = self.vectorizer.fit_transform(
-                self.products_df['content']
-            )
+    def __init__(self, store=None):
+        self.store = store or catalog_store
     
     def get_customers_also_bought(self, product_id, limit=5):
         """Get products frequently bought together"""
+        catalog = self.store.get()
+        product_idx = catalog.row_of(product_id)
+        
+        # Answer from the precomputed co-purchase matrix when available
+        if catalog.copurchase is not None and product_idx is not None:
+            rows, counts = catalog.top_copurchased([product_idx], limit)
+            return catalog.copurchase_records(rows, 'co_purchase_count', counts)
+        
         query = """
             SELECT oi2.product_id, COUNT(*) as co_purchase_count,
                    p.name, p.price, p.shop_id, s.name as shop_name, p.image_url
@@ -62,36 +37,78 @@ class ProductSimilarity:
             LIMIT %s
         """
         result = fetch_data(query, params=[product_id, product_id, limit])
-        return result.to_dict('records')
+        with stage('records'):
+            return result.to_dict('records')
+    
+    def similarities(self, catalog, rows):
+        """Similarity of every product to each of rows, one row of scores each.
+
+        Dot products of the unit-length embeddings, or cosine of the TF-IDF
+        vectors for catalogs without embeddings.
+        """
+        if catalog.embeddings is not None:
+            return embedding_scores(catalog.embeddings, catalog.embeddings[rows]).T
+        from sklearn.metrics.pairwise import cosine_similarity
+        return cosine_similarity(catalog.product_vectors[rows], catalog.product_vectors)
     
     def get_similar_products(self, product_id, limit=5):
         """Get similar products based on content similarity"""
-        if self.products_df is None:
-            self.load_products()
+        catalog = self.store.get()
+        # A negative limit asks for nothing rather than slicing from the end
+        limit = max(int(limit), 0)
         
         # Find product index
-        product_idx = self.products_df[self.products_df['id'] == product_id].index
+        product_idx = catalog.row_of(product_id)
         
-        if len(product_idx) == 0:
+        if product_idx is None:
             return []
         
-        product_idx = product_idx[0]
+        # Answer from the precomputed neighbour table when it is deep enough
+        if catalog.has_neighbours(product_idx) and limit <= catalog.similar_ids.shape[1]:
+            neighbour_ids = catalog.similar_ids[product_idx, :limit]
+            neighbour_scores = catalog.similar_scores[product_idx, :limit]
+            found = neighbour_ids >= 0
+            return catalog.records(
+                catalog.rows_of(neighbour_ids[found]), 'similarity_score', neighbour_scores[found]
+            )
         
         # Get similarity scores
-        similarities = cosine_similarity(
-            self.product_vectors[product_idx:product_idx+1],
-            self.product_vectors
-        ).flatten()
-        
-        # Create results
-        similar = self.products_df.copy()
-        similar['similarity_score'] = similarities
+        with stage('score'):
+            similarities = self.similarities(catalog, [product_idx])[0]
         
-        # Filter out the current product and get top N
-        similar = similar[similar['id'] != product_id]
-        similar = similar.nlargest(limit, 'similarity_score')
+        # Top N, leaving out the current product
+        rows = top_k_rows(similarities, limit, exclude_rows=[product_idx])
         
-        return similar[['id', 'name', 'price', 'shop_name', 'image_url', 'similarity_score']].to_dict('records')
-
-
+        return catalog.records(rows, 'similarity_score', similarities[rows])
+    
+    def get_similar_products_batch(self, product_ids, limit=5):
+        """Similar products for many ids at once, one result list per id.
 
+        Products covered by the precomputed table are looked up; the rest
+        (including products added or edited since training) are scored
+        together with a single similarity matrix product.
+        """
+        catalog = self.store.get()
+        limit = max(int(limit), 0)
+        results = [[] for _ in product_ids]
+        use_table = catalog.similar_ids is not None and limit <= catalog.similar_ids.shape[1]
+        
+        pending = []
+        for i, product_id in enumerate(product_ids):
+            product_idx = catalog.row_of(product_id)
+            if product_idx is None:
+                continue
+            if use_table and catalog.has_neighbours(product_idx):
+                results[i] = self.get_similar_products(product_id, limit)
+            else:
+                pending.append((i, product_idx))
+        
+        if pending:
+            rows = [product_idx for _, product_idx in pending]
+            with stage('score'):
+                similarities = self.similarities(catalog, rows)
+            for (i, product_idx), scores in zip(pending, similarities):
+                top = top_k_rows(scores, limit, exclude_rows=[product_idx])
+                results[i] = catalog.records(top, 'similarity_score', scores[top])
+        
+        return results
@@ -0,0 +1,333 @@
+import pandas as pd
+import numpy as np
+from scipy import sparse
+import threading
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.database import fetch_data
+from utils import artifacts
+from utils.cache import get_cache
+from utils.singleflight import SingleFlight
+from utils.background import run_periodically
+from utils import metrics
+from models.catalog import catalog_store, REFRESH_INTERVAL
+from models.shop_stats import shop_stats_store
+
+# Profiles held in memory besides the training-time table
+USER_PROFILE_CACHE_SIZE = int(os.getenv('USER_PROFILE_CACHE_SIZE', 10000))
+
+# Paid order items with the order total and the product's shop
+ORDER_ITEMS_COLUMNS = """
+    SELECT o.user_id, o.id as order_id, o.total_amount, oi.product_id, p.shop_id
+    FROM order_items oi
+    JOIN orders o ON oi.order_id = o.id
+    JOIN products p ON oi.product_id = p.id
+"""
+USER_ORDER_ITEMS_QUERY = ORDER_ITEMS_COLUMNS + """
+    WHERE o.user_id = %s AND o.payment_status = 'paid'
+"""
+# Paid orders after the order id watermark, plus earlier orders that were still unpaid
+NEW_ORDER_ITEMS_QUERY = ORDER_ITEMS_COLUMNS + """
+    WHERE o.payment_status = 'paid'
+      AND (o.id > %s OR o.id = ANY(%s))
+"""
+UNPAID_ORDERS_QUERY = """
+    SELECT id FROM orders
+    WHERE payment_status <> 'paid' AND id <= %s
+"""
+LAST_ORDER_QUERY = "SELECT COALESCE(MAX(id), 0) as id FROM orders"
+
+# Arrays of a UserProfileTable, saved as profile_<name>
+TABLE_ARRAYS = ('user_ids', 'vectors', 'purchased_indptr', 'purchased_ids',
+                'shop_indptr', 'shop_ids', 'shop_orders', 'shop_spend', 'shop_items')
+
+
+def mean_vector(catalog, product_ids):
+    """Mean embedding of the catalog products among product_ids, or None"""
+    if catalog.embeddings is None:
+        return None
+    rows = catalog.rows_of(product_ids)
+    if not rows:
+        return None
+    return catalog.embeddings[rows].mean(axis=0).astype(np.float32)
+
+
+def shop_totals(items, *keys):
+    """Distinct orders, summed order totals and items with a total, per keys.
+
+    Like COUNT(DISTINCT o.id), SUM(o.total_amount) and the row count behind
+    AVG(o.total_amount) over the order items joined to their orders.
+    """
+    return items.groupby(list(keys)).agg(
+        orders=('order_id', 'nunique'), spend=('total_amount', 'sum'), items=('total_amount', 'count')
+    ).reset_index()
+
+
+def _indptr(codes, n):
+    """CSR row pointers for entries sorted by row code"""
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=n), out=indptr[1:])
+    return indptr
+
+
+class UserProfile:
+    """One user's paid purchases: product ids, mean product vector, orders and spend per shop.
+
+    Shop spend sums the order total once per item of the shop, like the
+    shop ranking SQL, and shop_items counts those items, so spend / items
+    is the SQL's AVG(total_amount). order_ids are the orders folded in
+    after training.
+    """
+
+    def __init__(self, purchased_ids, vector, shop_ids, shop_orders, shop_spend, shop_items,
+                 order_ids=frozenset()):
+        self.purchased_ids = purchased_ids
+        self.vector = vector
+        self.shop_ids = shop_ids
+        self.shop_orders = shop_orders
+        self.shop_spend = shop_spend
+        self.shop_items = shop_items
+        self.order_ids = order_ids
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, dtype=np.int64), None, np.empty(0, dtype=np.int64),
+                   np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int32))
+
+    def with_orders(self, items, catalog):
+        """Profile with paid order items added, skipping orders it already holds.
+
+        items has order_id, total_amount, product_id and shop_id columns.
+        """
+        items = items[~items['order_id'].isin(self.order_ids)]
+        if items.empty:
+            return self
+        items = items.assign(total_amount=items['total_amount'].astype(float))
+
+        purchased_ids = np.union1d(self.purchased_ids, items['product_id'].to_numpy(dtype=np.int64))
+        shops = pd.concat([
+            pd.DataFrame({'shop_id': self.shop_ids, 'orders': self.shop_orders,
+                          'spend': self.shop_spend, 'items': self.shop_items}),
+            shop_totals(items, 'shop_id'),
+        ]).groupby('shop_id', as_index=False).sum()
+        return UserProfile(
+            purchased_ids, mean_vector(catalog, purchased_ids),
+            shops['shop_id'].to_numpy(dtype=np.int64),
+            shops['orders'].to_numpy(dtype=np.int32),
+            shops['spend'].to_numpy(dtype=np.float64),
+            shops['items'].to_numpy(dtype=np.int32),
+            self.order_ids | frozenset(items['order_id'].tolist())
+        )
+
+
+class UserProfileTable:
+    """Profiles of every user with paid orders at training time, in flat arrays.
+
+    Users are sorted by id; purchased ids and per-shop stats are CSR-style
+    slices and mean vectors one row per user, so the table memory-maps.
+    """
+
+    def __init__(self, user_ids, vectors, purchased_indptr, purchased_ids,
+                 shop_indptr, shop_ids, shop_orders, shop_spend, shop_items):
+        self.user_ids = user_ids
+        self.vectors = vectors
+        self.purchased_indptr = purchased_indptr
+        self.purchased_ids = purchased_ids
+        self.shop_indptr = shop_indptr
+        self.shop_ids = shop_ids
+        self.shop_orders = shop_orders
+        self.shop_spend = shop_spend
+        self.shop_items = shop_items
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    @classmethod
+    def build(cls, orders_df, product_ids, product_shop_ids, embeddings):
+        """Table from paid order items (user_id, order_id, product_id, total_amount).
+
+        Items of products outside the catalog are dropped, like the
+        products join of the SQL queries.
+        """
+        row_of = pd.Series(np.arange(len(product_ids)), index=product_ids)
+        items = orders_df[orders_df['product_id'].isin(row_of.index)]
+        rows = row_of.loc[items['product_id']].to_numpy()
+        items = items.assign(
+            row=rows, shop_id=np.asarray(product_shop_ids)[rows],
+            total_amount=items['total_amount'].astype(float)
+        )
+        user_ids = np.unique(items['user_id'].to_numpy(dtype=np.int64))
+
+        purchases = items[['user_id', 'product_id', 'row']].drop_duplicates(['user_id', 'product_id'])
+        purchases = purchases.sort_values(['user_id', 'product_id'])
+        purchase_users = np.searchsorted(user_ids, purchases['user_id'].to_numpy())
+        purchased_indptr = _indptr(purchase_users, len(user_ids))
+
+        # Mean embedding of each user's distinct purchases
+        incidence = sparse.csr_matrix(
+            (np.ones(len(purchases), dtype=np.float32), (purchase_users, purchases['row'].to_numpy())),
+            shape=(len(user_ids), len(product_ids))
+        )
+        counts = np.maximum(np.diff(purchased_indptr), 1)[:, None]
+        vectors = (np.asarray(incidence @ embeddings) / counts).astype(np.float32)
+
+        shops = shop_totals(items, 'user_id', 'shop_id')
+        shop_indptr = _indptr(np.searchsorted(user_ids, shops['user_id'].to_numpy()), len(user_ids))
+
+        return cls(
+            user_ids, vectors, purchased_indptr,
+            purchases['product_id'].to_numpy(dtype=np.int64),
+            shop_indptr, shops['shop_id'].to_numpy(dtype=np.int64),
+            shops['orders'].to_numpy(dtype=np.int32), shops['spend'].to_numpy(dtype=np.float64),
+            shops['items'].to_numpy(dtype=np.int32)
+        )
+
+    def save(self, writer):
+        """Add the table arrays to an ArtifactWriter version"""
+        for name in TABLE_ARRAYS:
+            writer.save_array(f"profile_{name}", getattr(self, name))
+
+    @classmethod
+    def load(cls, version_dir):
+        """Load the table from an artifact version, or None if it has none"""
+        if not artifacts.has_array(version_dir, 'profile_user_ids'):
+            return None
+        # Tables trained before item counts were saved average over orders instead
+        names = [name if artifacts.has_array(version_dir, f"profile_{name}") else 'shop_orders'
+                 for name in TABLE_ARRAYS]
+        return cls(*(artifacts.load_array(version_dir, f"profile_{name}") for name in names))
+
+    def profile(self, user_id):
+        """UserProfile of user_id, or None if they had no paid orders"""
+        position = np.searchsorted(self.user_ids, user_id)
+        if position == len(self.user_ids) or self.user_ids[position] != user_id:
+            return None
+        purchased = slice(self.purchased_indptr[position], self.purchased_indptr[position + 1])
+        shops = slice(self.shop_indptr[position], self.shop_indptr[position + 1])
+        return UserProfile(
+            self.purchased_ids[purchased], self.vectors[position],
+            self.shop_ids[shops], self.shop_orders[shops], self.shop_spend[shops], self.shop_items[shops]
+        )
+
+
+class UserProfileStore:
+    """User profiles for the personalized endpoints, without per-request queries.
+
+    Users are read from the training-time table. Orders paid since are
+    folded in by refresh() (run in the background and on the order-paid
+    event) into profiles kept in an LRU cache, and counted in the shop
+    stats. Users it cannot answer for (evicted after a change, or no table)
+    are loaded from the database once.
+    """
+
+    def __init__(self, store=None, shops=None):
+        self.store = store or catalog_store
+        self.shops = shops or shop_stats_store
+        self._table = None
+        self._loaded = False
+        # (last order id, ids of earlier orders still unpaid) already applied
+        self._watermark = None
+        # Users whose table entry no longer matches their orders
+        self._changed_users = set()
+        self._profiles = get_cache('user_profiles', ttl=float('inf'), maxsize=USER_PROFILE_CACHE_SIZE)
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        # The table load and database lookups of a user, once for concurrent callers
+        self._flight = SingleFlight('user_profiles')
+        self._refresher = None
+
+    def load(self):
+        """Load the profile table of the current artifact version"""
+        version_dir = artifacts.current_version_dir(self.store.models_dir)
+        table, watermark = None, None
+        with metrics.MODEL_LOAD_SECONDS.labels('user_profiles').time():
+            if version_dir is not None:
+                table = UserProfileTable.load(version_dir)
+                watermark = artifacts.read_manifest(version_dir).get('orders_watermark')
+        with self._lock:
+            self._table = table
+            self._watermark = None
+            if table is not None and watermark is not None:
+                self._watermark = (watermark['last_order_id'], watermark['unpaid_order_ids'])
+            self._changed_users = set()
+            self._profiles.invalidate()
+            self._loaded = True
+        print(f"User profiles loaded for {len(table) if table is not None else 0} users")
+        return table
+
+    def _get_table(self):
+        if not self._loaded:
+            self._flight.do('table', lambda: self._table if self._loaded else self.load())
+        return self._table
+
+    def get(self, user_id):
+        """Profile of user_id, empty if they have no paid orders"""
+        user_id = int(user_id)
+        profile = self._profiles.get(user_id)
+        if profile is not None:
+            return profile
+
+        table = self._get_table()
+        # With a table kept current by refresh(), unchanged users are exactly their entry
+        if table is not None and self._watermark is not None and user_id not in self._changed_users:
+            profile = table.profile(user_id)
+            return profile if profile is not None else UserProfile.empty()
+
+        return self._flight.do(('user', user_id), lambda: self._load_user(user_id))
+
+    def _load_user(self, user_id):
+        """Profile of user_id from their paid orders in the database, cached"""
+        profile = UserProfile.empty().with_orders(
+            fetch_data(USER_ORDER_ITEMS_QUERY, params=[user_id]), self.store.get()
+        )
+        self._profiles.set(user_id, profile)
+        return profile
+
+    def refresh(self):
+        """Fold orders paid since the last refresh into the affected profiles.
+
+        Returns the number of orders applied.
+        """
+        with self._refresh_lock, metrics.MODEL_REFRESH_SECONDS.labels('user_profiles').time():
+            table = self._get_table()
+            if self._watermark is None:
+                # No table to bring up to date: start from the current orders
+                last_order_id = int(fetch_data(LAST_ORDER_QUERY)['id'].iloc[0])
+                unpaid = fetch_data(UNPAID_ORDERS_QUERY, params=[last_order_id])['id'].tolist()
+                self._watermark = (last_order_id, unpaid)
+                return 0
+
+            last_order_id, unpaid = self._watermark
+            items = fetch_data(NEW_ORDER_ITEMS_QUERY, params=[last_order_id, unpaid])
+            if not items.empty:
+                last_order_id = max(last_order_id, int(items['order_id'].max()))
+            unpaid = fetch_data(UNPAID_ORDERS_QUERY, params=[last_order_id])['id'].tolist()
+            self.shops.add_orders(items)
+
+            catalog = self.store.get()
+            for user_id, user_items in items.groupby('user_id'):
+                user_id = int(user_id)
+                profile = self._profiles.get(user_id)
+                if profile is None:
+                    if table is None or user_id in self._changed_users:
+                        # Loaded from the database, orders included, when next needed
+                        continue
+                    profile = table.profile(user_id)
+                    if profile is None:
+                        profile = UserProfile.empty()
+                self._profiles.set(user_id, profile.with_orders(user_items, catalog))
+                self._changed_users.add(user_id)
+
+            self._watermark = (last_order_id, unpaid)
+            return int(items['order_id'].nunique())
+
+    def start_auto_refresh(self, interval=REFRESH_INTERVAL):
+        """Refresh profiles every interval seconds in a daemon thread"""
+        if interval <= 0 or (self._refresher is not None and self._refresher.is_alive()):
+            return
+        self._refresher = run_periodically('User profile refresh', interval, self.refresh)
+
+
+# Shared by every model class in the process
+profile_store = UserProfileStore()
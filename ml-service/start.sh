@@ -12,15 +12,23 @@ cleanup() {
 trap cleanup SIGTERM SIGINT
 
 # Start Python ML service in background
+# ML_DEV_SERVER=1 runs the Flask development server instead of gunicorn,
+# ML_ASGI=0 the threaded WSGI app instead of the asyncio one
 echo "Starting ML service on port 5000..."
 cd /app/ml-service
-python app.py &
+if [ "${ML_DEV_SERVER:-0}" = "1" ]; then
+    python app.py &
+elif [ "${ML_ASGI:-1}" = "1" ]; then
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app &
+else
+    gunicorn -c gunicorn.conf.py wsgi:app &
+fi
 PYTHON_PID=$!
 
-# Wait for ML service to be ready
+# Wait for ML service to load its models (/health/live answers before that)
 echo "Waiting for ML service to start..."
-for i in {1..30}; do
-    if curl -f http://localhost:5000/health > /dev/null 2>&1; then
+for i in {1..60}; do
+    if curl -f http://localhost:5000/health/ready > /dev/null 2>&1; then
         echo "ML service is ready!"
         break
     fi
@@ -1,50 +1,450 @@
 import pandas as pd
 import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
-import joblib
+from sklearn.decomposition import TruncatedSVD
+from scipy import sparse
+from datetime import datetime
+import json
+import sys
 import os
 
-def train_models():
-    """Reads CSV data and trains/saves ML models."""
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from models.search_index import SearchIndex
+from models.ann_index import IVFIndex, normalize_rows
+from models.embeddings import save_embeddings
+from models.user_profiles import UserProfileTable
+from models.product_groups import ProductGroups, BEST_DEALS_MATCH
+from models.shop_stats import ShopStats
+from models.catalog import RECORD_FIELDS, encode_records
+from utils import artifacts
+from utils.pipeline import Pipeline, ranges
+
+# Processes the training stages run on
+TRAIN_WORKERS = int(os.getenv('TRAIN_WORKERS', os.cpu_count() or 1))
+# TfidfVectorizer settings of the product vectors
+TFIDF_PARAMS = {'max_features': 100, 'stop_words': 'english'}
+# Dimensions of the product embeddings, reduced by TruncatedSVD from a larger
+# TF-IDF; 0 keeps the unit-length TF-IDF product vectors as embeddings
+EMBEDDING_DIM = int(os.getenv('EMBEDDING_DIM', 64))
+# TfidfVectorizer settings the embeddings are reduced from; the tokens are
+# shared with the product vectors, so the analyzer settings must match
+EMBEDDING_TFIDF_PARAMS = {'max_features': 20000, 'stop_words': 'english', 'sublinear_tf': True}
+# Rows the SVD is fitted on, sampled from larger catalogs
+SVD_FIT_ROWS = 200000
+# Number of neighbours kept per product in the similar-products table
+SIMILAR_TOP_K = 20
+# Rows scored at once by each worker while building the table, bounds peak
+# memory to about 4 x this x catalog size bytes per worker
+SIMILARITY_BLOCK_SIZE = 256
+# Parts of the row-partitioned stages (tokenization, co-purchase counts) per worker
+PARTS_PER_WORKER = 4
+
+def part_size(n, workers, minimum=1000):
+    """Rows per part so that n rows spread over every worker"""
+    return max(-(-n // (workers * PARTS_PER_WORKER)), minimum)
+
+def dataset_path(data_dir, name):
+    """Path of an exported table (see read_dataset), or None if it was not exported"""
+    for path in (os.path.join(data_dir, f"{name}.parquet"), os.path.join(data_dir, name),
+                 os.path.join(data_dir, f"{name}.csv")):
+        if os.path.exists(path):
+            return path
+    return None
+
+def read_dataset(data_dir, name, columns=None):
+    """An exported table: name.parquet, a name/ directory of Parquet parts, or name.csv.
+
+    Returns (DataFrame, path read), or (None, None) if it was not exported.
+    """
+    path = dataset_path(data_dir, name)
+    if path is None:
+        return None, None
+    if path.endswith('.csv'):
+        return pd.read_csv(path, usecols=columns), path
+    return pd.read_parquet(path, columns=columns), path
+
+def orders_watermark(data_dir, orders_df):
+    """Last exported order id and the earlier orders still unpaid at export time"""
+    state_path = os.path.join(data_dir, 'export_state.json')
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f).get('order_history')
+        if state is not None:
+            return {'last_order_id': state['last_order_id'], 'unpaid_order_ids': state['unpaid_order_ids']}
+    # CSV exports do not record unpaid orders
+    last_order_id = int(orders_df['order_id'].max()) if orders_df is not None and len(orders_df) else 0
+    return {'last_order_id': last_order_id, 'unpaid_order_ids': []}
+
+def export_time(data_dir, products_path):
+    """When the exported products were read from the database, as an ISO timestamp.
+
+    export_data.py records the time it took its snapshot; CSV and older
+    exports fall back to the products file's mtime.
+    """
+    state_path = os.path.join(data_dir, 'export_state.json')
+    if not products_path.endswith('.csv') and os.path.exists(state_path):
+        with open(state_path) as f:
+            exported_at = json.load(f).get('exported_at')
+        if exported_at is not None:
+            return exported_at
+    return datetime.fromtimestamp(os.path.getmtime(products_path)).isoformat()
+
+# --- Stage functions (module level, so pipeline workers can import them) ---
+
+def read_products(data_dir):
+    """Exported products, with the text the vectors are built from"""
+    df, _ = read_dataset(data_dir, 'products')
+    df['content'] = df['name'].fillna('') + ' ' + df['description'].fillna('')
+    return df
+
+def read_orders(data_dir):
+    """Paid order items (user_id, order_id, product_id, total_amount), or None"""
+    orders_df, _ = read_dataset(data_dir, 'order_history')
+    if orders_df is None:
+        return None
+    orders_df = orders_df[orders_df['payment_status'] == 'paid'].dropna(subset=['product_id']).astype({'product_id': np.int64})
+    if 'total_amount' not in orders_df:
+        # Older CSV exports have no order totals
+        orders_df = orders_df.assign(total_amount=0.0)
+    return orders_df.reset_index(drop=True)
+
+def read_shops(data_dir):
+    shops_df, _ = read_dataset(data_dir, 'shops')
+    return shops_df
+
+def split_products(workers, products, tfidf_params):
+    return ranges(len(products), part_size(len(products), workers))
+
+def tokenize_part(part, products, tfidf_params):
+    """Analyzer tokens of the product texts in a row range"""
+    start, stop = part
+    analyze = TfidfVectorizer(**tfidf_params).build_analyzer()
+    return [analyze(text) for text in products['content'].iloc[start:stop]]
+
+def combine_tokens(results, products, tfidf_params):
+    return [tokens for part in results for tokens in part]
+
+def _pretokenized(tokens):
+    return tokens
+
+def _fit_pretokenized(tokens, params):
+    """TfidfVectorizer(**params) fitted on analyzer tokens, and its manifest entry.
+
+    Fitting on the analyzer's tokens selects the same vocabulary and idf as
+    fitting TfidfVectorizer(**params) on the texts.
+    """
+    fit_params = {name: value for name, value in params.items() if name != 'stop_words'}
+    fitted = TfidfVectorizer(analyzer=_pretokenized, **fit_params)
+    matrix = fitted.fit_transform(tokens)
+    template = TfidfVectorizer(**params)
+    manifest = {
+        'params': {name: getattr(template, name) for name in artifacts.VECTORIZER_PARAMS},
+        'vocabulary': {term: int(index) for term, index in fitted.vocabulary_.items()},
+        'idf': fitted.idf_.tolist(),
+    }
+    return matrix, manifest
+
+def vectorize(tokens, tfidf_params):
+    """TF-IDF vectors of the tokenized products and the vectorizer's manifest entry"""
+    product_vectors, vectorizer = _fit_pretokenized(tokens, tfidf_params)
+    # Cached outputs are read back read-only, so sort in place now
+    product_vectors.sort_indices()
+    return {'vectorizer': vectorizer, 'product_vectors': product_vectors}
+
+def fit_embedder(tokens, dim, tfidf_params, fit_rows):
+    """A larger TF-IDF vocabulary and the TruncatedSVD components reducing it to dim dimensions.
+
+    None when dim is 0 or the vocabulary has too few terms, leaving the
+    unit-length TF-IDF product vectors as embeddings.
+    """
+    if dim <= 0:
+        return None
+    matrix, vectorizer = _fit_pretokenized(tokens, tfidf_params)
+    dim = min(dim, matrix.shape[1] - 1, matrix.shape[0] - 1)
+    if dim < 1:
+        return None
+    if matrix.shape[0] > fit_rows:
+        matrix = matrix[np.sort(np.random.default_rng(0).choice(matrix.shape[0], fit_rows, replace=False))]
+    svd = TruncatedSVD(n_components=dim, random_state=0).fit(matrix)
+    return {'vectorizer': vectorizer, 'components': svd.components_.astype(np.float32)}
+
+def split_embeddings(workers, tokens, vectors, embedder):
+    return ranges(len(tokens), part_size(len(tokens), workers))
+
+def embed_part(part, tokens, vectors, embedder):
+    """Unit-length dense embeddings of the products in a row range"""
+    start, stop = part
+    if embedder is None:
+        return normalize_rows(vectors['product_vectors'][start:stop])
+    vectorizer = artifacts.vectorizer_from_manifest(embedder['vectorizer']).set_params(analyzer=_pretokenized)
+    return normalize_rows(vectorizer.transform(tokens[start:stop]) @ embedder['components'].T)
+
+def combine_embeddings(results, tokens, vectors, embedder):
+    return np.concatenate(results)
+
+def split_similarity(workers, embeddings, products, top_k):
+    return ranges(len(embeddings), SIMILARITY_BLOCK_SIZE)
+
+def top_k_row(scores, k):
+    """Positions of the k highest scores, highest first, ties broken by position"""
+    candidates = np.flatnonzero(scores > 0)
+    if len(candidates) < k:
+        # Sparse rows: after the positive scores come the zeros, first ones first
+        zeros = np.flatnonzero(scores == 0)[:k - len(candidates)]
+        if len(candidates) + len(zeros) == k:
+            candidates = np.concatenate([candidates, zeros])
+        else:
+            candidates = np.arange(len(scores))
+    values = scores[candidates]
+    kth = np.partition(values, len(values) - k)[len(values) - k]
+    top = candidates[values > kth]
+    top = np.concatenate([top, candidates[values == kth][:k - len(top)]])
+    return top[np.lexsort((top, -scores[top]))]
+
+def similar_block(part, embeddings, products, top_k):
+    """Top-K most similar product ids (and scores) for the rows of a block.
+
+    Products with fewer than top_k neighbours are padded with id -1 and score 0.
+    """
+    start, stop = part
+    n_products = len(embeddings)
+    k = min(top_k, max(n_products - 1, 0))
+    neighbour_ids = np.full((stop - start, top_k), -1, dtype=np.int32)
+    neighbour_scores = np.zeros((stop - start, top_k), dtype=np.float32)
+    if k == 0:
+        return neighbour_ids, neighbour_scores
+
+    # Cosine similarity of unit-length rows
+    block = embeddings[start:stop] @ embeddings.T
+    # A product is never its own neighbour
+    block[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+
+    # Highest score first, ties broken by catalog order
+    product_ids = products['id'].to_numpy()
+    for i, scores in enumerate(block):
+        top = top_k_row(scores, k)
+        neighbour_ids[i, :k] = product_ids[top]
+        neighbour_scores[i, :k] = scores[top]
+    return neighbour_ids, neighbour_scores
+
+def combine_similarity(results, embeddings, products, top_k):
+    if not results:
+        return np.full((0, top_k), -1, dtype=np.int32), np.zeros((0, top_k), dtype=np.float32)
+    return np.concatenate([ids for ids, _ in results]), np.concatenate([scores for _, scores in results])
+
+def index_purchases(orders, products):
+    """Catalog rows of the paid order items, sorted by order, or None without orders"""
+    if orders is None:
+        return None
+    product_ids = products['id'].to_numpy()
+    id_to_row = pd.Series(np.arange(len(product_ids)), index=product_ids)
+    items = orders[orders['product_id'].isin(id_to_row.index)]
+    order_codes, _ = pd.factorize(items['order_id'])
+    order = np.argsort(order_codes, kind='stable')
+    return {
+        'order_codes': order_codes[order],
+        'product_rows': id_to_row.loc[items['product_id']].to_numpy()[order],
+    }
+
+def split_purchases(workers, purchases, products):
+    """Item ranges holding whole orders"""
+    if purchases is None or not len(purchases['order_codes']):
+        return []
+    codes = purchases['order_codes']
+    n_orders = int(codes[-1]) + 1
+    bounds = [int(np.searchsorted(codes, start)) for start, _ in ranges(n_orders, part_size(n_orders, workers))]
+    return list(zip(bounds, bounds[1:] + [len(codes)]))
+
+def copurchase_part(part, purchases, products):
+    """Item pair counts of the orders in an item range, product x product"""
+    start, stop = part
+    codes = purchases['order_codes'][start:stop]
+    # order x product incidence, duplicate items add up
+    incidence = sparse.csr_matrix(
+        (np.ones(stop - start, dtype=np.int32), (codes - codes[0], purchases['product_rows'][start:stop])),
+        shape=(int(codes[-1] - codes[0]) + 1, len(products))
+    )
+    return (incidence.T @ incidence).tocsr()
+
+def combine_copurchase(results, purchases, products):
+    """Sparse product x product count of paid order item pairs, or None without orders.
+
+    Entry (i, j) equals what the order_items self-join counts for products
+    i and j: for every order, items of i times items of j. Rows and columns
+    are aligned with the catalog; products outside it are dropped.
+    """
+    if purchases is None:
+        return None
+    copurchase = sparse.csr_matrix((len(products), len(products)), dtype=np.int32)
+    for counts in results:
+        copurchase = copurchase + counts
+    copurchase.setdiag(0)
+    copurchase.eliminate_zeros()
+    copurchase.sort_indices()
+    return copurchase.astype(np.int32)
+
+def build_search_index(products):
+    return SearchIndex.build(products['name'], products['description'])
+
+def build_ann_index(embeddings):
+    """Centroids and list assignments of the IVF index, or None for an empty catalog"""
+    if not len(embeddings):
+        return None
+    ann_index = IVFIndex.build(embeddings)
+    return ann_index.centroids, ann_index.assignments
+
+def build_profiles(orders, products, embeddings):
+    if orders is None:
+        return None
+    return UserProfileTable.build(orders, products['id'].to_numpy(), products['shop_id'].to_numpy(), embeddings)
+
+def build_product_groups(products, match):
+    return ProductGroups.build(products['name'], products['price'].to_numpy(dtype=np.float64), match)
+
+def build_shop_stats(shops, orders, products):
+    if shops is None:
+        return None
+    return ShopStats.build(shops, orders, products['id'].to_numpy(), products['shop_id'].to_numpy())
+
+def build_record_json(products, fields):
+    """JSON of the API result fields of every product, spliced into responses by the service"""
+    return encode_records(*(products[field].to_numpy() for field in fields))
+
+def training_pipeline(data_dir, cache_dir, workers=TRAIN_WORKERS):
+    """The training stages over the exports in data_dir"""
+    pipeline = Pipeline(cache_dir, workers)
+    params = {'data_dir': os.path.abspath(data_dir)}
+    # Sources: re-read when the exported files change
+    pipeline.add('products', read_products, params=params, files=[dataset_path(data_dir, 'products')])
+    pipeline.add('orders', read_orders, params=params, files=[
+        dataset_path(data_dir, 'order_history'), os.path.join(data_dir, 'export_state.json')
+    ])
+    pipeline.add('shops', read_shops, params=params, files=[dataset_path(data_dir, 'shops')])
+    # Product text -> tokens -> TF-IDF vectors, and unit-length SVD embeddings in row parts
+    tfidf = {'tfidf_params': TFIDF_PARAMS}
+    pipeline.add('tokens', tokenize_part, deps=['products'], params=tfidf, split=split_products, combine=combine_tokens)
+    pipeline.add('vectors', vectorize, deps=['tokens'], params=tfidf)
+    pipeline.add('embedder', fit_embedder, deps=['tokens'], params={
+        'dim': EMBEDDING_DIM, 'tfidf_params': EMBEDDING_TFIDF_PARAMS, 'fit_rows': SVD_FIT_ROWS
+    })
+    pipeline.add('embeddings', embed_part, deps=['tokens', 'vectors', 'embedder'],
+                 split=split_embeddings, combine=combine_embeddings)
+    # Top-K similar products in row blocks
+    pipeline.add('similarity', similar_block, deps=['embeddings', 'products'], params={'top_k': SIMILAR_TOP_K},
+                 split=split_similarity, combine=combine_similarity)
+    # Co-purchase counts in order partitions
+    pipeline.add('purchases', index_purchases, deps=['orders', 'products'])
+    pipeline.add('copurchase', copurchase_part, deps=['purchases', 'products'],
+                 split=split_purchases, combine=combine_copurchase)
+    # Indexes and aggregates
+    pipeline.add('search_index', build_search_index, deps=['products'])
+    pipeline.add('ann_index', build_ann_index, deps=['embeddings'])
+    pipeline.add('profiles', build_profiles, deps=['orders', 'products', 'embeddings'])
+    pipeline.add('product_groups', build_product_groups, deps=['products'], params={'match': BEST_DEALS_MATCH})
+    pipeline.add('shop_stats', build_shop_stats, deps=['shops', 'orders', 'products'])
+    pipeline.add('record_json', build_record_json, deps=['products'], params={'fields': RECORD_FIELDS})
+    return pipeline
+
+def train_models(data_dir=None, models_dir=None, workers=TRAIN_WORKERS):
+    """Build every model from the exported data and publish them as a new artifact version.
+
+    Stages whose code and inputs did not change since the last run are read
+    from the models directory's cache/; when none changed the current
+    version is kept. Returns the published version directory.
+    """
     print("Starting training process...")
-    
-    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
-    models_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'models')
-    
+
+    data_dir = data_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+    models_dir = models_dir or os.path.join(data_dir, 'models')
+
     if not os.path.exists(models_dir):
         os.makedirs(models_dir)
-        
-    # Check if CSV exists
-    products_csv = os.path.join(data_dir, 'products.csv')
-    if not os.path.exists(products_csv):
-        print(f"Error: {products_csv} not found. Please run export_data.py first.")
+
+    # Exported data (Parquet from export_data.py, or CSV)
+    products_path = dataset_path(data_dir, 'products')
+    if products_path is None:
+        print(f"Error: products data not found in {data_dir}. Please run export_data.py first.")
         return
+    if dataset_path(data_dir, 'order_history') is None:
+        print("Warning: order history not found, skipping co-purchase matrix and user profiles.")
+    if dataset_path(data_dir, 'shops') is None:
+        print("Warning: shops not found, the service will aggregate shop stats from the database.")
 
-    # Load data
-    print("Loading products data...")
-    df = pd.read_csv(products_csv)
-    
-    # Prepare content for vectorization
-    df['content'] = df['name'].fillna('') + ' ' + df['description'].fillna('')
-    
-    # --- 1. Train Vectorizer ---
-    print("Training TfidfVectorizer...")
-    vectorizer = TfidfVectorizer(max_features=100, stop_words='english')
-    product_vectors = vectorizer.fit_transform(df['content'])
-    
-    # --- 2. Save Models ---
-    print("Saving models...")
-    # Save the vectorizer
-    joblib.dump(vectorizer, os.path.join(models_dir, 'tfidf_vectorizer.pkl'))
-    # Save the vectors
-    joblib.dump(product_vectors, os.path.join(models_dir, 'product_vectors.pkl'))
-    # Save the dataframe (useful for index mapping)
-    df.to_pickle(os.path.join(models_dir, 'products_processed.pkl'))
-    
-    print("\nTraining completed! Models saved in 'data/models/' directory.")
-    print("- tfidf_vectorizer.pkl")
-    print("- product_vectors.pkl")
-    print("- products_processed.pkl")
+    pipeline = training_pipeline(data_dir, os.path.join(models_dir, 'cache'), workers)
+    build_key = pipeline.build_key()
+    current_dir = artifacts.current_version_dir(models_dir)
+    if current_dir is not None and artifacts.read_manifest(current_dir).get('build_key') == build_key:
+        print(f"Models are up to date, keeping {current_dir}")
+        return current_dir
+
+    print(f"Running training stages on {pipeline.workers} processes...")
+    pipeline.run()
+    df = pipeline.load('products')
+    vectors = pipeline.load('vectors')
+    embeddings = pipeline.load('embeddings')
+    neighbour_ids, neighbour_scores = pipeline.load('similarity')
+    ann_index = pipeline.load('ann_index')
+
+    print("Saving model artifacts...")
+    writer = artifacts.ArtifactWriter(models_dir)
+    # Product columns (numeric arrays and UTF-8 string columns)
+    writer.save_array('id', df['id'].to_numpy(dtype=np.int64))
+    writer.save_array('price', df['price'].to_numpy(dtype=np.float64))
+    writer.save_array('shop_id', df['shop_id'].to_numpy(dtype=np.int64))
+    for field in ('name', 'description', 'shop_name', 'image_url'):
+        writer.save_strings(field, df[field].tolist())
+    # Their JSON in API results
+    writer.save_strings('record_json', pipeline.load('record_json'))
+    # Rows in id order, for id -> row lookups
+    writer.save_array('id_order', np.argsort(df['id'].to_numpy(), kind='stable'))
+    # The vectors, as CSR arrays
+    writer.save_csr('product_vectors', vectors['product_vectors'])
+    # The similar products table (rows aligned with the products)
+    writer.save_array('similar_ids', neighbour_ids)
+    writer.save_array('similar_scores', neighbour_scores)
+    # The search index
+    pipeline.load('search_index').save(writer)
+    # Dense embeddings (float32 and int8), the SVD that made them and their IVF lists
+    save_embeddings(writer, embeddings)
+    embedder = pipeline.load('embedder')
+    if embedder is not None:
+        writer.save_array('embedding_components', embedder['components'])
+    if ann_index is not None:
+        IVFIndex(*ann_index, embeddings).save(writer)
+    # Product groups by normalized name, prices sorted within each
+    pipeline.load('product_groups').save(writer)
+    # Shop stats
+    shop_stats = pipeline.load('shop_stats')
+    if shop_stats is not None:
+        shop_stats.save(writer)
+    # User profiles
+    profiles = pipeline.load('profiles')
+    if profiles is not None:
+        profiles.save(writer)
+    # The co-purchase matrix (rows and columns aligned with the products)
+    copurchase = pipeline.load('copurchase')
+    if copurchase is not None:
+        writer.save_csr('copurchase', copurchase)
+    # The manifest holds the vectorizer vocabulary and idf
+    version_dir = writer.publish(
+        n_products=len(df),
+        # Products edited after this are applied by the service's incremental refresh
+        exported_at=export_time(data_dir, products_path),
+        # Orders after this are folded into user profiles by the service
+        orders_watermark=orders_watermark(data_dir, pipeline.load('orders')),
+        vectorizer=vectors['vectorizer'],
+        # The larger vectorizer the embeddings are reduced from, for products changed later
+        embedder=embedder['vectorizer'] if embedder is not None else None,
+        # The service rebuilds the groups when it runs with another BEST_DEALS_MATCH
+        product_groups_match=BEST_DEALS_MATCH,
+        # Same key on the next run: nothing changed, nothing to publish
+        build_key=build_key
+    )
+
+    print(f"\nTraining completed! Models published to {version_dir}")
+    for name in writer.manifest['files']:
+        print(f"- {name}")
+    return version_dir
 
 if __name__ == "__main__":
     train_models()
@@ -0,0 +1,284 @@
+"""Versioned, pickle-free model artifacts.
+
+train.py writes each run to data/models/artifacts/<version>/:
+
+- manifest.json: format version, product count, TF-IDF vocabulary and
+  idf, and the shape of every stored array
+- <name>.npy: numeric arrays (ids, prices, CSR parts, tables), loaded
+  with mmap_mode='r' so workers share the pages through the OS
+- <name>.utf8 + <name>.offsets.npy + <name>.nulls.npy: string columns as
+  one UTF-8 buffer with row offsets, decoded only for the rows read
+
+The CURRENT file in artifacts/ names the published version and is
+replaced atomically, so readers never see a half-written run.
+"""
+import numpy as np
+from scipy import sparse
+from datetime import datetime, timezone
+import shutil
+import json
+import os
+
+FORMAT_VERSION = 1
+ARTIFACTS_DIR = 'artifacts'
+CURRENT_FILE = 'CURRENT'
+MANIFEST_FILE = 'manifest.json'
+# Published versions kept on disk, older ones are removed
+KEEP_VERSIONS = 2
+
+# TfidfVectorizer parameters needed to rebuild it without pickle
+VECTORIZER_PARAMS = (
+    'lowercase', 'stop_words', 'token_pattern', 'ngram_range', 'analyzer',
+    'norm', 'use_idf', 'smooth_idf', 'sublinear_tf', 'strip_accents',
+)
+
+
+class StringColumn:
+    """Read-only string column over a UTF-8 buffer and row offsets"""
+
+    def __init__(self, data, offsets, nulls):
+        self.data = data
+        self.offsets = offsets
+        self.nulls = nulls
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        if self.nulls[row]:
+            return None
+        return bytes(self.data[self.offsets[row]:self.offsets[row + 1]]).decode('utf-8')
+
+    def raw(self, rows):
+        """UTF-8 bytes of many rows at once, b'' for nulls"""
+        rows = np.asarray(rows, dtype=np.int64)
+        buffer = memoryview(np.asarray(self.data))
+        starts, stops = self.offsets[rows].tolist(), self.offsets[rows + 1].tolist()
+        return [buffer[start:stop].tobytes() for start, stop in zip(starts, stops)]
+
+    def __iter__(self):
+        return (self[row] for row in range(len(self)))
+
+    def to_list(self):
+        return list(self)
+
+
+class PatchedArray:
+    """Read-only array with rows replaced or appended over a base array.
+
+    The base (usually memory-mapped) is never copied or written: indexing
+    gathers from it and then fills in the patched rows, which are kept
+    sorted with their values alongside. The base may be an ndarray, a
+    sparse CSR matrix or anything indexed by row arrays like them.
+    """
+
+    def __init__(self, base, rows, values, length):
+        self.base = base
+        self.rows = rows
+        self.values = values
+        self.length = length
+
+    @classmethod
+    def patch(cls, array, rows, values, length=None):
+        """array with values at rows, grown to length; patches of a PatchedArray are merged"""
+        rows = np.asarray(rows, dtype=np.int64)
+        if isinstance(array, cls):
+            keep = np.flatnonzero(~np.isin(array.rows, rows))
+            base, length = array.base, max(length or 0, array.length)
+            rows = np.concatenate([array.rows[keep], rows])
+            values = _stack_rows([array.values[keep], values])
+        else:
+            base, length = array, max(length or 0, array.shape[0])
+        order = np.argsort(rows, kind='stable')
+        return cls(base, rows[order], values[order], length)
+
+    @property
+    def shape(self):
+        return (self.length,) + tuple(self.base.shape[1:])
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    def __len__(self):
+        return self.length
+
+    def _positions(self, rows):
+        """Positions of rows in the patches, and the mask of the rows patched"""
+        positions = np.minimum(np.searchsorted(self.rows, rows), max(len(self.rows) - 1, 0))
+        patched = self.rows[positions] == rows if len(self.rows) else np.zeros(len(rows), dtype=bool)
+        return positions, patched
+
+    def __getitem__(self, rows):
+        if isinstance(rows, (int, np.integer)):
+            row = int(rows) + (self.length if rows < 0 else 0)
+            position = np.searchsorted(self.rows, row)
+            if position < len(self.rows) and self.rows[position] == row:
+                return self.values[position]
+            if row >= self.length:
+                raise IndexError(f"row {row} out of range for {self.length} rows")
+            return self.base[row]
+        if isinstance(rows, slice):
+            rows = np.arange(*rows.indices(self.length))
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        rows = np.where(rows < 0, rows + self.length, rows).astype(np.int64)
+        positions, patched = self._positions(rows)
+        from_base = np.flatnonzero(~patched)
+        from_patches = np.flatnonzero(patched)
+        if sparse.issparse(self.values):
+            stacked = sparse.vstack([self.base[rows[from_base]], self.values[positions[from_patches]]]).tocsr()
+            return stacked[np.argsort(np.concatenate([from_base, from_patches]), kind='stable')]
+        result = np.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+        result[from_base] = self.base[rows[from_base]]
+        result[from_patches] = self.values[positions[from_patches]]
+        return result
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype)
+
+    def tocsr(self):
+        """The whole matrix as one CSR, for a sparse base"""
+        return self[:]
+
+
+def _stack_rows(parts):
+    if sparse.issparse(parts[0]) or sparse.issparse(parts[-1]):
+        return sparse.vstack(parts).tocsr()
+    return np.concatenate(parts)
+
+
+def artifacts_root(models_dir):
+    return os.path.join(models_dir, ARTIFACTS_DIR)
+
+
+def current_version_dir(models_dir):
+    """Directory of the published artifact version, or None if there is none"""
+    current_path = os.path.join(artifacts_root(models_dir), CURRENT_FILE)
+    if not os.path.exists(current_path):
+        return None
+    with open(current_path) as f:
+        version = f.read().strip()
+    version_dir = os.path.join(artifacts_root(models_dir), version)
+    return version_dir if os.path.isdir(version_dir) else None
+
+
+def read_manifest(version_dir):
+    """Manifest of an artifact version; raises ValueError on an unknown format"""
+    with open(os.path.join(version_dir, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported artifact format {manifest.get('format_version')} in {version_dir}"
+        )
+    return manifest
+
+
+def has_array(version_dir, name):
+    return os.path.exists(os.path.join(version_dir, f"{name}.npy"))
+
+
+def load_array(version_dir, name):
+    """Memory-mapped read-only array"""
+    return np.load(os.path.join(version_dir, f"{name}.npy"), mmap_mode='r', allow_pickle=False)
+
+
+def load_csr(version_dir, name, shape):
+    """CSR matrix over memory-mapped data, indices and indptr arrays"""
+    return sparse.csr_matrix(
+        (load_array(version_dir, f"{name}.data"),
+         load_array(version_dir, f"{name}.indices"),
+         load_array(version_dir, f"{name}.indptr")),
+        shape=tuple(shape), copy=False
+    )
+
+
+def load_strings(version_dir, name):
+    """StringColumn over a memory-mapped UTF-8 buffer"""
+    data_path = os.path.join(version_dir, f"{name}.utf8")
+    if os.path.getsize(data_path) > 0:
+        data = np.memmap(data_path, dtype=np.uint8, mode='r')
+    else:
+        data = np.empty(0, dtype=np.uint8)
+    return StringColumn(
+        data, load_array(version_dir, f"{name}.offsets"), load_array(version_dir, f"{name}.nulls")
+    )
+
+
+def vectorizer_from_manifest(spec):
+    """Rebuild a fitted TfidfVectorizer from its manifest entry"""
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    params = dict(spec['params'])
+    if params.get('ngram_range') is not None:
+        params['ngram_range'] = tuple(params['ngram_range'])
+    vectorizer = TfidfVectorizer(vocabulary=spec['vocabulary'], **params)
+    vectorizer.idf_ = np.asarray(spec['idf'], dtype=np.float64)
+    return vectorizer
+
+
+def vectorizer_to_manifest(vectorizer):
+    return {
+        'params': {name: getattr(vectorizer, name) for name in VECTORIZER_PARAMS},
+        'vocabulary': {term: int(index) for term, index in vectorizer.vocabulary_.items()},
+        'idf': vectorizer.idf_.tolist(),
+    }
+
+
+class ArtifactWriter:
+    """Writes one artifact version and publishes it atomically"""
+
+    def __init__(self, models_dir):
+        self.root = artifacts_root(models_dir)
+        self.version = datetime.now(timezone.utc).strftime('v%Y%m%dT%H%M%S%f')
+        self.path = os.path.join(self.root, self.version)
+        os.makedirs(self.path)
+        self.manifest = {'format_version': FORMAT_VERSION, 'version': self.version, 'files': []}
+
+    def save_array(self, name, array):
+        np.save(os.path.join(self.path, f"{name}.npy"), np.ascontiguousarray(array), allow_pickle=False)
+        self.manifest['files'].append(f"{name}.npy")
+
+    def save_csr(self, name, matrix):
+        matrix = matrix.tocsr()
+        matrix.sort_indices()
+        self.save_array(f"{name}.data", matrix.data)
+        self.save_array(f"{name}.indices", matrix.indices)
+        self.save_array(f"{name}.indptr", matrix.indptr)
+        self.manifest.setdefault('shapes', {})[name] = list(matrix.shape)
+
+    def save_strings(self, name, values):
+        nulls = np.array([not isinstance(value, str) for value in values], dtype=bool)
+        encoded = [value.encode('utf-8') if isinstance(value, str) else b'' for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        with open(os.path.join(self.path, f"{name}.utf8"), 'wb') as f:
+            f.write(b''.join(encoded))
+        self.manifest['files'].append(f"{name}.utf8")
+        self.save_array(f"{name}.offsets", offsets)
+        self.save_array(f"{name}.nulls", nulls)
+
+    def publish(self, **manifest):
+        """Write the manifest, point CURRENT at this version and prune old ones"""
+        self.manifest.update(manifest)
+        with open(os.path.join(self.path, MANIFEST_FILE), 'w') as f:
+            json.dump(self.manifest, f)
+
+        current_tmp = os.path.join(self.root, f"{CURRENT_FILE}.tmp")
+        with open(current_tmp, 'w') as f:
+            f.write(self.version)
+        os.replace(current_tmp, os.path.join(self.root, CURRENT_FILE))
+
+        older = sorted(
+            entry for entry in os.listdir(self.root)
+            if entry != self.version and os.path.isdir(os.path.join(self.root, entry))
+        )
+        # Processes still mapping a removed version keep their pages until they reload
+        for version in older[:max(len(older) - (KEEP_VERSIONS - 1), 0)]:
+            shutil.rmtree(os.path.join(self.root, version), ignore_errors=True)
+        return self.path
@@ -0,0 +1,18 @@
+import threading
+import time
+
+
+def run_periodically(name, interval, func):
+    """Call func every interval seconds in a daemon thread, logging failures"""
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                func()
+            except Exception as e:
+                print(f"{name} failed: {e}")
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
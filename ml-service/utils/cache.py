@@ -0,0 +1,163 @@
+from collections import OrderedDict
+import threading
+import time
+import os
+from utils import metrics
+from utils.singleflight import SingleFlight
+
+_MISSING = object()
+
+# Directory shared by the gunicorn workers (set in gunicorn.conf.py). A cache
+# cleared with invalidate() touches a file named after it there, and every
+# worker clears its own copy when it sees the file change.
+CACHE_INVALIDATION_DIR = os.getenv('CACHE_INVALIDATION_DIR')
+
+
+def _generation(path):
+    """Last time path was touched by invalidate(), None before the first"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire after ttl seconds"""
+
+    def __init__(self, name, ttl, maxsize=128):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Misses of the same key computed once, see get_or_compute
+        self._flight = SingleFlight(name)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._hit_counter = metrics.CACHE_LOOKUPS.labels(name, 'hit')
+        self._miss_counter = metrics.CACHE_LOOKUPS.labels(name, 'miss')
+        self._eviction_counter = metrics.CACHE_EVICTIONS.labels(name)
+        self._generation_path = os.path.join(CACHE_INVALIDATION_DIR, name) if CACHE_INVALIDATION_DIR else None
+        self._seen_generation = _generation(self._generation_path) if self._generation_path else None
+
+    def get(self, key, default=None):
+        """Cached value for key, or default if it is missing or expired"""
+        return self._lookup(key, default, count=True)
+
+    def _lookup(self, key, default, count):
+        if self._generation_path:
+            self._sync()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and entry[0] > now:
+                self._entries.move_to_end(key)
+                if count:
+                    self.hits += 1
+                    self._hit_counter.inc()
+                return entry[1]
+            if entry is not _MISSING:
+                del self._entries[key]
+            if count:
+                self.misses += 1
+                self._miss_counter.inc()
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+                self._eviction_counter.inc()
+
+    def get_or_compute(self, key, compute):
+        """Cached value for key, computing and storing it on a miss.
+
+        Concurrent misses of one key share a single compute() call.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._flight.do(key, lambda: self._compute(key, compute))
+        return value
+
+    def _compute(self, key, compute):
+        # Set by a call that finished since this one missed
+        value = self._lookup(key, _MISSING, count=False)
+        if value is _MISSING:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def invalidate(self):
+        """Clear this process's entries"""
+        with self._lock:
+            self._entries.clear()
+
+    def broadcast_invalidate(self):
+        """Clear the entries of this cache in every worker"""
+        self.invalidate()
+        if self._generation_path:
+            with open(self._generation_path, 'a'):
+                pass
+            os.utime(self._generation_path, ns=(time.time_ns(), time.time_ns()))
+
+    def _sync(self):
+        # Another worker invalidated this cache since the last lookup
+        generation = _generation(self._generation_path)
+        if generation != self._seen_generation:
+            with self._lock:
+                self._entries.clear()
+                self._seen_generation = generation
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'name': self.name,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(name, ttl=60, maxsize=128):
+    """The process-wide cache called name; CACHE_TTL_<NAME> overrides ttl"""
+    with _caches_lock:
+        cache = _caches.get(name)
+        if cache is None:
+            ttl = float(os.getenv(f"CACHE_TTL_{name.upper()}", ttl))
+            cache = _caches[name] = TTLCache(name, ttl, maxsize)
+        return cache
+
+
+def invalidate(*names):
+    """Clear the named caches, or every cache when no name is given, in every worker"""
+    with _caches_lock:
+        caches = [_caches[name] for name in names if name in _caches] if names else list(_caches.values())
+    for cache in caches:
+        cache.broadcast_invalidate()
+
+
+def invalidate_local(*names):
+    """Clear the named caches in this process only"""
+    with _caches_lock:
+        caches = [_caches[name] for name in names if name in _caches]
+    for cache in caches:
+        cache.invalidate()
+
+
+def cache_stats():
+    with _caches_lock:
+        caches = list(_caches.values())
+    return [cache.stats() for cache in caches]
@@ -1,12 +1,34 @@
 import psycopg2
+from psycopg2 import pool, OperationalError, InterfaceError
+from contextlib import contextmanager, ExitStack
+import contextvars
+import threading
+import atexit
+import time
 import os
 from dotenv import load_dotenv
+from utils import metrics
 
 load_dotenv()
 
-def get_db_connection():
-    """Get PostgreSQL database connection"""
-    return psycopg2.connect(
+# Pool sizing and behaviour, overridable from the environment
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+# Seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))
+# Connections idle longer than this are pinged before reuse
+DB_POOL_HEALTHCHECK_AFTER = float(os.getenv('DB_POOL_HEALTHCHECK_AFTER', 30))
+
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+_last_used = {}
+# The SharedConnection of the running shared_connection() block. A context
+# variable, so threads the block hands work to (asgi.offload) join it too
+_shared = contextvars.ContextVar('shared_connection', default=None)
+
+def _connection_params():
+    return dict(
         host=os.getenv('DB_HOST', 'localhost'),
         port=os.getenv('DB_PORT', 5432),
         database=os.getenv('DB_NAME', 'grocery_app'),
@@ -14,18 +36,163 @@ def get_db_connection():
         password=os.getenv('DB_PASSWORD')
     )
 
-def fetch_data(query, params=None):
-    """Fetch data from database"""
-    conn = get_db_connection()
+def get_db_connection():
+    """Get a dedicated PostgreSQL database connection (caller closes it)"""
+    return psycopg2.connect(**_connection_params())
+
+def _get_pool_and_slots():
+    """The current pool with the semaphore that bounds its borrowers, created together"""
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is None:
+            _pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+            _pool = pool.ThreadedConnectionPool(
+                DB_POOL_MIN, DB_POOL_MAX, **_connection_params()
+            )
+        return _pool, _pool_slots
+
+def get_pool():
+    """Get the process-wide connection pool, creating it on first use"""
+    return _get_pool_and_slots()[0]
+
+def close_pool():
+    """Close every pooled connection.
+
+    Borrowers still holding a connection give it back to the pool and
+    semaphore they took it from; the next borrow creates both anew.
+    """
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool, _pool_slots = None, None
+            _last_used.clear()
+
+atexit.register(close_pool)
+
+def _is_healthy(conn):
+    """Check a pooled connection before handing it out"""
+    if conn.closed:
+        return False
+    if time.monotonic() - _last_used.get(id(conn), 0) < DB_POOL_HEALTHCHECK_AFTER:
+        return True
     try:
-        import pandas as pd
-        if params:
-            df = pd.read_sql(query, conn, params=params)
-        else:
-            df = pd.read_sql(query, conn)
-        return df
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        return True
+    except (OperationalError, InterfaceError):
+        return False
+
+def _checkout(db_pool):
+    # After a database restart every idle connection is dead: drop them until
+    # one answers, then open a new one
+    for _ in range(DB_POOL_MAX):
+        conn = db_pool.getconn()
+        if _is_healthy(conn):
+            break
+        _last_used.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+    else:
+        conn = db_pool.getconn()
+    # Queries here are read-only, so never leave a transaction open in the pool
+    if not conn.autocommit:
+        conn.autocommit = True
+    return conn
+
+class SharedConnection:
+    """One pooled connection for the queries of a block, borrowed by the first of them.
+
+    Queries from several threads take turns on it.
+    """
+
+    def __init__(self):
+        self._stack = ExitStack()
+        self._conn = None
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._stack.enter_context(_borrow())
+            yield self._conn
+
+    def close(self):
+        with self._lock:
+            self._conn = None
+            self._stack.close()
+
+@contextmanager
+def shared_connection():
+    """Let every query of the block reuse one pooled connection.
+
+    The connection is only borrowed once the first query needs it. Work
+    run in other threads with a copy of this context (contextvars) shares
+    it as well, one query at a time.
+    """
+    if _shared.get() is not None:
+        yield
+        return
+    shared = SharedConnection()
+    token = _shared.set(shared)
+    try:
+        yield
     finally:
-        conn.close()
+        _shared.reset(token)
+        shared.close()
 
+@contextmanager
+def pooled_connection():
+    """Borrow a connection from the pool, waiting up to DB_POOL_TIMEOUT for one"""
+    shared = _shared.get()
+    if shared is not None:
+        with shared.connection() as conn:
+            yield conn
+        return
+    with _borrow() as conn:
+        yield conn
 
+@contextmanager
+def _borrow():
+    """Check a connection out of the pool and put it back afterwards"""
+    db_pool, slots = _get_pool_and_slots()
+    wait_start = time.perf_counter()
+    acquired = slots.acquire(timeout=DB_POOL_TIMEOUT)
+    metrics.DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - wait_start)
+    if not acquired:
+        raise pool.PoolError(f"No database connection available after {DB_POOL_TIMEOUT}s")
+    try:
+        conn = _checkout(db_pool)
+        try:
+            yield conn
+        finally:
+            # psycopg2 marks connections it found broken as closed
+            discard = bool(conn.closed)
+            if discard:
+                _last_used.pop(id(conn), None)
+            else:
+                _last_used[id(conn)] = time.monotonic()
+            if db_pool.closed:
+                # close_pool() ran meanwhile and already closed it
+                _last_used.pop(id(conn), None)
+            else:
+                db_pool.putconn(conn, close=discard)
+    finally:
+        slots.release()
 
+def fetch_data(query, params=None):
+    """Fetch data from database"""
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        with metrics.stage('db'), pooled_connection() as conn:
+            import pandas as pd
+            if params:
+                df = pd.read_sql(query, conn, params=params)
+            else:
+                df = pd.read_sql(query, conn)
+            outcome = 'ok'
+            return df
+    finally:
+        metrics.DB_QUERIES.labels(outcome).inc()
+        metrics.DB_QUERY_SECONDS.observe(time.perf_counter() - start)
@@ -0,0 +1,135 @@
+"""Prometheus metrics of the ML service, served at /metrics.
+
+Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR
+(set up by gunicorn.conf.py) and /metrics sums all of them; a single
+process (python app.py) reports its own.
+
+Requests are split into stages (db, score, topk, records, serialize, coalesced). A
+stage nested in another counts only towards itself, so the stages of a
+request add up to at most its total.
+"""
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest,
+)
+from prometheus_client import multiprocess
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import time
+import os
+
+# ML_SERVER_TIMING=1 adds a Server-Timing header with the stage durations to every response
+SERVER_TIMING = os.getenv('ML_SERVER_TIMING', '0') == '1'
+
+# Request latencies are mostly a few milliseconds; stages are shorter still
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+STAGE_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+
+REQUESTS = Counter('ml_requests_total', 'Requests served', ['endpoint', 'status'])
+REQUEST_SECONDS = Histogram('ml_request_duration_seconds', 'Request latency', ['endpoint'],
+                            buckets=LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram('ml_stage_duration_seconds', 'Time spent per request stage',
+                          ['endpoint', 'stage'], buckets=STAGE_BUCKETS)
+
+DB_QUERIES = Counter('ml_db_queries_total', 'Database queries run', ['outcome'])
+DB_QUERY_SECONDS = Histogram('ml_db_query_duration_seconds', 'Database query latency, pool wait included',
+                             buckets=LATENCY_BUCKETS)
+DB_POOL_WAIT_SECONDS = Histogram('ml_db_pool_wait_seconds', 'Time waiting for a pooled connection',
+                                 buckets=STAGE_BUCKETS)
+
+CACHE_LOOKUPS = Counter('ml_cache_lookups_total', 'Cache lookups', ['cache', 'result'])
+CACHE_EVICTIONS = Counter('ml_cache_evictions_total', 'Entries evicted from a full cache', ['cache'])
+SINGLEFLIGHT_CALLS = Counter('ml_singleflight_calls_total', 'Calls computed, or coalesced into a running one',
+                             ['flight', 'role'])
+
+MODEL_LOAD_SECONDS = Gauge('ml_model_load_seconds', 'Duration of the last model load', ['model'],
+                           multiprocess_mode='mostrecent')
+MODEL_REFRESH_SECONDS = Histogram('ml_model_refresh_duration_seconds', 'Incremental model refresh latency',
+                                  ['model'], buckets=LATENCY_BUCKETS)
+
+_request = ContextVar('ml_request_timer', default=None)
+# Time spent in stages nested in the running one
+_nested = ContextVar('ml_nested_stage_time', default=None)
+
+
+class RequestTimer:
+    """Total and per-stage durations of one request"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.stages = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._token = None
+
+    def add(self, stage, seconds):
+        # Stages of concurrent sub-requests (asgi batch) land here from several threads
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def server_timing(self):
+        """Server-Timing header value, durations in milliseconds"""
+        with self._lock:
+            parts = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in self.stages.items()]
+        parts.append(f"total;dur={self.elapsed() * 1000:.2f}")
+        return ', '.join(parts)
+
+    def finish(self, status):
+        """Record the request and stop attributing stages to it"""
+        if self._token is not None:
+            _request.reset(self._token)
+            self._token = None
+        REQUESTS.labels(self.endpoint, str(status)).inc()
+        REQUEST_SECONDS.labels(self.endpoint).observe(self.elapsed())
+        with self._lock:
+            stages = list(self.stages.items())
+        for stage_name, seconds in stages:
+            STAGE_SECONDS.labels(self.endpoint, stage_name).observe(seconds)
+
+
+def start_request(endpoint):
+    """Timer that stages in this context report to until finish()"""
+    timer = RequestTimer(endpoint)
+    timer._token = _request.set(timer)
+    return timer
+
+
+@contextmanager
+def stage(name):
+    """Attribute the block's time, minus nested stages, to the current request"""
+    timer = _request.get()
+    if timer is None:
+        yield
+        return
+    parent = _nested.get()
+    nested = [0.0]
+    token = _nested.set(nested)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _nested.reset(token)
+        if parent is not None:
+            parent[0] += elapsed
+        # Nested stages running concurrently can add up to more than the block
+        timer.add(name, max(elapsed - nested[0], 0.0))
+
+
+def render():
+    """(body, content type) of the /metrics response"""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """Drop the live-only samples of an exited gunicorn worker"""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,308 @@
+"""Build steps with declared dependencies, run on a process pool and cached on disk.
+
+A Pipeline is a set of named stages. A stage's function is called with
+the outputs of its dependencies as keyword arguments (plus its params)
+and its output is written to the cache directory under a key hashing:
+
+- the source of its functions and its params
+- the source of the project modules they use (models/, utils/, ...),
+  followed through the globals the functions and those modules refer to
+- the size and mtime of the input files it reads
+- the keys of its dependencies
+
+so a stage whose code and inputs did not change is not run again, and
+neither is anything downstream of it. A stage with a split function is
+run as several tasks, one per part (row blocks, order partitions), and
+their results are merged by its combine function. Every stage whose
+dependencies are done is submitted at once, so independent stages and the
+parts of a split stage share the pool's processes.
+
+Functions must be defined at module level so worker processes can import
+them. Outputs are stored with joblib: numpy arrays inside them are
+memory-mapped when read back, so every task of a stage shares the pages
+of a large input instead of receiving a copy. The cache holds pickles and
+is only meant to be read by the pipeline that wrote it.
+"""
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import functools
+import hashlib
+import inspect
+import joblib
+import json
+import types
+import time
+import sys
+import os
+
+# Bump to invalidate every cached stage output
+CACHE_FORMAT = 1
+# Modules under this directory are part of a stage's code; site-packages are not
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def file_fingerprint(path):
+    """Size and mtime of a file, or of every file in a directory, None if missing"""
+    if path is None or not os.path.exists(path):
+        return None
+    if os.path.isdir(path):
+        return sorted((entry, file_fingerprint(os.path.join(path, entry))) for entry in os.listdir(path))
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _project_file(module):
+    """Source file of a module of the project, or None for any other module"""
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return None
+    path = os.path.abspath(path)
+    if not path.startswith(PROJECT_DIR + os.sep) or 'site-packages' in path:
+        return None
+    return path
+
+
+def _module_of(value):
+    if isinstance(value, types.ModuleType):
+        return value
+    return sys.modules.get(getattr(value, '__module__', None) or '')
+
+
+def _code_names(code):
+    """Global names used by a code object and the functions nested in it"""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+    return names
+
+
+def module_sources(funcs):
+    """{path: sha256} of the project modules funcs use, directly or through other modules.
+
+    Functions of the funcs' own module are followed through the names they
+    use (their own source is hashed by the stage), other project modules
+    through all of their globals.
+    """
+    own_modules = {func.__module__ for func in funcs}
+    pending, seen_funcs, modules = list(funcs), set(), {}
+    while pending:
+        func = pending.pop()
+        if func in seen_funcs:
+            continue
+        seen_funcs.add(func)
+        for name in _code_names(func.__code__):
+            value = func.__globals__.get(name)
+            if isinstance(value, types.FunctionType) and value.__module__ in own_modules:
+                pending.append(value)
+                continue
+            module = _module_of(value)
+            if module is not None and module.__name__ not in own_modules:
+                modules.setdefault(module.__name__, module)
+
+    sources, stack = {}, list(modules.values())
+    while stack:
+        module = stack.pop()
+        path = _project_file(module)
+        if path is None or path in sources:
+            continue
+        with open(path, 'rb') as f:
+            sources[path] = hashlib.sha256(f.read()).hexdigest()
+        stack.extend(filter(None, (_module_of(value) for value in vars(module).values())))
+    return {os.path.relpath(path, PROJECT_DIR): digest for path, digest in sorted(sources.items())}
+
+
+def ranges(n, size):
+    """(start, stop) ranges of at most size covering range(n)"""
+    return [(start, min(start + size, n)) for start in range(0, n, max(size, 1))]
+
+
+@functools.lru_cache(maxsize=32)
+def load_output(path):
+    """A cached stage output, with its arrays memory-mapped read-only"""
+    return joblib.load(path, mmap_mode='r')
+
+
+def _dump(value, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    joblib.dump(value, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _run_stage(func, dep_paths, params, path):
+    """Worker side of a single-task stage: load inputs, run, write the output"""
+    inputs = {name: load_output(dep_path) for name, dep_path in dep_paths.items()}
+    _dump(func(**inputs, **params), path)
+    return path
+
+
+def _run_part(func, part, dep_paths, params):
+    """Worker side of one part of a split stage"""
+    inputs = {name: load_output(dep_path) for name, dep_path in dep_paths.items()}
+    return func(part, **inputs, **params)
+
+
+class InlineExecutor:
+    """Runs submitted calls right away in this process, for workers=1"""
+
+    def submit(self, func, *args):
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class Stage:
+    """One step of a Pipeline; see the module docstring"""
+
+    def __init__(self, name, func, deps=(), params=None, files=(), split=None, combine=None):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.params = params or {}
+        self.files = tuple(files)
+        self.split = split
+        self.combine = combine
+
+    def functions(self):
+        return [func for func in (self.func, self.split, self.combine) if func is not None]
+
+    def source_hash(self):
+        """Hash of the stage's functions and of the project modules they use"""
+        source = ''.join(inspect.getsource(func) for func in self.functions())
+        source += json.dumps(module_sources(self.functions()), sort_keys=True)
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+class Pipeline:
+    """Stages added in dependency order, run by run() on workers processes"""
+
+    def __init__(self, cache_dir, workers=None):
+        self.cache_dir = cache_dir
+        self.workers = max(workers or os.cpu_count() or 1, 1)
+        self.stages = {}
+        self._keys = {}
+
+    def add(self, name, func, deps=(), params=None, files=(), split=None, combine=None):
+        """Declare a stage; its deps must already be declared"""
+        missing = [dep for dep in deps if dep not in self.stages]
+        if missing:
+            raise ValueError(f"Stage {name} depends on undeclared stages {missing}")
+        self.stages[name] = Stage(name, func, deps, params, files, split, combine)
+
+    def key(self, name):
+        """Hash of everything the output of a stage depends on"""
+        if name not in self._keys:
+            stage = self.stages[name]
+            spec = {
+                'format': CACHE_FORMAT,
+                'name': name,
+                'source': stage.source_hash(),
+                'params': repr(sorted(stage.params.items())),
+                'files': [file_fingerprint(path) for path in stage.files],
+                'deps': [self.key(dep) for dep in stage.deps],
+            }
+            digest = hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()
+            self._keys[name] = digest[:20]
+        return self._keys[name]
+
+    def build_key(self):
+        """Hash of every stage key: equal for two builds of the same outputs"""
+        keys = [f"{name}:{self.key(name)}" for name in self.stages]
+        return hashlib.sha256('\n'.join(keys).encode('utf-8')).hexdigest()[:20]
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, f"{name}-{self.key(name)}.joblib")
+
+    def load(self, name):
+        """Output of a stage that has run"""
+        return load_output(self.path(name))
+
+    def run(self):
+        """Run every stage whose output is not cached. Returns the names of those run."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        done = {name for name in self.stages if os.path.exists(self.path(name))}
+        for name in self.stages:
+            if name in done:
+                print(f"Stage {name}: cached")
+        pending = [name for name in self.stages if name not in done]
+        executor = ProcessPoolExecutor(self.workers) if self.workers > 1 and len(pending) else InlineExecutor()
+        # future -> (stage name, part index or None)
+        running = {}
+        # stage name -> [results by part, parts left]
+        parts = {}
+        started = {}
+        try:
+            while pending or running:
+                ready = self._ready(pending, done)
+                while ready:
+                    for name in ready:
+                        pending.remove(name)
+                        started[name] = time.perf_counter()
+                        self._submit(executor, name, running, parts)
+                        if name in parts and parts[name][1] == 0:
+                            # Nothing to split: done right away, its dependents may be ready
+                            self._finish(name, parts.pop(name)[0], started, done)
+                    ready = self._ready(pending, done)
+                if not running:
+                    if pending:
+                        raise RuntimeError(f"Stages {pending} cannot run")
+                    break
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, index = running.pop(future)
+                    result = future.result()
+                    if index is None:
+                        self._report(name, started)
+                        done.add(name)
+                        continue
+                    parts[name][0][index] = result
+                    parts[name][1] -= 1
+                    if parts[name][1] == 0:
+                        self._finish(name, parts.pop(name)[0], started, done)
+        finally:
+            executor.shutdown(wait=True)
+        self._prune()
+        return [name for name in self.stages if name in started]
+
+    def _ready(self, pending, done):
+        return [name for name in pending if all(dep in done for dep in self.stages[name].deps)]
+
+    def _dep_paths(self, stage):
+        return {dep: self.path(dep) for dep in stage.deps}
+
+    def _submit(self, executor, name, running, parts):
+        stage = self.stages[name]
+        dep_paths = self._dep_paths(stage)
+        if stage.split is None:
+            future = executor.submit(_run_stage, stage.func, dep_paths, stage.params, self.path(name))
+            running[future] = (name, None)
+            return
+        inputs = {dep: load_output(path) for dep, path in dep_paths.items()}
+        split_parts = stage.split(self.workers, **inputs, **stage.params)
+        print(f"Stage {name}: {len(split_parts)} parts")
+        parts[name] = [[None] * len(split_parts), len(split_parts)]
+        for index, part in enumerate(split_parts):
+            future = executor.submit(_run_part, stage.func, part, dep_paths, stage.params)
+            running[future] = (name, index)
+
+    def _finish(self, name, results, started, done):
+        stage = self.stages[name]
+        inputs = {dep: load_output(path) for dep, path in self._dep_paths(stage).items()}
+        _dump(stage.combine(results, **inputs, **stage.params), self.path(name))
+        self._report(name, started)
+        done.add(name)
+
+    def _report(self, name, started):
+        print(f"Stage {name}: built in {time.perf_counter() - started[name]:.2f}s")
+
+    def _prune(self):
+        """Remove cached outputs of earlier builds that this one no longer uses"""
+        current = {os.path.basename(self.path(name)) for name in self.stages}
+        for entry in os.listdir(self.cache_dir):
+            if entry.endswith('.joblib') and entry not in current:
+                os.remove(os.path.join(self.cache_dir, entry))
@@ -0,0 +1,28 @@
+import numpy as np
+from utils.metrics import stage
+
+def top_k_rows(scores, k, exclude_rows=None):
+    """Rows of the k highest scores, best first.
+
+    Ties keep catalog order, like DataFrame.nlargest. Excluded rows are
+    masked in place, so pass a scores array owned by the caller. Rows
+    whose score is -inf (excluded or unscorable) are never returned.
+    """
+    with stage('topk'):
+        if exclude_rows is not None and len(exclude_rows) > 0:
+            scores[np.asarray(exclude_rows, dtype=np.intp)] = -np.inf
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.intp)
+
+        if k < len(scores):
+            split = len(scores) - k
+            kth = scores[np.argpartition(scores, split)[split]]
+            # Rows tied with the k-th score are taken in catalog order too
+            above = np.flatnonzero(scores > kth)
+            tied = np.flatnonzero(scores == kth)[:k - len(above)]
+            rows = np.union1d(above, tied)
+        else:
+            rows = np.arange(len(scores))
+        rows = rows[np.argsort(-scores[rows], kind='stable')]
+        return rows[scores[rows] > -np.inf]
@@ -0,0 +1,105 @@
+"""JSON encoding of API responses.
+
+dumps() encodes a response with orjson when it is installed (the json
+module otherwise) and splices in PreEncoded values as they are, so
+catalog records are written from JSON encoded once per product rather
+than built as dicts and encoded on every request. NumPy scalars and
+arrays, Decimal and dates are accepted wherever they appear.
+"""
+from decimal import Decimal
+import datetime
+import math
+import json
+import os
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson, or json to use the standard library even when orjson is installed
+JSON_LIBRARY = os.getenv('JSON_LIBRARY', 'orjson')
+
+
+class PreEncoded:
+    """A value that encodes itself, spliced into dumps() output as is"""
+
+    def to_json(self):
+        """UTF-8 JSON of the value"""
+        raise NotImplementedError
+
+
+def _default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    # As Flask's encoder did, so database prices keep their digits
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# Compact and UTF-8, the same bytes orjson writes
+_encoder = json.JSONEncoder(default=_default, ensure_ascii=False, separators=(',', ':'))
+
+
+def json_dumps(value):
+    return _encoder.encode(value).encode('utf-8')
+
+
+def orjson_dumps(value):
+    return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+# Encodes everything that is not PreEncoded
+_dumps = orjson_dumps if orjson is not None and JSON_LIBRARY == 'orjson' else json_dumps
+
+
+def dumps_str(value):
+    """JSON of value as a str, for fragments stored as text"""
+    return _dumps(value).decode('utf-8')
+
+
+def float_json(value):
+    """JSON of a float; null for NaN and infinities, which JSON cannot hold"""
+    return repr(value) if math.isfinite(value) else 'null'
+
+
+def _nested(values):
+    return any(isinstance(value, (PreEncoded, dict, list, tuple)) for value in values)
+
+
+def _encode(value, parts):
+    if isinstance(value, PreEncoded):
+        parts.append(value.to_json())
+    elif isinstance(value, dict) and _nested(value.values()):
+        parts.append(b'{')
+        for i, (key, item) in enumerate(value.items()):
+            if i:
+                parts.append(b',')
+            parts.append(_dumps(str(key)))
+            parts.append(b':')
+            _encode(item, parts)
+        parts.append(b'}')
+    elif isinstance(value, (list, tuple)) and _nested(value):
+        parts.append(b'[')
+        for i, item in enumerate(value):
+            if i:
+                parts.append(b',')
+            _encode(item, parts)
+        parts.append(b']')
+    else:
+        # No PreEncoded inside: one call to the encoder
+        parts.append(_dumps(value))
+
+
+def dumps(value):
+    """UTF-8 JSON of a response"""
+    parts = []
+    _encode(value, parts)
+    return b''.join(parts)
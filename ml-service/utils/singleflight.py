@@ -0,0 +1,74 @@
+"""Coalescing of concurrent identical calls.
+
+When several threads need the same missing value at once (a cold cache
+entry, a user profile not loaded yet, a model on first use), only the
+first one computes it. The others wait for that call and share its result
+or its exception, so a burst of identical requests runs one Postgres
+query or one model load instead of one per request.
+"""
+import threading
+import os
+from utils import metrics
+
+# Seconds a caller waits for the call it joined before giving up with TimeoutError
+SINGLEFLIGHT_TIMEOUT = float(os.getenv('SINGLEFLIGHT_TIMEOUT', 30))
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.thread = threading.get_ident()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time; callers of a running key join it"""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._computed = metrics.SINGLEFLIGHT_CALLS.labels(name, 'computed')
+        self._coalesced = metrics.SINGLEFLIGHT_CALLS.labels(name, 'coalesced')
+        self._timeouts = metrics.SINGLEFLIGHT_CALLS.labels(name, 'timeout')
+
+    def do(self, key, func, timeout=SINGLEFLIGHT_TIMEOUT):
+        """func()'s result, computed by this call or by the running call of key.
+
+        A joined call's exception is raised in every caller. Callers stop
+        waiting after timeout seconds (None waits as long as it takes),
+        leaving the call to finish for the others.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader and call.thread == threading.get_ident():
+            # Called again for the same key from inside func: waiting would never end
+            return func()
+        if leader:
+            self._computed.inc()
+            try:
+                call.result = func()
+                return call.result
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    if self._calls.get(key) is call:
+                        del self._calls[key]
+                call.done.set()
+
+        self._coalesced.inc()
+        with metrics.stage('coalesced'):
+            finished = call.done.wait(timeout)
+        if not finished:
+            self._timeouts.inc()
+            raise TimeoutError(f"{self.name} {key!r} still running after {timeout}s")
+        if call.error is not None:
+            raise call.error
+        return call.result
@@ -0,0 +1,97 @@
+"""Model loading as named steps, and the readiness they add up to.
+
+The service can answer /health/live as soon as it is imported; the
+steps (database, catalog, profiles, ...) load the models afterwards,
+in the gunicorn master before forking or in a background thread of
+each worker, and /health/ready reports every step until all are done.
+"""
+import threading
+import time
+import os
+
+# Seconds between attempts at the steps that failed, when loading in the background
+WARMUP_RETRY_INTERVAL = float(os.getenv('WARMUP_RETRY_INTERVAL', 5))
+
+
+class Warmup:
+    """Steps run once, in order, each pending, loading, ready or failed.
+
+    A required step that fails stops the run, since later steps build
+    on it. Optional steps (cache warming, request replay) only have to
+    have been attempted for the service to be ready.
+    """
+
+    def __init__(self):
+        self.steps = []
+        self.states = {}
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._thread = None
+
+    def add(self, name, func, required=True):
+        self.steps.append((name, func, required))
+        self.states[name] = {'state': 'pending', 'required': required}
+
+    def _set(self, name, **state):
+        with self._lock:
+            self.states[name] = dict(state, required=self.states[name]['required'])
+
+    def run(self):
+        """Run the steps not done yet in this thread. Returns whether the service is ready."""
+        with self._run_lock:
+            for name, func, required in self.steps:
+                if self.states[name]['state'] == 'ready' or (not required and self.states[name]['state'] == 'failed'):
+                    continue
+                self._set(name, state='loading')
+                start = time.perf_counter()
+                try:
+                    func()
+                except Exception as e:
+                    print(f"Warmup step {name} failed: {e}")
+                    self._set(name, state='failed', error=str(e), seconds=round(time.perf_counter() - start, 3))
+                    if required:
+                        return False
+                else:
+                    self._set(name, state='ready', seconds=round(time.perf_counter() - start, 3))
+            return self.ready()
+
+    def start(self, then=None):
+        """Run the steps in a daemon thread until the service is ready, then call then().
+
+        Calls then() right away when the steps already ran, e.g. in a
+        worker forked from a master that loaded the models.
+        """
+        if self.ready():
+            if then is not None:
+                then()
+            return
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        def run():
+            while not self.run():
+                time.sleep(WARMUP_RETRY_INTERVAL)
+            print("Warmup complete, ready to serve")
+            if then is not None:
+                then()
+
+        self._thread = threading.Thread(target=run, name='Warmup', daemon=True)
+        self._thread.start()
+
+    def ready(self):
+        """Whether every required step is ready and every optional one was attempted"""
+        with self._lock:
+            return all(
+                state['state'] == 'ready' or (not state['required'] and state['state'] == 'failed')
+                for state in self.states.values()
+            )
+
+    def report(self):
+        """Readiness and the state of every step, for /health/ready"""
+        with self._lock:
+            steps = {name: dict(state) for name, state in self.states.items()}
+        return {'ready': self.ready(), 'steps': steps}
+
+
+# The service's steps, added by app.py
+warmup = Warmup()
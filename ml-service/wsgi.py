@@ -0,0 +1,23 @@
+"""WSGI entry point for production serving.
+
+Gunicorn imports this once in the master process (preload_app), so the
+catalog is loaded before the workers fork and its arrays are shared
+copy-on-write between them. With ML_WARMUP=background the master skips
+that: every worker answers /health/live right away and loads the models
+in a background thread, reporting its progress on /health/ready. Run with:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import os
+from app import app
+from utils.warmup import warmup
+from utils.database import close_pool
+
+# preload: load the models in the master before forking; background: in every worker after fork
+WARMUP_MODE = os.getenv('ML_WARMUP', 'preload')
+
+if WARMUP_MODE == 'preload':
+    # Forked workers inherit the models and the head query rankings
+    warmup.run()
+    # Pooled sockets must not be inherited by forked workers
+    close_pool()
@@ -0,0 +1,28 @@
+-- Add an updated_at column to products so the ML service can pick up
+-- added and edited products incrementally (see ml-service catalog refresh)
+-- Run these commands in your PostgreSQL database if the table already exists
+
+-- Add updated_at column (new rows get the insert time)
+ALTER TABLE products ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+
+-- Keep updated_at current on every UPDATE
+CREATE OR REPLACE FUNCTION set_products_updated_at() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.updated_at = CURRENT_TIMESTAMP;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS products_set_updated_at ON products;
+CREATE TRIGGER products_set_updated_at
+    BEFORE UPDATE ON products
+    FOR EACH ROW EXECUTE FUNCTION set_products_updated_at();
+
+-- The ML service polls for rows changed since its last refresh
+CREATE INDEX IF NOT EXISTS idx_products_updated_at ON products(updated_at);
+
+-- Verify the column was added
+SELECT column_name, data_type, is_nullable 
+FROM information_schema.columns 
+WHERE table_name = 'products' 
+ORDER BY ordinal_position;
@@ -4,11 +4,13 @@ const ML_SERVICE_URL = process.env.ML_SERVICE_URL || 'http://localhost:5000';
 
 const mlService = {
   // 1. Home page recommendations
-  getHomeRecommendations: async (userId, limit = 8) => {
+  // cartProductIds is optional; without it the service reads the cart itself
+  getHomeRecommendations: async (userId, limit = 8, cartProductIds = null) => {
     try {
       const response = await axios.post(`${ML_SERVICE_URL}/api/recommend/home`, {
         user_id: userId || null,
-        limit: limit
+        limit: limit,
+        cart_product_ids: cartProductIds || null
       }, {
         timeout: 5000 // 5 second timeout
       });
@@ -104,6 +106,43 @@ const mlService = {
     }
   },
 
+  // Tell the ML service an order was paid so its cached rankings refresh
+  notifyOrderPaid: async (orderId, userId) => {
+    try {
+      await axios.post(`${ML_SERVICE_URL}/api/events/order-paid`, {
+        order_id: orderId,
+        user_id: userId || null
+      }, {
+        timeout: 5000
+      });
+    } catch (error) {
+      console.error('Error notifying ML service of paid order:', error.message);
+    }
+  },
+
+  // Several calls in one round trip. Each entry is { path, body }; the
+  // result holds one array per entry, [] for any entry that failed.
+  batch: async (requests) => {
+    try {
+      if (!requests || requests.length === 0) {
+        return [];
+      }
+      const response = await axios.post(`${ML_SERVICE_URL}/api/batch`, {
+        requests: requests
+      }, {
+        timeout: 5000
+      });
+      const results = (response.data && response.data.results) || [];
+      return requests.map((_, i) => {
+        const result = results[i];
+        return result && result.status === 200 ? result.data || [] : [];
+      });
+    } catch (error) {
+      console.error('Error running ML batch:', error.message);
+      return requests.map(() => []);
+    }
+  },
+
   // 5. Search
   searchProducts: async (query, userId = null, limit = 20) => {
     try {